@@ -0,0 +1,222 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Deterministic synthetic inputs for the benchmarks
+
+The files follow the formats of tests/support_files: BLAST (-m9) or
+SortMeRNA tabular search results against the interest and the other
+database, a taxonomy file, a FASTA file and a split file.
+"""
+from __future__ import division
+
+from json import dump, load
+from os import makedirs
+from os.path import isdir, isfile, join
+from random import Random
+
+import click
+
+_BLAST_HEADER = ("# BLASTN 2.2.22 [Sep-27-2009]\n"
+                 "# Query: %s\n"
+                 "# Database: %s\n")
+_BLAST_FIELDS = ("# Fields: Query id, Subject id, % identity, alignment "
+                 "length, mismatches, gap openings, q. start, q. end, s. "
+                 "start, s. end, e-value, bit score\n")
+
+# the taxon used to split the database, see split_db
+TAXON = 'Salmonella'
+
+_OTHER_TAXA = ['Escherichia coli K-12', 'Burkholderia mallei GB8 horse 4',
+               'Vibrio cholerae O1', 'Yersinia pestis bv Orientalis IP275',
+               'Marine gamma proteobacterium sp. HTCC2143']
+
+# name of the file that describes how the data was generated
+PARAMETERS_FN = 'parameters.json'
+
+DEFAULTS = {'queries': 10000, 'hits': 10, 'interest_fraction': 0.5,
+            'other_fraction': 0.8, 'subjects': 1000, 'sequences': 10000,
+            'sequence_length': 1000, 'taxon_fraction': 0.1, 'style': 'blast',
+            'seed': 0}
+
+# help of the command line option of each parameter, see generate
+_HELP = {'queries': 'Number of reads searched against both databases',
+         'hits': 'Average number of hits of the reads with hits',
+         'interest_fraction': 'Fraction of the reads with hits in the '
+         'interest database',
+         'other_fraction': 'Fraction of the reads with hits in the other '
+         'database',
+         'subjects': 'Number of sequences of each database that are hit',
+         'sequences': 'Number of sequences of the FASTA file',
+         'sequence_length': 'Average length of the FASTA sequences',
+         'taxon_fraction': 'Fraction of the FASTA sequences that belong to '
+         'the taxon of interest',
+         'style': 'Format of the search results',
+         'seed': 'Seed of the random number generator'}
+
+
+def query_name(i):
+    """Name of the i-th query, the names sort in the order of creation"""
+    return 'Q%010d' % i
+
+
+def subject_name(db, i):
+    """Name of the i-th sequence of a database"""
+    return '%s_%08d|%d' % (db.upper(), i, 640000000 + i)
+
+
+def _hit_line(rng, query, subject, style):
+    """A search result line with plausible values"""
+    length = rng.randint(30, 300)
+    percent_id = round(rng.uniform(70, 100), 2)
+    mismatches = int(round(length * (100 - percent_id) / 100))
+    gaps = rng.randint(0, 3)
+    q_start = rng.randint(1, 20)
+    s_start = rng.randint(1, 5000)
+    bit_score = round(length * percent_id / 50, 1)
+    evalue = '%.3g' % (10 ** -rng.uniform(1, 100))
+    fields = [query, subject, '%.2f' % percent_id, length, mismatches, gaps,
+              q_start, q_start + length - 1, s_start, s_start + length - 1,
+              evalue, bit_score]
+    if style == 'sortmerna':
+        # CIGAR, coverage and the trailing tab of SortMeRNA
+        fields += ['%dM' % length, '%.1f' % rng.uniform(10, 100), '']
+    return '\t'.join(str(f) for f in fields) + '\n'
+
+
+def _write_search(fp, db, params, rng, fraction):
+    """Write the search results of all the queries against a database"""
+    with open(fp, 'w') as f:
+        for i in range(params['queries']):
+            query = query_name(i)
+            if params['style'] == 'blast':
+                f.write(_BLAST_HEADER % (query, db))
+            if rng.random() >= fraction:
+                continue
+
+            if params['style'] == 'blast':
+                f.write(_BLAST_FIELDS)
+            for _ in range(rng.randint(1, 2 * params['hits'] - 1)):
+                subject = subject_name(db, rng.randrange(params['subjects']))
+                f.write(_hit_line(rng, query, subject, params['style']))
+
+
+def _write_sequences(fp, tax_fp, split_fp, params, rng):
+    """Write the FASTA file, its taxonomy and the split file"""
+    # sequences are slices of a random pool, drawing each base is too slow
+    mean = params['sequence_length']
+    pool = ''.join(rng.choice('ACGT') for _ in range(4 * mean))
+
+    with open(fp, 'w') as seqs, open(tax_fp, 'w') as tax, \
+            open(split_fp, 'w') as split:
+        for i in range(params['sequences']):
+            name = subject_name('seq', i)
+            if rng.random() < params['taxon_fraction']:
+                taxon = '%s enterica strain %d' % (TAXON, i)
+                split.write('%s\n' % name)
+            else:
+                taxon = rng.choice(_OTHER_TAXA)
+            tax.write('%s\t%s\n' % (name, taxon))
+
+            length = min(max(1, int(rng.gauss(mean, mean / 10))), 2 * mean)
+            start = rng.randrange(len(pool) - length + 1)
+            sequence = pool[start:start + length]
+            seqs.write('>%s description %d\n%s\n' % (name, i, sequence))
+
+
+def generate(output_dir, **params):
+    """Write a synthetic data set
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory where the files are written, created if needed.
+    params : dict
+        Overrides of DEFAULTS:
+
+        - queries: number of reads searched against both databases.
+        - hits: average number of hits of the reads with hits.
+        - interest_fraction: fraction of the reads with hits in the interest
+          database.
+        - other_fraction: fraction of the reads with hits in the other
+          database.
+        - subjects: number of sequences of each database that are hit.
+        - sequences: number of sequences of the FASTA file.
+        - sequence_length: average length of the FASTA sequences.
+        - taxon_fraction: fraction of the FASTA sequences that belong to
+          TAXON.
+        - style: 'blast' or 'sortmerna', the format of the search results.
+        - seed: seed of the random number generator.
+
+    Returns
+    -------
+    dict
+        The parameters used, also written to PARAMETERS_FN.
+
+    Notes
+    -----
+    The same parameters always generate the same files. If output_dir
+    already contains a data set generated with the same parameters, it's
+    not written again.
+    """
+    unknown = set(params) - set(DEFAULTS)
+    if unknown:
+        raise ValueError("Unknown parameters: %s" % ', '.join(sorted(unknown)))
+    full = dict(DEFAULTS)
+    full.update(params)
+    if full['style'] not in ('blast', 'sortmerna'):
+        raise ValueError("Unknown style: %s" % full['style'])
+
+    parameters_fp = join(output_dir, PARAMETERS_FN)
+    if isfile(parameters_fp):
+        with open(parameters_fp) as f:
+            if load(f) == full:
+                return full
+    if not isdir(output_dir):
+        makedirs(output_dir)
+
+    # every file has its own generator so changing one doesn't change the rest
+    _write_search(join(output_dir, 'interest.m9'), 'interest', full,
+                  Random(3 * full['seed']),
+                  full['interest_fraction'])
+    _write_search(join(output_dir, 'other.m9'), 'other', full,
+                  Random(3 * full['seed'] + 1), full['other_fraction'])
+    _write_sequences(join(output_dir, 'seqs.fna'),
+                     join(output_dir, 'taxonomy.txt'),
+                     join(output_dir, 'split.txt'), full,
+                     Random(3 * full['seed'] + 2))
+
+    # written last, an interrupted run is generated again
+    with open(parameters_fp, 'w') as f:
+        dump(full, f, indent=2, sort_keys=True)
+    return full
+
+
+def generator_options(function):
+    """Add an option for each of the parameters of generate"""
+    for name, value in sorted(DEFAULTS.items(), reverse=True):
+        if name == 'style':
+            function = click.option(
+                '--style', type=click.Choice(['blast', 'sortmerna']),
+                default=value, show_default=True,
+                help=_HELP[name])(function)
+        else:
+            function = click.option('--' + name, type=type(value),
+                                    default=value, show_default=True,
+                                    help=_HELP[name])(function)
+    return function
+
+
+@click.command()
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@generator_options
+def main(output_dir, **params):
+    """Write a synthetic data set to OUTPUT_DIR"""
+    generate(output_dir, **params)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Measure the throughput and peak memory of each stage of platypus
+
+Typical use, to find regressions of the working tree against master::
+
+    python benchmarks/run.py --revision master --output master.json
+    python benchmarks/run.py --baseline master.json
+"""
+from __future__ import division
+
+import sys
+import tarfile
+from collections import OrderedDict
+from json import dump, load, loads
+from os import environ
+from os.path import abspath, dirname, join
+from shutil import rmtree
+from subprocess import PIPE, Popen
+from tempfile import mkdtemp
+
+import click
+
+from generate import generate, generator_options
+from stages import STAGES, UNSUPPORTED
+
+_BENCHMARKS = dirname(abspath(__file__))
+_REPOSITORY = dirname(_BENCHMARKS)
+
+# smaller memory growths are measurement noise, the ratios are computed from
+# at least this many bytes
+_MIN_GROWTH = 1024 ** 2
+
+
+def checkout(revision, directory):
+    """Extract the platypus package of a git revision into directory"""
+    process = Popen(['git', 'archive', revision, 'platypus'],
+                    cwd=_REPOSITORY, stdout=PIPE)
+    with tarfile.open(fileobj=process.stdout, mode='r|') as archive:
+        archive.extractall(directory)
+    if process.wait():
+        raise click.ClickException("Could not read revision %s" % revision)
+
+
+def run_stage(stage, data_dir, grid, source):
+    """Run a stage in a new process with platypus imported from source
+
+    Returns
+    -------
+    dict or None
+        The measurements, None if the revision doesn't support the stage.
+    """
+    env = dict(environ)
+    env['PYTHONPATH'] = source
+    process = Popen([sys.executable, join(_BENCHMARKS, 'stages.py'), stage,
+                     data_dir, str(grid)], stdout=PIPE, env=env)
+    output = process.communicate()[0]
+    if process.returncode == UNSUPPORTED:
+        return None
+    if process.returncode:
+        raise click.ClickException("The %s stage failed" % stage)
+    # the measurements are the last line, the stage could print other lines
+    return loads(output.strip().split('\n')[-1])
+
+
+def best_of(measurements):
+    """Combine repeated measurements, keeping the fastest and smallest"""
+    best = dict(min(measurements, key=lambda m: m['wall']))
+    smallest = min(measurements, key=lambda m: m['peak_rss'])
+    best['peak_rss'] = smallest['peak_rss']
+    best['setup_rss'] = smallest['setup_rss']
+    best['repeats'] = len(measurements)
+    return best
+
+
+def report(results, baseline, tolerance):
+    """Print a table of the results, return the names of the regressions"""
+    header = ('stage', 'wall (s)', 'cpu (s)', 'MB/s', 'items/s',
+              'peak RSS (MB)', 'growth (MB)')
+    if baseline:
+        header += ('wall ratio', 'growth ratio')
+    # the first column fits the longest stage name
+    name = '%%-%ds' % (max(len(stage) for stage in
+                           list(results) + [header[0]]) + 2)
+    click.echo(name % header[0] + ''.join('%14s' % h for h in header[1:]))
+
+    regressions = []
+    for stage, m in results.items():
+        if m is None:
+            click.echo(name % stage + '%14s' % 'unsupported')
+            continue
+        wall = max(m['wall'], 1e-9)
+        row = ['%.3f' % m['wall'], '%.3f' % m['cpu'],
+               '%.1f' % (m['input_bytes'] / wall / 1024 ** 2)
+               if m['input_bytes'] else '-',
+               '%.0f' % (m['items'] / wall) if m['items'] else '-',
+               '%.1f' % (m['peak_rss'] / 1024 ** 2),
+               '%.1f' % ((m['peak_rss'] - m['setup_rss']) / 1024 ** 2)]
+
+        base = baseline.get(stage)
+        if base:
+            wall_ratio = m['wall'] / max(base['wall'], 1e-9)
+            # the memory of the stage itself, not the imports of the revision
+            growth_ratio = (max(m['peak_rss'] - m['setup_rss'], _MIN_GROWTH) /
+                            max(base['peak_rss'] - base['setup_rss'],
+                                _MIN_GROWTH))
+            row += ['%.2f' % wall_ratio, '%.2f' % growth_ratio]
+            if wall_ratio > 1 + tolerance or growth_ratio > 1 + tolerance:
+                regressions.append(stage)
+                row.append('REGRESSION')
+        click.echo(name % stage + ''.join('%14s' % r for r in row))
+    return regressions
+
+
+@click.command()
+@click.option('--data_dir', type=click.Path(file_okay=False),
+              default='benchmark-data', show_default=True,
+              help='Directory of the synthetic data, it is generated only '
+              'if the parameters change')
+@click.option('--stage', 'stages', type=click.Choice(list(STAGES)),
+              multiple=True, help='Stage to run, can be repeated. Defaults '
+              'to all of them')
+@click.option('--grid', type=click.IntRange(1), default=3, show_default=True,
+              help='Number of percentage identities and of alignment '
+              'lengths, the thresholds are all their combinations')
+@click.option('--repeat', type=click.IntRange(1), default=3,
+              show_default=True, help='Runs of each stage, the best is kept')
+@click.option('--revision', default=None,
+              help='Benchmark this git revision instead of the working tree')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Write the results as JSON to this file')
+@click.option('--baseline', type=click.File('r'), default=None,
+              help='Results of a previous run to compare with')
+@click.option('--tolerance', type=float, default=0.1, show_default=True,
+              help='Relative slowdown or memory increase over the baseline '
+              'reported as a regression')
+@generator_options
+def main(data_dir, stages, grid, repeat, revision, output, baseline,
+         tolerance, **params):
+    """Benchmark the stages of platypus on synthetic data
+
+    Exits with status 1 if a stage regressed with respect to the baseline.
+    """
+    params = generate(data_dir, **params)
+    data_dir = abspath(data_dir)
+
+    source = _REPOSITORY
+    if revision is not None:
+        source = mkdtemp()
+        checkout(revision, source)
+
+    results = {}
+    try:
+        for stage in stages or STAGES:
+            measurements = [run_stage(stage, data_dir, grid, source)
+                            for _ in range(repeat)]
+            if None in measurements:
+                results[stage] = None
+            else:
+                results[stage] = best_of(measurements)
+    finally:
+        if revision is not None:
+            rmtree(source)
+
+    if baseline is not None:
+        baseline = load(baseline)
+        if baseline['parameters'] != params or baseline['grid'] != grid:
+            click.echo('Warning: the baseline was run with other parameters',
+                       err=True)
+        baseline = baseline['stages']
+
+    results = OrderedDict((stage, results[stage]) for stage in STAGES
+                          if stage in results)
+    regressions = report(results, baseline or {}, tolerance)
+
+    if output is not None:
+        with open(output, 'w') as f:
+            dump({'revision': revision, 'parameters': params, 'grid': grid,
+                  'stages': results}, f, indent=2, sort_keys=True)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Run a single benchmark stage and print its measurements as JSON
+
+Usage: python stages.py STAGE DATA_DIR GRID
+
+Every stage runs in a fresh process started by run.py, so the peak memory
+belongs to that stage alone. The platypus package is imported from
+PYTHONPATH, which lets run.py benchmark other revisions of the code.
+"""
+from __future__ import division
+
+import sys
+from collections import OrderedDict
+from inspect import getargspec
+from json import dumps
+from os.path import getsize, join
+from resource import getrusage, RUSAGE_SELF
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+# stages not supported by the benchmarked revision exit with this status
+UNSUPPORTED = 3
+
+# the taxon of generate.TAXON, not imported to keep this script standalone
+TAXON = 'Salmonella'
+
+
+def thresholds(grid):
+    """Percentage identities and alignment lengths of a grid x grid sweep"""
+    percentage_ids = [70 + 30 * i // grid for i in range(grid)]
+    alignment_lengths = [30 + 270 * i // grid for i in range(grid)]
+    return percentage_ids, alignment_lengths
+
+
+def _supported(function, **kwargs):
+    """Keep the keyword arguments that function accepts"""
+    names = getargspec(function).args
+    return {k: v for k, v in kwargs.items() if k in names}
+
+
+class _Measure(object):
+    """Wall and CPU time and memory of the code run inside the block"""
+
+    def __enter__(self):
+        self.rss_before = getrusage(RUSAGE_SELF).ru_maxrss * 1024
+        self.cpu = -sum(getrusage(RUSAGE_SELF)[:2])
+        self.wall = -time()
+        return self
+
+    def __exit__(self, *args):
+        self.wall += time()
+        usage = getrusage(RUSAGE_SELF)
+        self.cpu += usage.ru_utime + usage.ru_stime
+        self.peak_rss = usage.ru_maxrss * 1024
+
+
+def _first(data_dir, grid):
+    from platypus.parse import parse_first_database
+
+    pcts, lens = thresholds(grid)
+    kwargs = _supported(parse_first_database, columnar=True)
+    with open(join(data_dir, 'interest.m9')) as f:
+        return parse_first_database(f, pcts, lens, **kwargs)
+
+
+def _second(data_dir, grid, best_hits):
+    from platypus.parse import parse_second_database
+
+    pcts, lens = thresholds(grid)
+    kwargs = _supported(parse_second_database, columnar=True)
+    with open(join(data_dir, 'other.m9')) as f:
+        parse_second_database(f, best_hits, pcts, lens, **kwargs)
+
+
+def stage_parse_m9(data_dir, grid):
+    from platypus.parse import parse_m9
+
+    fp = join(data_dir, 'interest.m9')
+    with _Measure() as m, open(fp) as f:
+        items = sum(1 for query, _ in parse_m9(f) if query is not None)
+    return m, getsize(fp), items
+
+
+def stage_parse_m9_columnar(data_dir, grid):
+    try:
+        from platypus.parse import parse_m9_columnar
+    except ImportError:
+        sys.exit(UNSUPPORTED)
+
+    fp = join(data_dir, 'interest.m9')
+    with _Measure() as m, open(fp) as f:
+        items = sum(1 for query, _ in parse_m9_columnar(f)
+                    if query is not None)
+    return m, getsize(fp), items
+
+
+def stage_parse_first_database(data_dir, grid):
+    with _Measure() as m:
+        _, best_hits = _first(data_dir, grid)
+    return m, getsize(join(data_dir, 'interest.m9')), len(best_hits)
+
+
+def stage_parse_first_database_unordered(data_dir, grid):
+    from platypus.parse import parse_first_database
+
+    # the halves of the hits of every query are far apart in the file, and
+    # a small memory limit groups them through the temporary files
+    pcts, lens = thresholds(grid)
+    kwargs = _supported(parse_first_database, columnar=True, unordered=True,
+                        group_memory=1024 * 1024)
+    if 'unordered' not in kwargs:
+        sys.exit(UNSUPPORTED)
+    fp = join(data_dir, 'interest.m9')
+    output_dir = mkdtemp()
+    try:
+        with open(fp) as f:
+            lines = [line for line in f if not line.startswith('#')]
+        interleaved = join(output_dir, 'interest.m9')
+        with open(interleaved, 'w') as f:
+            f.writelines(lines[::2])
+            f.writelines(lines[1::2])
+        del lines
+
+        with _Measure() as m, open(interleaved) as f:
+            _, best_hits = parse_first_database(f, pcts, lens, **kwargs)
+    finally:
+        rmtree(output_dir)
+    return m, getsize(fp), len(best_hits)
+
+
+def stage_parse_second_database(data_dir, grid):
+    _, best_hits = _first(data_dir, grid)
+    with _Measure() as m:
+        _second(data_dir, grid, best_hits)
+    return m, getsize(join(data_dir, 'other.m9')), len(best_hits)
+
+
+def stage_process_results(data_dir, grid):
+    from platypus.parse import process_results
+
+    _, best_hits = _first(data_dir, grid)
+    _second(data_dir, grid, best_hits)
+    pcts, lens = thresholds(grid)
+    output_dir = mkdtemp()
+    try:
+        with _Measure() as m:
+            process_results(pcts, lens, pcts, lens, best_hits, output_dir,
+                            True, True)
+    finally:
+        rmtree(output_dir)
+    return m, 0, len(best_hits) * grid * grid
+
+
+def stage_process_results_consolidated(data_dir, grid):
+    return _process_results(data_dir, grid, consolidated=True)
+
+
+def stage_process_results_counts_only(data_dir, grid):
+    return _process_results(data_dir, grid, counts_only=True)
+
+
+def _process_results(data_dir, grid, **options):
+    from platypus.parse import process_results
+
+    kwargs = _supported(process_results, **options)
+    if not kwargs:
+        sys.exit(UNSUPPORTED)
+    _, best_hits = _first(data_dir, grid)
+    _second(data_dir, grid, best_hits)
+    pcts, lens = thresholds(grid)
+    output_dir = mkdtemp()
+    try:
+        with _Measure() as m:
+            process_results(pcts, lens, pcts, lens, best_hits, output_dir,
+                            True, True, **kwargs)
+    finally:
+        rmtree(output_dir)
+    return m, 0, len(best_hits) * grid * grid
+
+
+def stage_compare(data_dir, grid):
+    from platypus.commands import compare
+
+    pcts, lens = thresholds(grid)
+    interest_fp = join(data_dir, 'interest.m9')
+    other_fp = join(data_dir, 'other.m9')
+    output_dir = mkdtemp()
+    try:
+        with _Measure() as m:
+            compare(interest_fp, other_fp, join(output_dir, 'compare'), pcts,
+                    lens, pcts, lens, True, True)
+    finally:
+        rmtree(output_dir)
+    return m, getsize(interest_fp) + getsize(other_fp), 0
+
+
+def stage_compare_state(data_dir, grid):
+    from platypus.commands import compare
+
+    kwargs = _supported(compare, state_dir=None)
+    if not kwargs:
+        sys.exit(UNSUPPORTED)
+
+    # the queries are split in two batches, only adding the second is timed
+    pcts, lens = thresholds(grid)
+    output_dir = mkdtemp()
+    try:
+        batches = [[], []]
+        for name in ('interest.m9', 'other.m9'):
+            with open(join(data_dir, name)) as f:
+                lines = [line for line in f if not line.startswith('#')]
+            for i, batch in enumerate(batches):
+                batch.append(join(output_dir, '%s.%d' % (name, i)))
+                with open(batch[-1], 'w') as f:
+                    f.writelines(line for line in lines
+                                 if hash(line.split('\t', 1)[0]) % 2 == i)
+            del lines
+
+        state_dir = join(output_dir, 'state')
+        compare(batches[0][0], batches[0][1], join(output_dir, 'first'), pcts,
+                lens, pcts, lens, True, True, state_dir=state_dir)
+        with _Measure() as m:
+            compare(batches[1][0], batches[1][1], join(output_dir, 'second'),
+                    pcts, lens, pcts, lens, True, True, state_dir=state_dir)
+        input_bytes = sum(getsize(fp) for fp in batches[1])
+    finally:
+        rmtree(output_dir)
+    return m, input_bytes, 0
+
+
+def stage_compare_batch(data_dir, grid):
+    try:
+        from platypus.commands import compare_batch
+    except ImportError:
+        sys.exit(UNSUPPORTED)
+
+    # the queries are split in four samples compared by two processes
+    pcts, lens = thresholds(grid)
+    output_dir = mkdtemp()
+    try:
+        samples = [['s%d' % i] for i in range(4)]
+        for name in ('interest.m9', 'other.m9'):
+            with open(join(data_dir, name)) as f:
+                lines = [line for line in f if not line.startswith('#')]
+            for i, sample in enumerate(samples):
+                sample.append('%s.%d' % (name, i))
+                with open(join(output_dir, sample[-1]), 'w') as f:
+                    f.writelines(line for line in lines
+                                 if hash(line.split('\t', 1)[0]) % 4 == i)
+            del lines
+        manifest_fp = join(output_dir, 'manifest.txt')
+        with open(manifest_fp, 'w') as f:
+            f.writelines('\t'.join(sample) + '\n' for sample in samples)
+
+        with _Measure() as m:
+            compare_batch(manifest_fp, join(output_dir, 'batch'), pcts, lens,
+                          pcts, lens, True, True, jobs=2)
+    finally:
+        rmtree(output_dir)
+    return m, getsize(join(data_dir, 'interest.m9')) + getsize(
+        join(data_dir, 'other.m9')), len(samples)
+
+
+def stage_sequences_from_query(data_dir, grid):
+    from platypus.compare import sequences_from_query
+
+    fp = join(data_dir, 'taxonomy.txt')
+    with _Measure() as m, open(fp, 'U') as f:
+        items = len(sequences_from_query(f, TAXON))
+    return m, getsize(fp), items
+
+
+def stage_taxonomy_index(data_dir, grid):
+    try:
+        from platypus.taxonomy import taxonomy_index
+    except ImportError:
+        sys.exit(UNSUPPORTED)
+
+    # the index is built before measuring, only the cached query is timed
+    fp = join(data_dir, 'taxonomy.txt')
+    cache_dir = mkdtemp()
+    try:
+        taxonomy_index(fp, cache_dir)
+        with _Measure() as m:
+            items = len(taxonomy_index(fp, cache_dir).sequences_from_query(
+                TAXON))
+    finally:
+        rmtree(cache_dir)
+    return m, getsize(fp), items
+
+
+def stage_sequences_from_queries(data_dir, grid):
+    try:
+        from platypus.compare import sequences_from_queries
+    except ImportError:
+        sys.exit(UNSUPPORTED)
+
+    # a thousand queries, each of them matches a few strains at most
+    queries = [TAXON] + ['strain %d' % i for i in range(0, 10000, 10)]
+    fp = join(data_dir, 'taxonomy.txt')
+    with _Measure() as m, open(fp, 'U') as f:
+        items = len(sequences_from_queries(f, queries))
+    return m, getsize(fp), items
+
+
+def stage_split_db(data_dir, grid):
+    from platypus.commands import split_db
+
+    fp = join(data_dir, 'seqs.fna')
+    output_dir = mkdtemp()
+    try:
+        with _Measure() as m:
+            split_db(join(data_dir, 'taxonomy.txt'), fp, TAXON,
+                     join(output_dir, 'split'), None)
+    finally:
+        rmtree(output_dir)
+    return m, getsize(fp), 0
+
+
+def stage_split_db_indexed(data_dir, grid):
+    from platypus.commands import split_db
+
+    # the indexes are built before measuring, only the cached split is timed
+    fp = join(data_dir, 'seqs.fna')
+    output_dir = mkdtemp()
+    cache_dir = join(output_dir, 'cache')
+    kwargs = _supported(split_db, cache_dir=cache_dir)
+    if not kwargs:
+        rmtree(output_dir)
+        sys.exit(UNSUPPORTED)
+    try:
+        split_db(join(data_dir, 'taxonomy.txt'), fp, TAXON,
+                 join(output_dir, 'first'), None, **kwargs)
+        with _Measure() as m:
+            split_db(join(data_dir, 'taxonomy.txt'), fp, TAXON,
+                     join(output_dir, 'split'), None, **kwargs)
+    finally:
+        rmtree(output_dir)
+    return m, getsize(fp), 0
+
+
+# in the order of the pipeline
+STAGES = OrderedDict((f.__name__[len('stage_'):], f) for f in (
+    stage_parse_m9, stage_parse_m9_columnar, stage_parse_first_database,
+    stage_parse_first_database_unordered, stage_parse_second_database,
+    stage_process_results,
+    stage_process_results_consolidated, stage_process_results_counts_only,
+    stage_compare, stage_compare_state, stage_compare_batch,
+    stage_sequences_from_query, stage_taxonomy_index,
+    stage_sequences_from_queries, stage_split_db, stage_split_db_indexed))
+
+
+def main(argv):
+    name, data_dir, grid = argv[1], argv[2], int(argv[3])
+
+    # importing the package is not part of the measurements
+    import platypus.commands  # noqa
+    measure, input_bytes, items = STAGES[name](data_dir, grid)
+    print(dumps({'stage': name, 'wall': measure.wall, 'cpu': measure.cpu,
+                 'peak_rss': measure.peak_rss,
+                 'setup_rss': measure.rss_before,
+                 'input_bytes': input_bytes, 'items': items}))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
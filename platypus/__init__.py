@@ -8,4 +8,5 @@
 
 __version__ = "0.9.0-dev"
 
-__all__ = ['commands', 'compare', 'parse']
+__all__ = ['cache', 'commands', 'compare', 'fasta', 'parse', 'state',
+           'stats', 'taxonomy', 'util']
@@ -0,0 +1,252 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import division
+
+import re
+from hashlib import sha1
+from json import dumps, loads
+from mmap import mmap, ACCESS_READ
+from os import fdopen, listdir, remove, rename, stat, utime
+from os.path import abspath, dirname, getsize, isdir, isfile, join
+from stat import S_ISREG
+from tempfile import mkstemp
+
+import numpy as np
+
+from platypus.compare import PlatypusParseError
+from platypus.util import create_dir
+
+# identifies the files written by write_arrays, the number is the version of
+# the layout and needs to be changed if the layout ever changes
+MAGIC = 'PLATYPUS-ARRAYS-1\n'
+
+# every array starts at a multiple of this number of bytes
+_ALIGNMENT = 64
+
+# default maximum size of a cache directory, in bytes
+CACHE_SIZE = 10 * 1024 ** 3
+
+# names of the files written by cache_path, the sha1 of the key and the kind
+_CACHE_NAME = re.compile(r'^[0-9a-f]{40}\.[a-z0-9]+$')
+
+
+def _descr(dtype):
+    """Describe a dtype so it can be serialized as JSON"""
+    return dtype.str if dtype.names is None else dtype.descr
+
+
+def _dtype(descr):
+    """Build a dtype from its description after a round trip through JSON"""
+    if isinstance(descr, list):
+        return np.dtype([tuple(_dtype(d) if isinstance(d, list) else str(d)
+                               for d in field) for field in descr])
+    return np.dtype(str(descr))
+
+
+def write_arrays(fp, arrays, metadata=None):
+    """Write arrays to a file that can be memory mapped with read_arrays
+
+    Parameters
+    ----------
+    fp : str
+        Path of the file to write. The file is written under a temporary name
+        and renamed when complete, so readers never see a partial file.
+    arrays : dict of np.ndarray
+        Arrays to write, keyed by name. Object arrays are not supported.
+    metadata : dict, optional
+        JSON serializable information stored along with the arrays.
+    """
+    arrays = {name: np.ascontiguousarray(array)
+              for name, array in arrays.items()}
+
+    layout, position = {}, 0
+    for name, array in sorted(arrays.items()):
+        layout[name] = {'descr': _descr(array.dtype), 'shape': array.shape,
+                        'offset': position}
+        position += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+    header = dumps({'metadata': metadata or {}, 'arrays': layout}) + '\n'
+
+    # the data starts at the first aligned position after the header
+    start = -(-(len(MAGIC) + len(header)) // _ALIGNMENT) * _ALIGNMENT
+
+    fd, tmp_fp = mkstemp(dir=dirname(abspath(fp)), suffix='.tmp')
+    complete = False
+    try:
+        with fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(header)
+            for name, array in sorted(arrays.items()):
+                f.seek(start + layout[name]['offset'])
+                f.write(array.data)
+            f.truncate(start + position)
+        rename(tmp_fp, fp)
+        complete = True
+    finally:
+        if not complete and isfile(tmp_fp):
+            remove(tmp_fp)
+
+
+def read_arrays(fp):
+    """Memory map the arrays written with write_arrays
+
+    Parameters
+    ----------
+    fp : str
+        Path to the file.
+
+    Returns
+    -------
+    dict of np.ndarray
+        The read-only arrays, keyed by name.
+    dict
+        The metadata stored with the arrays.
+
+    Raises
+    ------
+    PlatypusParseError
+        If the file was not written by write_arrays or it's truncated.
+    """
+    with open(fp, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise PlatypusParseError("%s is not a platypus arrays file" % fp)
+        try:
+            header = loads(f.readline())
+        except ValueError:
+            raise PlatypusParseError("The header of %s is corrupted" % fp)
+        start = -(-f.tell() // _ALIGNMENT) * _ALIGNMENT
+
+        size = getsize(fp)
+        buf = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        dtype = _dtype(layout['descr'])
+        count = int(np.prod(layout['shape']))
+        offset = start + layout['offset']
+        if offset + count * dtype.itemsize > size:
+            raise PlatypusParseError("%s is truncated" % fp)
+
+        arrays[str(name)] = np.frombuffer(
+            buf, dtype=dtype, count=count,
+            offset=offset).reshape(layout['shape'])
+    return arrays, header['metadata']
+
+
+def cache_path(fp, cache_dir, kind):
+    """Name of the cache file for the current contents of fp
+
+    Parameters
+    ----------
+    fp : str
+        Path to the file whose parsed contents are cached.
+    cache_dir : str
+        Directory where the cache files are stored.
+    kind : str
+        Name of the type of contents, used as the extension of the file.
+
+    Returns
+    -------
+    str or None
+        Path to the cache file, None if fp is not a regular file (for
+        example a pipe) and can't be cached.
+
+    Notes
+    -----
+    The name depends on the absolute path, the size and the modification
+    time of fp, so any change to the file leads to a different cache file
+    and the stale one is eventually removed by evict.
+    """
+    try:
+        info = stat(fp)
+    except (OSError, TypeError):
+        return None
+    if not S_ISREG(info.st_mode):
+        return None
+
+    key = '\0'.join([MAGIC, kind, abspath(fp), str(info.st_size),
+                     repr(info.st_mtime)])
+    return join(cache_dir, '%s.%s' % (sha1(key).hexdigest(), kind))
+
+
+def touch(fp):
+    """Mark a cache file as recently used"""
+    try:
+        utime(fp, None)
+    except OSError:
+        pass
+
+
+def evict(cache_dir, max_size=CACHE_SIZE, keep=()):
+    """Remove the least recently used files until the directory fits
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory where the cache files are stored, nothing is removed if it
+        doesn't exist.
+    max_size : int, optional
+        Maximum total size in bytes of the files in the directory.
+    keep : iterable of str, optional
+        Paths of the files that should not be removed, None values are
+        ignored.
+
+    Returns
+    -------
+    list of str
+        The paths of the removed files.
+
+    Notes
+    -----
+    Only the files named by cache_path and written by write_arrays are
+    counted and removed, any other file in the directory is left alone.
+    Files still being written have a temporary name and are never removed.
+    """
+    if not isdir(cache_dir):
+        return []
+
+    keep = {abspath(k) for k in keep if k is not None}
+    files = []
+    for name in listdir(cache_dir):
+        if not _CACHE_NAME.match(name):
+            continue
+        fp = join(cache_dir, name)
+        try:
+            info = stat(fp)
+        except OSError:
+            continue
+        if S_ISREG(info.st_mode) and _is_arrays_file(fp):
+            files.append((info.st_mtime, info.st_size, fp))
+
+    total = sum(size for _, size, _ in files)
+    removed = []
+    for _, size, fp in sorted(files):
+        if total <= max_size:
+            break
+        if abspath(fp) in keep:
+            continue
+        try:
+            remove(fp)
+        except OSError:
+            continue
+        total -= size
+        removed.append(fp)
+    return removed
+
+
+def _is_arrays_file(fp):
+    """Whether the file starts as the files written by write_arrays"""
+    try:
+        with open(fp, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+def create_cache_dir(cache_dir):
+    """Create the cache directory if it doesn't exist"""
+    create_dir(cache_dir)
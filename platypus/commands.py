@@ -7,29 +7,57 @@
 # ----------------------------------------------------------------------------
 from __future__ import division
 
-from os.path import join, basename
+import re
+import sys
+from collections import Mapping, OrderedDict
+from multiprocessing import Pool
+from os.path import abspath, dirname, join, basename, getsize
 
 from click import BadParameter
-from skbio.util import create_dir
-from skbio import read
 
+from platypus.cache import CACHE_SIZE, cache_path, evict
 from platypus.compare import (
-    sequences_from_query, PlatypusParseError, PlatypusValueError)
-from platypus.parse import (parse_first_database, parse_second_database,
-                            process_results)
+    sequences_from_query, sequences_from_queries, PlatypusError,
+    PlatypusParseError, PlatypusValueError)
+from platypus.fasta import (BLOCK_SIZE, MAX_OPEN, OutputFiles, fasta_index,
+                            route_fasta, split_fasta_indexed,
+                            split_fasta_parallel)
+from platypus.parse import (CONSOLIDATED_INDEX_FN, GROUP_MEMORY,
+                            parse_first_database,
+                            parse_second_database, process_results,
+                            read_consolidated, MergedDatabases)
+from platypus.state import CompareState, CompareSummary
+from platypus.stats import REPORT_FN, Stats
+from platypus.taxonomy import taxonomy_index
+from platypus.util import create_dir, is_stream, open_input, spool
+
+# table of compare_batch with the counts of compile_output.txt of every
+# sample, and its columns after the sample and the combination
+COLLATED_FN = 'collated_output.txt'
+COLLATED_COLUMNS = ('interest db', 'other db', 'only interest', 'both dbs',
+                    'no hits in interest db')
 
 
 def compare(interest_fp, other_fp, output_dir='blast-results-compare',
             interest_pcts=None, interest_alg_lens=None, other_pcts=None,
-            other_alg_lens=None, hits_to_first=False, hits_to_second=False):
+            other_alg_lens=None, hits_to_first=False, hits_to_second=False,
+            cache_dir=None, cache_size=CACHE_SIZE, streaming=False, jobs=1,
+            report=False, progress=None, hit_counts=False,
+            consolidated=False, compress=False, counts_only=False,
+            unordered=False, group_memory=GROUP_MEMORY, state_dir=None,
+            partial_fp=None):
     """Compare two databases and write the outputs
 
     Parameters
     ----------
     interest_fp : str
-        BLAST results when searching against the database of interest.
+        BLAST results when searching against the database of interest. The
+        file can be gzip, bz2 or xz compressed. It can also be a named pipe
+        or `-` for the standard input, so the results are compared while
+        the search writes them.
     other_fp : str
-        BLAST results when searching against the other database.
+        BLAST results when searching against the other database. The file
+        can be gzip, bz2 or xz compressed, a named pipe or `-`.
     output_dir : str, optional
         Name of the output file path.
     interest_pcts : list, optional
@@ -54,6 +82,61 @@ def compare(interest_fp, other_fp, output_dir='blast-results-compare',
     hits_to_second : bool, optional defaults to False
         Outputs all the labels of the sequences being hit in the second
         database.
+    cache_dir : str, optional
+        Directory where the parsed search results are cached, so later
+        comparisons of the same files don't need to parse them again. If None
+        is passed, nothing is cached.
+    cache_size : int, optional
+        Maximum size in bytes of `cache_dir`, the least recently used files
+        are removed once the comparison is done.
+    streaming : bool, optional
+        Read both files side by side keeping only a few queries in memory at
+        a time. Both files have to be sorted by query identifier, see
+        `platypus.parse.MergedDatabases`.
+    jobs : int, optional
+        Number of processes used to parse each file. The outputs are the same
+        regardless of the number of processes.
+    report : bool, optional
+        Write the time, counters and memory of each stage as JSON to
+        `platypus_report.json` in `output_dir`, see `platypus.stats.Stats`.
+    progress : float, optional
+        Seconds between the progress lines written to the standard error, if
+        None is passed no progress is written.
+    hit_counts : bool, optional
+        With `hits_to_first` or `hits_to_second`, write the number of hits
+        to each sequence of the databases instead of one line per hit, see
+        `platypus.parse.SubjectCounts`.
+    consolidated : bool, optional
+        Write the summaries and the hits of all the combinations of
+        thresholds to a single table with an index, instead of a set of files
+        per combination. `compile_output.txt` is written as usual. See
+        `platypus.parse.ConsolidatedOutput`.
+    compress : bool, optional
+        With `consolidated`, compress the table with gzip.
+    counts_only : bool, optional
+        Only write `compile_output.txt` and `compile_output_no_nohits.txt`,
+        the queries are counted without writing a line per query.
+        `hits_to_first`, `hits_to_second` and `consolidated` are ignored.
+    unordered : bool, optional
+        The hits of a query can be anywhere in the files instead of one
+        after the other, for example when the outputs of several searches
+        are merged. See `platypus.parse.group_records`.
+    group_memory : int, optional
+        With `unordered`, bytes of hits kept in memory while they are
+        grouped, the rest are written to temporary files.
+    state_dir : str, optional
+        Directory with the state of the previous batches compared with the
+        same thresholds, see `platypus.state.CompareState`. The results of
+        `interest_fp` and `other_fp` are added to it as a new batch.
+        `compile_output.txt`, `compile_output_no_nohits.txt` and, with
+        `hit_counts`, the hit count tables then cover all the batches added
+        so far, the other outputs only the queries of this batch.
+    partial_fp : str, optional
+        Also write the counts of `compile_output.txt` to this file, so the
+        comparisons of several shards of the queries can be combined with
+        merge. With `hit_counts`, it has the subject tallies to write the
+        hit count tables too, except in `streaming` mode. See
+        `platypus.state.CompareSummary`.
 
     Raises
     ------
@@ -62,6 +145,24 @@ def compare(interest_fp, other_fp, output_dir='blast-results-compare',
         length.
         If the `interest_alg_lens` and the `other_alg_lens` lists are of
         different length.
+        If `streaming` is True and the files are not sorted by query.
+        If both `interest_fp` and `other_fp` are the standard input.
+        If both `streaming` and `unordered` are True.
+        If `state_dir` is used with `streaming`, its thresholds are not the
+        ones passed or the files were already added to it.
+
+    Returns
+    -------
+    list of list of str
+        The rows of `compile_output.txt`, the first one has the names of the
+        combinations of thresholds.
+
+    Notes
+    -----
+    Pipes are read once, in order, so they are never cached or split among
+    `jobs`. Without `streaming`, the other database is copied to a
+    temporary file while the first one is parsed, so both searches can
+    write their results at the same time, see `platypus.util.spool`.
     """
 
     if interest_pcts is None:
@@ -69,11 +170,22 @@ def compare(interest_fp, other_fp, output_dir='blast-results-compare',
     if interest_alg_lens is None:
         interest_alg_lens = [50]
 
-    db_a = open(interest_fp, 'U')
-    db_b = open(other_fp, 'U')
+    if streaming and unordered:
+        raise BadParameter("Unordered files can't be compared in streaming "
+                           "mode, it needs the files sorted by query.")
+    if streaming and state_dir is not None:
+        raise BadParameter("The state of the previous batches can't be "
+                           "updated in streaming mode.")
+    if interest_fp == '-' and other_fp == '-':
+        raise BadParameter("Only one of the databases can be read from the "
+                           "standard input.")
+    db_a = open_input(interest_fp)
+    db_b = open_input(other_fp)
+    if not streaming and is_stream(other_fp):
+        db_b = spool(db_b)
 
     # try to create the output directory, if it exists, just continue
-    create_dir(output_dir, False)
+    create_dir(output_dir)
 
     # run some validations on the input parameters
     if other_pcts:
@@ -92,25 +204,137 @@ def compare(interest_fp, other_fp, output_dir='blast-results-compare',
     else:
         other_alg_lens = interest_alg_lens
 
+    state = None
+    if state_dir is not None:
+        try:
+            state = CompareState(state_dir, interest_pcts, interest_alg_lens,
+                                 other_pcts, other_alg_lens)
+        except (PlatypusParseError, PlatypusValueError), e:
+            raise BadParameter(str(e))
+        if state.added(interest_fp, other_fp):
+            raise BadParameter("%s and %s were already added to %s." %
+                               (interest_fp, other_fp, state_dir))
+
+    stats = Stats(progress)
+
     # process databases
-    total_queries, best_hits = parse_first_database(db_a, interest_pcts,
-                                                    interest_alg_lens)
-    parse_second_database(db_b, best_hits, other_pcts,
-                          other_alg_lens)
+    if streaming:
+        best_hits = MergedDatabases(db_a, db_b, interest_pcts,
+                                    interest_alg_lens, other_pcts,
+                                    other_alg_lens, columnar=True,
+                                    cache_dir=cache_dir, jobs=jobs,
+                                    stats=stats)
+    else:
+        with stats.stage('parse_first_database', [db_a]):
+            total_queries, best_hits = parse_first_database(
+                db_a, interest_pcts, interest_alg_lens, columnar=True,
+                cache_dir=cache_dir, jobs=jobs, stats=stats,
+                unordered=unordered, group_memory=group_memory)
+        with stats.stage('parse_second_database', [db_b]):
+            parse_second_database(db_b, best_hits, other_pcts,
+                                  other_alg_lens, columnar=True,
+                                  cache_dir=cache_dir, jobs=jobs, stats=stats,
+                                  unordered=unordered,
+                                  group_memory=group_memory)
+
+    if state is not None:
+        with stats.stage('update_state'):
+            best_hits = state.add_batch(best_hits, total_queries,
+                                        interest_fp, other_fp)
+
+    # parse results, when streaming the databases are parsed at the same time
+    with stats.stage('process_results',
+                     [db_a, db_b] if streaming else []) as stage:
+        try:
+            # the hit count tables of a state are written from its tallies
+            tables = state is not None and hit_counts
+            results = process_results(interest_pcts, interest_alg_lens,
+                                      other_pcts, other_alg_lens, best_hits,
+                                      output_dir, hits_to_first and not tables,
+                                      hits_to_second and not tables,
+                                      hit_counts, consolidated, compress,
+                                      counts_only)
+        except PlatypusParseError, e:
+            raise BadParameter(e.message)
+
+    written = set()
+    counts = results
+    if streaming:
+        total_queries = best_hits.total_queries
+    if state is not None:
+        counts, total_queries = state.results(), state.total_queries
+        if hit_counts:
+            written.update(state.write_hit_counts(output_dir, hits_to_first,
+                                                  hits_to_second))
+
+    if partial_fp is not None:
+        with stats.stage('write_partial'):
+            if state is not None:
+                partial = state
+            else:
+                partial = CompareSummary(interest_pcts, interest_alg_lens,
+                                         other_pcts, other_alg_lens,
+                                         hit_counts)
+                partial.sources = {'interest': [basename(interest_fp)],
+                                   'other': [basename(other_fp)]}
+                if streaming:
+                    partial.add_results(results, total_queries)
+                else:
+                    partial.add(best_hits, total_queries)
+            partial.write(partial_fp)
+
+    if cache_dir is not None:
+        evict(cache_dir, cache_size,
+              keep=[cache_path(fp, cache_dir, 'm9')
+                    for fp in (interest_fp, other_fp)])
+
+    combined_results = _write_compiled(output_dir, counts, total_queries,
+                                       basename(interest_fp),
+                                       basename(other_fp))
+    written.update([join(output_dir, "compile_output.txt"),
+                    join(output_dir, "compile_output_no_nohits.txt")])
+    for item in results:
+        if item['summary_fh']:
+            written.add(item['summary_fh'].name)
+        written.update(fh.name for fh in item['db_seqs_counts'].values()
+                       if fh)
+    if consolidated and not counts_only:
+        written.add(join(output_dir, CONSOLIDATED_INDEX_FN))
+    stage.add('bytes_written', sum(getsize(fp) for fp in written))
+
+    if report:
+        stats.write(join(output_dir, REPORT_FN))
+    return combined_results
+
 
-    # parse results
-    results = process_results(interest_pcts, interest_alg_lens,
-                              other_pcts, other_alg_lens, best_hits,
-                              output_dir, hits_to_first, hits_to_second)
+def _write_compiled(output_dir, counts, total_queries, interest_name,
+                    other_name):
+    """Write compile_output.txt and compile_output_no_nohits.txt
 
+    Parameters
+    ----------
+    output_dir : str
+        Directory where the files are written.
+    counts : list of dict
+        The counts of each combination of thresholds, as the results of
+        process_results.
+    total_queries : int
+        Number of queries compared.
+    interest_name, other_name : str
+        Names of the search results shown in the header of the rows.
+
+    Returns
+    -------
+    list of list of str
+        The rows of `compile_output.txt`.
+    """
     # Collating output and writing full results
-    for i, item in enumerate(results):
+    for i, item in enumerate(counts):
         if i == 0:
             combined_results = []
             combined_results.append(['filename'])
-            combined_results.append(['interest db (%s)' %
-                                     basename(interest_fp)])
-            combined_results.append(['other db (%s)' % basename(other_fp)])
+            combined_results.append(['interest db (%s)' % interest_name])
+            combined_results.append(['other db (%s)' % other_name])
             combined_results.append(['only interest'])
             combined_results.append(['both dbs'])
             combined_results.append(['no hits in interest db'])
@@ -134,9 +358,270 @@ def compare(interest_fp, other_fp, output_dir='blast-results-compare',
     with open(fn, 'w') as fd:
         fd.write('\n'.join(['\t'.join(item)
                             for item in combined_results[:-1]]))
+    return combined_results
+
+
+def merge(partial_fps, output_dir, hits_to_first=False,
+          hits_to_second=False):
+    """Combine the partial files of the shards of a comparison
+
+    Parameters
+    ----------
+    partial_fps : list of str
+        The files written by compare with `partial_fp`, each for a different
+        shard of the queries compared with the same thresholds.
+    output_dir : str
+        Directory where `compile_output.txt` and
+        `compile_output_no_nohits.txt` are written.
+    hits_to_first, hits_to_second : bool, optional
+        Also write the hit count tables of the first and second databases.
+        The partial files need the subject tallies, see compare.
+
+    Returns
+    -------
+    list of list of str
+        The rows of `compile_output.txt`.
+
+    Raises
+    ------
+    BadParameter
+        If no files are passed or they are not partial files.
+        If the files were compared with different thresholds.
+        If the hit count tables are requested and a file has no tallies.
+
+    Notes
+    -----
+    The outputs are the same as comparing all the shards at once, as long
+    as each query is in a single shard. The names of the search results in
+    `compile_output.txt` are the ones of the shards, joined by commas when
+    they are not all the same.
+    """
+    if not partial_fps:
+        raise BadParameter('There are no partial files to merge!')
+
+    summary = None
+    for fp in partial_fps:
+        try:
+            partial = CompareSummary.read(fp)
+            if summary is None:
+                summary = partial
+            else:
+                summary.update(partial)
+        except (PlatypusParseError, PlatypusValueError, EnvironmentError), e:
+            raise BadParameter(str(e))
+    if summary.tallies is None and (hits_to_first or hits_to_second):
+        raise BadParameter("The hit count tables can't be written, some of "
+                           "the partial files don't have the subject "
+                           "tallies.")
+
+    create_dir(output_dir)
+    names = {db: ','.join(OrderedDict.fromkeys(summary.sources[db]))
+             for db in summary.sources}
+    combined_results = _write_compiled(output_dir, summary.results(),
+                                       summary.total_queries,
+                                       names['interest'], names['other'])
+    summary.write_hit_counts(output_dir, hits_to_first, hits_to_second)
+    return combined_results
+
+
+def read_manifest(fp):
+    """Read the samples of compare_batch from a manifest
+
+    Parameters
+    ----------
+    fp : str
+        Tab-delimited file, each line has the name of a sample and the
+        paths of its search results against the database of interest and
+        against the other database. Relative paths are relative to the
+        directory of the manifest. Empty lines and lines that start with #
+        are ignored.
+
+    Returns
+    -------
+    OrderedDict
+        The paths of the results of each sample, keyed by sample, in the
+        order of the file.
+
+    Raises
+    ------
+    BadParameter
+        If a line doesn't have three columns or a sample is repeated.
+        If a sample name can't be a directory name or a path is `-`.
+        If the manifest has no samples.
+    """
+    samples = OrderedDict()
+    base = dirname(abspath(fp))
+    with open_input(fp) as f:
+        for i, line in enumerate(f):
+            if not line.strip() or line.startswith('#'):
+                continue
+            parts = [part.strip() for part in
+                     line.rstrip('\r\n').split('\t')]
+            if len(parts) != 3 or not all(parts):
+                raise BadParameter("Line %d of %s doesn't have a sample and "
+                                   "two search results" % (i + 1, fp))
+            sample, interest_fp, other_fp = parts
+            if sample in samples:
+                raise BadParameter("The sample %s is repeated in %s" %
+                                   (sample, fp))
+            if '/' in sample or sample in ('.', '..'):
+                raise BadParameter("The sample %s in %s can't be used as the "
+                                   "name of a directory" % (sample, fp))
+            if '-' in (interest_fp, other_fp):
+                raise BadParameter("The samples of %s can't be read from the "
+                                   "standard input" % fp)
+            samples[sample] = (join(base, interest_fp), join(base, other_fp))
+
+    if not samples:
+        raise BadParameter('The manifest is empty!')
+    return samples
+
+
+def compare_batch(manifest_fp, output_dir, interest_pcts=None,
+                  interest_alg_lens=None, other_pcts=None,
+                  other_alg_lens=None, hits_to_first=False,
+                  hits_to_second=False, jobs=1, report=False,
+                  hit_counts=False, consolidated=False, compress=False,
+                  counts_only=False, unordered=False,
+                  group_memory=GROUP_MEMORY):
+    """Compare the databases of several samples with the same thresholds
+
+    Parameters
+    ----------
+    manifest_fp : str
+        Manifest with the name of each sample and its search results, see
+        read_manifest.
+    output_dir : str
+        Directory where the outputs are written. The outputs of each sample
+        are written by compare to a directory named after the sample, and
+        the counts of all the samples to `collated_output.txt`.
+    interest_pcts, interest_alg_lens, other_pcts, other_alg_lens : list
+        The thresholds of all the samples, see compare.
+    hits_to_first, hits_to_second : bool, optional
+        Write the hits to each database of each sample, see compare.
+    jobs : int, optional
+        Number of samples compared at the same time, each by its own
+        process.
+    report : bool, optional
+        Write the report of each sample to its directory, see compare.
+    hit_counts, consolidated, compress, counts_only : bool, optional
+        The outputs of each sample, see compare.
+    unordered : bool, optional
+        The hits of a query can be anywhere in the files, see compare.
+    group_memory : int, optional
+        With `unordered`, bytes of hits kept in memory by each process.
+
+    Returns
+    -------
+    OrderedDict
+        The rows of the `compile_output.txt` of each sample, keyed by the
+        samples that were compared.
+
+    Raises
+    ------
+    BadParameter
+        If the manifest is not valid.
+        If some of the samples can't be compared. The rest of the samples
+        are compared and written to `collated_output.txt` first.
+
+    Notes
+    -----
+    `collated_output.txt` has a line per sample and combination of
+    thresholds with the counts of `compile_output.txt`, in the order of the
+    manifest. The processes are started once and compare a sample after
+    another, so the cost of starting the interpreter and importing the
+    package is paid once per process instead of once per sample.
+    """
+    samples = read_manifest(manifest_fp)
+    create_dir(output_dir)
+
+    options = dict(interest_pcts=interest_pcts,
+                   interest_alg_lens=interest_alg_lens, other_pcts=other_pcts,
+                   other_alg_lens=other_alg_lens, hits_to_first=hits_to_first,
+                   hits_to_second=hits_to_second, report=report,
+                   hit_counts=hit_counts, consolidated=consolidated,
+                   compress=compress, counts_only=counts_only,
+                   unordered=unordered, group_memory=group_memory)
+    tasks = [(sample, interest_fp, other_fp, join(output_dir, sample),
+              options) for sample, (interest_fp, other_fp) in
+             samples.items()]
+
+    if jobs == 1:
+        outcomes = [_compare_sample(task) for task in tasks]
+    else:
+        pool = Pool(min(jobs, len(tasks)))
+        try:
+            outcomes = pool.map(_compare_sample, tasks, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    compiled, failed = OrderedDict(), []
+    for sample, rows, error in outcomes:
+        if error is None:
+            compiled[sample] = rows
+        else:
+            failed.append('%s (%s)' % (sample, error))
+
+    with open(join(output_dir, COLLATED_FN), 'w') as f:
+        f.write('#Sample\tCombination\t%s\n' % '\t'.join(COLLATED_COLUMNS))
+        for sample, rows in compiled.items():
+            for i, combination in enumerate(rows[0][1:], 1):
+                f.write('%s\t%s\t%s\n' % (sample, combination, '\t'.join(
+                    row[i] for row in rows[1:])))
+
+    if failed:
+        raise BadParameter("Some of the samples couldn't be compared: %s" %
+                           '; '.join(failed))
+    return compiled
+
+
+def _compare_sample(task):
+    """Helper of compare_batch that compares the results of a sample"""
+    sample, interest_fp, other_fp, output_dir, options = task
+    try:
+        rows = compare(interest_fp, other_fp, output_dir, **options)
+    except (BadParameter, PlatypusError, EnvironmentError, ValueError), e:
+        return sample, None, e.message if isinstance(e, BadParameter) else \
+            str(e)
+    return sample, rows, None
+
+
+def extract(output_dir, combination, output, output_fp=None):
+    """Write an output of a combination of thresholds of a consolidated table
+
+    Parameters
+    ----------
+    output_dir : str
+        Output directory of a comparison with `consolidated`.
+    combination : str
+        Name or position of the combination of thresholds, for example
+        `p1_70-a1_50_p2_70-a2_50` or `0`.
+    output : str
+        Name of the output, for example `summary` or `hits_to_first_db`.
+    output_fp : str, optional
+        File where the output is written. If None is passed, it's written to
+        the standard output.
+
+    Raises
+    ------
+    click.BadParameter
+        If the output of the combination is not in the table.
+    """
+    try:
+        lines = read_consolidated(output_dir, combination, output)
+    except (IOError, PlatypusValueError), e:
+        raise BadParameter(str(e))
+
+    if output_fp is None:
+        sys.stdout.writelines(lines)
+    else:
+        with open(output_fp, 'w') as f:
+            f.writelines(lines)
 
 
-def split_db(tax_fp, seqs_fp, query, output_fp, split_fp):
+def split_db(tax_fp, seqs_fp, query, output_fp, split_fp, report=False,
+             progress=None, cache_dir=None, cache_size=CACHE_SIZE, jobs=1):
     """Split a database in parts that match a query and parts that don't
 
     Parameters
@@ -148,6 +633,9 @@ def split_db(tax_fp, seqs_fp, query, output_fp, split_fp):
     seqs_fp : str
         Path to a FASTA formatted file to split in interest and rest. Note:
         sequence identifiers must match the ones in the taxonomy file.
+        This file, as well as tax_fp and split_fp, can be gzip, bz2 or xz
+        compressed. The records are copied to the outputs as they are, see
+        `platypus.fasta.split_fasta`.
     query : str
         The query used to split the database, for example: salmonella. The
         query should be an exact match, no wild cards, it can have spaces, and
@@ -157,46 +645,266 @@ def split_db(tax_fp, seqs_fp, query, output_fp, split_fp):
     split_fp : str
         The tab delimited query file, where each line is a different sequence
         and the first column is the sequence id.
+    report : bool, optional
+        Write the time, counters and memory of each stage as JSON to
+        `platypus_report.json` in `output_fp`, see `platypus.stats.Stats`.
+    progress : float, optional
+        Seconds between the progress lines written to the standard error, if
+        None is passed no progress is written.
+    cache_dir : str, optional
+        Directory where the indexes of tax_fp and seqs_fp are cached, so
+        later queries against the same taxonomy don't read it again, see
+        `platypus.taxonomy.taxonomy_index`, and the sequences of interest
+        are read directly from seqs_fp, see `platypus.fasta.fasta_index`. If
+        None is passed, nothing is cached.
+    cache_size : int, optional
+        Maximum size in bytes of `cache_dir`, the least recently used files
+        are removed.
+    jobs : int, optional
+        Number of processes used to split seqs_fp when it's not indexed, see
+        `platypus.fasta.split_fasta_parallel`. The outputs are the same
+        regardless of the number of processes.
 
     Raises
     ------
     BadParameter
         If the Taxonomy file is empty.
         If the query you passed retrieved no results.
+        If seqs_fp is not FASTA formatted.
     """
+    stats = Stats(progress)
 
     if query is not None:
         # query the taxonomy file for the required sequence identifiers
-        try:
-            interest_taxonomy = sequences_from_query(open(tax_fp, 'U'),
-                                                     query)
-        except (PlatypusValueError, PlatypusParseError), e:
-            raise BadParameter(e.message)
+        tax = open_input(tax_fp) if cache_dir is None else None
+        inputs = [tax] if tax is not None else []
+        with stats.stage('select_sequences', inputs) as stage:
+            try:
+                if tax is None:
+                    index = taxonomy_index(tax_fp, cache_dir)
+                    interest_taxonomy = index.sequences_from_query(query)
+                else:
+                    interest_taxonomy = sequences_from_query(tax, query)
+            except (PlatypusValueError, PlatypusParseError), e:
+                raise BadParameter(e.message)
 
         if len(interest_taxonomy) == 0:
             raise BadParameter('The query could not retrieve any results, try '
                                'a different one.')
     else:
-        interest_taxonomy = {l.strip().split('\t')[0].strip(): ''
-                             for l in open(split_fp, 'U')}
+        split = open_input(split_fp)
+        with stats.stage('select_sequences', [split]) as stage:
+            interest_taxonomy = {l.strip().split('\t')[0].strip(): ''
+                                 for l in split}
         if not interest_taxonomy:
             raise BadParameter('The split_fp is empty!')
+    stage.add('selected', len(interest_taxonomy))
+
+    create_dir(output_fp)
 
-    create_dir(output_fp, False)
+    index = None
+    if cache_dir is not None:
+        with stats.stage('index_sequences'):
+            try:
+                index = fasta_index(seqs_fp, cache_dir)
+            except PlatypusParseError, e:
+                raise BadParameter(e.message)
 
-    interest_fp = open(join(output_fp, 'interest.fna'), 'w')
-    rest_fp = open(join(output_fp, 'rest.fna'), 'w')
+    interest_fp = open(join(output_fp, 'interest.fna'), 'w', BLOCK_SIZE)
+    rest_fp = open(join(output_fp, 'rest.fna'), 'w', BLOCK_SIZE)
 
-    for record in read(seqs_fp, format='fasta'):
-        full_name = record.id
-        seq = record.sequence
+    seqs = open_input(seqs_fp) if index is None else None
+    inputs = [seqs] if seqs is not None else []
+    with stats.stage('split_sequences', inputs) as stage:
+        try:
+            if index is None:
+                split_fasta_parallel(seqs, interest_taxonomy, interest_fp,
+                                     rest_fp, jobs, stats=stats)
+            else:
+                split_fasta_indexed(seqs_fp, index, interest_taxonomy,
+                                    interest_fp, rest_fp, stats=stats)
+        except PlatypusParseError, e:
+            raise BadParameter(e.message)
+        finally:
+            interest_fp.close()
+            rest_fp.close()
+    stage.add('bytes_written', getsize(interest_fp.name) +
+              getsize(rest_fp.name))
+    _evict_indexes(cache_dir, cache_size, tax_fp, seqs_fp)
 
-        name = full_name.strip().split(' ')[0].strip()
+    if report:
+        stats.write(join(output_fp, REPORT_FN))
 
-        if name in interest_taxonomy:
-            interest_fp.write(">%s\n%s\n" % (full_name, seq))
-        else:
-            rest_fp.write(">%s\n%s\n" % (full_name, seq))
 
-    interest_fp.close()
-    rest_fp.close()
+def _evict_indexes(cache_dir, cache_size, tax_fp, seqs_fp):
+    """Limit the size of the cache, keeping the indexes of the inputs"""
+    if cache_dir is not None:
+        evict(cache_dir, cache_size,
+              keep=[cache_path(tax_fp, cache_dir, 'taxonomy'),
+                    cache_path(seqs_fp, cache_dir, 'fasta')])
+
+
+def read_queries(fp):
+    """Read the queries of split_db_multi from a file
+
+    Parameters
+    ----------
+    fp : str
+        Tab-delimited file, each line has a query and optionally the name of
+        its output. The file can be gzip, bz2 or xz compressed.
+
+    Returns
+    -------
+    OrderedDict
+        The queries keyed by the name of their output, in the order of the
+        file. Queries without a name are named after the query.
+
+    Raises
+    ------
+    BadParameter
+        If the file is empty or has more than two columns.
+        If two queries have the same name.
+    """
+    queries = OrderedDict()
+    for i, line in enumerate(open_input(fp)):
+        if not line.strip():
+            continue
+        parts = [part.strip() for part in line.rstrip('\r\n').split('\t')]
+        if len(parts) > 2:
+            raise BadParameter("Line %d of %s has more than two columns" %
+                               (i + 1, fp))
+        query = parts[0]
+        name = parts[1] if len(parts) == 2 and parts[1] else output_name(query)
+        if name in queries:
+            raise BadParameter("The output name %s is repeated in %s" %
+                               (name, fp))
+        queries[name] = query
+
+    if not queries:
+        raise BadParameter('The queries file is empty!')
+    return queries
+
+
+def output_name(query):
+    """Name of the output of a query in split_db_multi"""
+    return re.sub(r'[^\w.-]+', '_', query).strip('_') or 'query'
+
+
+def split_db_multi(tax_fp, seqs_fp, queries, output_fp, max_open=MAX_OPEN,
+                   report=False, progress=None, cache_dir=None,
+                   cache_size=CACHE_SIZE):
+    """Split a database in one part per query in a single pass
+
+    Parameters
+    ----------
+    tax_fp : str
+        Tab-delimited file with two columns, name/identifier of the sequence
+        and the taxonomy, see split_db.
+    seqs_fp : str
+        Path to a FASTA formatted file to split, see split_db.
+    queries : list of str or dict of str
+        The queries used to split the database, or the queries keyed by the
+        name of their output, see read_queries. Like in split_db, the queries
+        are case insensitive and match any part of the taxonomy.
+    output_fp : str
+        Output folder path where the results are stored. Each query writes
+        the sequences it matches to `<name>.fna`, and the sequences that
+        match no query are written to `rest.fna`.
+    max_open : int, optional
+        Maximum number of output files open at the same time.
+    report : bool, optional
+        Write the time, counters and memory of each stage as JSON to
+        `platypus_report.json` in `output_fp`, see `platypus.stats.Stats`.
+    progress : float, optional
+        Seconds between the progress lines written to the standard error, if
+        None is passed no progress is written.
+    cache_dir : str, optional
+        Directory where an index of tax_fp is cached, see split_db.
+    cache_size : int, optional
+        Maximum size in bytes of `cache_dir`.
+
+    Returns
+    -------
+    dict of int
+        Number of sequences written to each of the outputs, keyed by name.
+
+    Raises
+    ------
+    BadParameter
+        If two queries have the same name or a query is named rest.
+        If the queries retrieved no results.
+        If the taxonomy file is not valid or seqs_fp is not FASTA formatted.
+
+    Notes
+    -----
+    A sequence that matches several queries is written to all their
+    outputs. The taxonomy and the sequences are read once regardless of the
+    number of queries.
+    """
+    if not isinstance(queries, Mapping):
+        named = OrderedDict()
+        for query in queries:
+            fn = output_name(query)
+            if fn in named:
+                raise BadParameter("The output name %s is repeated" % fn)
+            named[fn] = query
+        queries = named
+    if 'rest' in queries:
+        raise BadParameter("rest can't be used as the name of a query, it's "
+                           "the output of the sequences that match no query")
+    names = list(queries)
+
+    stats = Stats(progress)
+
+    tax = open_input(tax_fp) if cache_dir is None else None
+    inputs = [tax] if tax is not None else []
+    with stats.stage('select_sequences', inputs) as stage:
+        try:
+            if tax is None:
+                index = taxonomy_index(tax_fp, cache_dir)
+                matches = index.sequences_from_queries(
+                    [queries[name] for name in names])
+            else:
+                matches = sequences_from_queries(tax, [queries[name]
+                                                       for name in names])
+        except (PlatypusValueError, PlatypusParseError), e:
+            raise BadParameter(e.message)
+    if not matches:
+        raise BadParameter('The queries could not retrieve any results, try '
+                           'different ones.')
+    stage.add('selected', len(matches))
+
+    create_dir(output_fp)
+
+    with OutputFiles(max_open) as files:
+        outputs = [files.open(join(output_fp, name + '.fna'))
+                   for name in names]
+        rest = (files.open(join(output_fp, 'rest.fna')),)
+
+        # the sequences that match the same queries share the tuple of files
+        targets = {}
+        routes = {}
+        for sequence_identifier, found in matches.iteritems():
+            if found not in targets:
+                targets[found] = tuple(outputs[i] for i in found)
+            routes[sequence_identifier] = targets[found]
+
+        seqs = open_input(seqs_fp)
+        with stats.stage('split_sequences', [seqs]) as stage:
+            try:
+                counts = route_fasta(seqs, routes, rest, stats=stats)
+            except PlatypusParseError, e:
+                raise BadParameter(e.message)
+
+    name_of = dict(zip(outputs + list(rest), names + ['rest']))
+    written = dict.fromkeys(name_of.values(), 0)
+    for files, count in counts.iteritems():
+        for output in files:
+            written[name_of[output]] += count
+    stage.add('bytes_written', sum(getsize(output.name)
+                                   for output in outputs + list(rest)))
+    _evict_indexes(cache_dir, cache_size, tax_fp, seqs_fp)
+
+    if report:
+        stats.write(join(output_fp, REPORT_FN))
+    return written
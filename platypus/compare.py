@@ -7,6 +7,8 @@
 # ----------------------------------------------------------------------------
 from __future__ import division
 
+from collections import deque
+
 
 class PlatypusError(Exception):
     """Base exception for errors in the Platypus module"""
@@ -47,32 +49,19 @@ def sequences_from_query(taxonomy, query):
     PlatypusValueError
         If the input contains repeated sequence identifiers.
     """
-    # Note this function could be greatly benefited from a C extension
+    # a single substring test is faster than QueryMatcher, see
+    # sequences_from_queries to search for several queries
 
     interest_taxonomy = {}
-    try:    # file path
-        fd = open(taxonomy, 'U')
-    except IOError:  # string with lines, split on new lines
-        fd = taxonomy.split('\n')
-    except TypeError:  # open file descriptor or StringIO object
-        fd = taxonomy
+    fd = _open_taxonomy(taxonomy)
 
     # read each line searching for matches to the query
     for line in fd:
-        try:
-            sequence_identifier, taxa_name = line.strip().split('\t')
-        except ValueError:
-            raise PlatypusParseError(
-                "Taxonomy file/string is not tab delimited")
-
-        sequence_identifier = sequence_identifier.strip()
+        sequence_identifier, taxa_name = _split_taxonomy_line(line)
 
         if sequence_identifier in interest_taxonomy:
             # if possible close the file descriptor before leaving the function
-            try:
-                fd.close()
-            except AttributeError:
-                pass
+            _close_taxonomy(fd)
 
             raise PlatypusValueError(
                 "There are duplicated entries in the taxonomy file (%s)." %
@@ -81,10 +70,175 @@ def sequences_from_query(taxonomy, query):
         elif query.lower() in taxa_name.lower():
             interest_taxonomy[sequence_identifier] = taxa_name.strip()
 
+    _close_taxonomy(fd)
+
+    return interest_taxonomy
+
+
+def sequences_from_queries(taxonomy, queries):
+    """Search for several queries in the contents of taxonomy at once
+
+    Parameters
+    ----------
+    taxonomy : file-like
+        File descriptor, StringIO object or lines that contain tab-delimited
+        values of sequence identifier to taxonomy assignment.
+    queries : list of str
+        Strings to search for in the taxonomy assignments, the search is case
+        insensitive like in sequences_from_query.
+
+    Returns
+    -------
+    dict
+        1-D dictionary where the keys are the identifiers of the sequences
+        that match at least one query and the values are tuples with the
+        positions in `queries` of the queries they match, in increasing
+        order.
+
+    Raises
+    ------
+    PlatypusParseError
+        If the input is not a two column tab-delimited file.
+    PlatypusValueError
+        If the input contains repeated sequence identifiers.
+
+    See Also
+    --------
+    QueryMatcher
+    """
+    matcher = QueryMatcher(queries)
+
+    # the same assignment is usually shared by many sequences
+    cache = {}
+    matches = {}
+    fd = _open_taxonomy(taxonomy)
+    try:
+        for line in fd:
+            sequence_identifier, taxa_name = _split_taxonomy_line(line)
+
+            found = cache.get(taxa_name)
+            if found is None:
+                found = cache[taxa_name] = matcher.find(taxa_name.lower())
+            if not found:
+                continue
+
+            if sequence_identifier in matches:
+                raise PlatypusValueError(
+                    "There are duplicated entries in the taxonomy file (%s)." %
+                    sequence_identifier)
+            matches[sequence_identifier] = found
+    finally:
+        _close_taxonomy(fd)
+    return matches
+
+
+class QueryMatcher(object):
+    """Find all the queries that are substrings of a text in a single scan
+
+    Parameters
+    ----------
+    queries : list of str
+        Strings to search for, the search is case insensitive.
+
+    Notes
+    -----
+    This is an Aho-Corasick automaton: a trie of the queries where every
+    state also links to the longest suffix of its path that is a state too,
+    so each text is scanned once no matter the number of queries. It's
+    built once and can be used to search any number of texts.
+    """
+
+    def __init__(self, queries):
+        queries = [query.lower() for query in queries]
+
+        # trie of the queries, the state 0 is the root
+        goto = [{}]
+        output = [set()]
+        self._everywhere = ()
+        for i, query in enumerate(queries):
+            if not query:
+                self._everywhere += (i, )
+                continue
+            state = 0
+            for character in query:
+                following = goto[state].get(character)
+                if following is None:
+                    following = goto[state][character] = len(goto)
+                    goto.append({})
+                    output.append(set())
+                state = following
+            output[state].add(i)
+
+        # failure links in breadth first order, so the links of the shorter
+        # paths are known, and each state gets the queries of its link
+        fail = [0] * len(goto)
+        pending = deque(goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for character, following in goto[state].iteritems():
+                link = fail[state]
+                while link and character not in goto[link]:
+                    link = fail[link]
+                fail[following] = goto[link].get(character, 0)
+                output[following] |= output[fail[following]]
+                pending.append(following)
+
+        self._goto = goto
+        self._fail = fail
+        self._output = [tuple(sorted(found)) for found in output]
+
+    def find(self, text):
+        """Queries found in text
+
+        Parameters
+        ----------
+        text : str
+            Text to search, it's expected to be lower case already.
+
+        Returns
+        -------
+        tuple of int
+            Positions of the queries that are substrings of text, in
+            increasing order.
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set(self._everywhere)
+        state = 0
+        for character in text:
+            following = goto[state].get(character)
+            while following is None and state:
+                state = fail[state]
+                following = goto[state].get(character)
+            state = following or 0
+            if output[state]:
+                found.update(output[state])
+        return tuple(sorted(found))
+
+
+def _open_taxonomy(taxonomy):
+    """Lines of a taxonomy given as a path, a string or a file"""
+    try:    # file path
+        return open(taxonomy, 'U')
+    except IOError:  # string with lines, split on new lines
+        return taxonomy.split('\n')
+    except TypeError:  # open file descriptor or StringIO object
+        return taxonomy
+
+
+def _close_taxonomy(fd):
+    """Close the taxonomy if it's a file"""
     # not all input types are file descriptors
     try:
         fd.close()
     except AttributeError:
         pass
 
-    return interest_taxonomy
+
+def _split_taxonomy_line(line):
+    """Sequence identifier and taxonomy of a line of a taxonomy file"""
+    try:
+        sequence_identifier, taxa_name = line.strip().split('\t')
+    except ValueError:
+        raise PlatypusParseError(
+            "Taxonomy file/string is not tab delimited")
+    return sequence_identifier.strip(), taxa_name
@@ -0,0 +1,635 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import division
+
+from collections import OrderedDict
+from itertools import izip
+from multiprocessing import Pool
+from os import fstat
+from os.path import abspath, isfile
+
+import numpy as np
+
+from platypus.cache import (cache_path, create_cache_dir, read_arrays, touch,
+                            write_arrays)
+from platypus.compare import PlatypusParseError
+from platypus.util import FileRange, compression
+
+# number of bytes read at a time, the blocks are extended to a full line
+BLOCK_SIZE = 8 * 1024 * 1024
+
+# maximum number of bytes of a file split by each task of split_fasta_parallel
+RANGE_SIZE = 64 * 1024 * 1024
+
+# default number of files that OutputFiles keeps open and their buffer size
+MAX_OPEN = 64
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+
+def sequence_id(header):
+    """Identifier of a sequence, the header up to the first white space
+
+    Parameters
+    ----------
+    header : str
+        Header line of a FASTA record, without the leading '>'.
+
+    Returns
+    -------
+    str
+        The identifier, empty if the header is blank.
+    """
+    parts = header.split(None, 1)
+    return parts[0] if parts else ''
+
+
+def split_fasta(fh, ids, interest_fh, rest_fh, block_size=BLOCK_SIZE,
+                stats=None):
+    """Copy the FASTA records in ids to interest_fh and the rest to rest_fh
+
+    Parameters
+    ----------
+    fh : file-like object
+        FASTA formatted data.
+    ids : container of str
+        Identifiers of the sequences of interest, see sequence_id.
+    interest_fh, rest_fh : file-like object
+        Where the records are written.
+    block_size : int, optional
+        Approximate number of bytes read at a time.
+    stats : platypus.stats.Stats, optional
+        Counts the records written to each file into its current stage.
+
+    Returns
+    -------
+    int
+        Number of records written to interest_fh.
+    int
+        Number of records written to rest_fh.
+
+    Raises
+    ------
+    PlatypusParseError
+        If the data doesn't start with a header line.
+
+    Notes
+    -----
+    The records are copied byte for byte, so the descriptions and the line
+    breaks of the sequences are kept. Only the header lines are looked at,
+    the sequences are not parsed nor validated. Consecutive records that go
+    to the same file are written at once.
+    """
+    interest, rest = (interest_fh,), (rest_fh,)
+    counts = route_fasta(fh, _Members(ids, interest), rest, block_size, stats)
+    return counts.get(interest, 0), counts.get(rest, 0)
+
+
+def split_fasta_parallel(fh, ids, interest_fh, rest_fh, jobs,
+                         range_size=RANGE_SIZE, stats=None):
+    """Split a FASTA file like split_fasta using several processes
+
+    Parameters
+    ----------
+    fh : file-like object
+        FASTA formatted data opened from a path, the workers read the file
+        by name.
+    ids : container of str
+        Identifiers of the sequences of interest, see sequence_id.
+    interest_fh, rest_fh : file-like object
+        Where the records are written.
+    jobs : int
+        Number of processes.
+    range_size : int, optional
+        Maximum number of bytes classified by each task.
+    stats : platypus.stats.Stats, optional
+        Counts the records written to each file into its current stage.
+
+    Returns
+    -------
+    int
+        Number of records written to interest_fh.
+    int
+        Number of records written to rest_fh.
+
+    Raises
+    ------
+    PlatypusParseError
+        If the data doesn't start with a header line.
+
+    Notes
+    -----
+    The file is split in byte ranges that start at a header line. Each
+    worker finds which records of its range are of interest, and the
+    records are then copied in the order of the file in large blocks, so
+    the outputs are identical to the ones of split_fasta. If jobs is 1, fh
+    is not a regular file (for example a compressed file opened with
+    platypus.util.open_input) or the file has carriage returns, fh is split
+    serially with split_fasta.
+    """
+    if jobs <= 1 or not isinstance(fh, file) or not isfile(fh.name):
+        return split_fasta(fh, ids, interest_fh, rest_fh, stats=stats)
+
+    name = fh.name
+    with open(name, 'rb') as f:
+        size = fstat(f.fileno()).st_size
+        ranges = max(jobs, -(-size // range_size))
+        offsets = [0]
+        for i in range(1, ranges):
+            offset = _next_record_boundary(f, max(size * i // ranges,
+                                                  offsets[-1]))
+            if offset >= size:
+                break
+            if offset > offsets[-1]:
+                offsets.append(offset)
+        offsets.append(size)
+    tasks = [(name, start, end)
+             for start, end in izip(offsets[:-1], offsets[1:])]
+
+    global _range_ids
+    _range_ids = ids
+    try:
+        pool = Pool(min(jobs, len(tasks)))
+    finally:
+        _range_ids = None
+    try:
+        results = pool.map(_classify_range, tasks)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # the offsets would not match the data read in universal newlines mode
+    if any(carriage_returns for _, _, carriage_returns in results):
+        return split_fasta(fh, ids, interest_fh, rest_fh, stats=stats)
+
+    found, rest = 0, 0
+    with open(name, 'rb') as f:
+        for (_, _, end), (starts, interest, _) in izip(tasks, results):
+            if not len(interest):
+                continue
+            # consecutive records that go to the same file are copied at once
+            runs = np.flatnonzero(np.r_[True, interest[1:] != interest[:-1]])
+            bounds = starts[runs].tolist() + [end]
+            for i, is_interest in enumerate(interest[runs].tolist()):
+                _copy(f, bounds[i], bounds[i + 1],
+                      interest_fh if is_interest else rest_fh)
+
+            range_found = int(interest.sum())
+            found += range_found
+            rest += len(interest) - range_found
+            if stats is not None:
+                stats.add('interest', range_found)
+                stats.add('rest', len(interest) - range_found)
+    return found, rest
+
+
+# identifiers kept by the workers of split_fasta_parallel, the forked
+# processes inherit them so they don't need to be sent with every task
+_range_ids = None
+
+
+def _next_record_boundary(f, offset):
+    """Offset of the first header line that starts after offset"""
+    f.seek(offset)
+    if offset:
+        # skip the rest of a line that could be partially read
+        f.readline()
+    while True:
+        position = f.tell()
+        line = f.readline()
+        if not line or line.startswith('>'):
+            return position
+
+
+def _classify_range(task):
+    """Find the records of interest of a range of a file in a worker
+
+    Returns
+    -------
+    np.ndarray of int
+        Offset of every record, one per record.
+    np.ndarray of bool
+        Whether each record is of interest.
+    bool
+        Whether the range has carriage returns.
+    """
+    name, start, end = task
+    offsets, interest = [], []
+    carriage_returns = False
+    with open(name, 'rb') as f:
+        position = start
+        for block, headers in _scan(FileRange(f, start, end), BLOCK_SIZE):
+            carriage_returns = carriage_returns or '\r' in block
+            for offset, identifier in headers:
+                offsets.append(position + offset)
+                interest.append(identifier in _range_ids)
+            position += len(block)
+    return (np.array(offsets, dtype=np.int64), np.array(interest, dtype=bool),
+            carriage_returns)
+
+
+class _Members(object):
+    """Route of split_fasta, the same targets for all the ids"""
+
+    def __init__(self, ids, targets):
+        self._ids = ids
+        self._targets = targets
+
+    def get(self, name, default):
+        return self._targets if name in self._ids else default
+
+
+def route_fasta(fh, routes, default, block_size=BLOCK_SIZE, stats=None):
+    """Copy each FASTA record to the files of its sequence identifier
+
+    Parameters
+    ----------
+    fh : file-like object
+        FASTA formatted data.
+    routes : dict of tuple
+        Files where the records of each sequence identifier are written, see
+        sequence_id. Identifiers with the same files should share the same
+        tuple, consecutive records are written at once when they do.
+    default : tuple of file-like object
+        Files where the records that are not in routes are written.
+    block_size : int, optional
+        Approximate number of bytes read at a time.
+    stats : platypus.stats.Stats, optional
+        Counts the records found in routes as 'interest' and the rest as
+        'rest' into its current stage.
+
+    Returns
+    -------
+    dict of int
+        Number of records written to each of the tuples of files, including
+        default.
+
+    Raises
+    ------
+    PlatypusParseError
+        If the data doesn't start with a header line.
+
+    See Also
+    --------
+    split_fasta
+    """
+    counts = {}
+    targets = None
+    for block, headers in _scan(fh, block_size):
+        found, rest = 0, 0
+        start = 0
+        for position, identifier in headers:
+            record_targets = routes.get(identifier, default)
+            counts[record_targets] = counts.get(record_targets, 0) + 1
+            if record_targets is default:
+                rest += 1
+            else:
+                found += 1
+
+            if record_targets is not targets:
+                if targets is not None:
+                    _write(targets, buffer(block, start, position - start))
+                targets, start = record_targets, position
+
+        # blank lines before the first header are dropped
+        if targets is not None:
+            _write(targets, buffer(block, start))
+
+        if stats is not None:
+            stats.add('interest', found)
+            stats.add('rest', rest)
+
+    return counts
+
+
+def _scan(fh, block_size):
+    """Blocks of FASTA data and the position and identifier of their headers
+
+    Raises
+    ------
+    PlatypusParseError
+        If the data doesn't start with a header line.
+    """
+    name = getattr(fh, 'name', 'The input')
+    started = False
+    while True:
+        block = fh.read(block_size)
+        if not block:
+            break
+        # finish reading the last line so no header is split in two
+        if not block.endswith('\n'):
+            block += fh.readline()
+
+        headers = []
+        position = 0 if block.startswith('>') else _next_header(block, 0)
+        if not started:
+            if block[:position if position != -1 else None].strip():
+                raise PlatypusParseError("%s is not FASTA formatted" % name)
+            started = position != -1
+
+        while position != -1:
+            end = block.find('\n', position)
+            if end == -1:
+                end = len(block)
+            headers.append((position, sequence_id(block[position + 1:end])))
+            position = _next_header(block, end)
+        yield block, headers
+
+
+def _write(targets, data):
+    """Write data to each of the files"""
+    for fh in targets:
+        fh.write(data)
+
+
+def _next_header(block, position):
+    """Position of the first header line that starts after position"""
+    position = block.find('\n>', position)
+    return position + 1 if position != -1 else -1
+
+
+def index_fasta(fh, block_size=BLOCK_SIZE):
+    """Find the byte offset of each record of a FASTA file
+
+    Parameters
+    ----------
+    fh : file-like object
+        FASTA formatted data, opened in binary mode.
+    block_size : int, optional
+        Approximate number of bytes read at a time.
+
+    Returns
+    -------
+    dict of np.ndarray or None
+        The arrays of a FastaIndex, they can be stored with
+        platypus.cache.write_arrays. None if the data has carriage returns,
+        the offsets would not match the data read in universal newlines
+        mode.
+
+    Raises
+    ------
+    PlatypusParseError
+        If the data doesn't start with a header line.
+    """
+    ids, offsets = [], []
+    size = 0
+    for block, headers in _scan(fh, block_size):
+        if '\r' in block:
+            return None
+        for position, identifier in headers:
+            ids.append(identifier)
+            offsets.append(size + position)
+        size += len(block)
+    # the last record ends at the end of the data
+    offsets.append(size)
+
+    ids = np.array(ids, dtype=str)
+    order = np.argsort(ids, kind='mergesort')
+    return {'offsets': np.array(offsets, dtype=np.int64),
+            'ids': ids[order], 'records': order.astype(np.int64)}
+
+
+class FastaIndex(object):
+    """Position of the records of a FASTA file by sequence identifier
+
+    Parameters
+    ----------
+    arrays : dict of np.ndarray
+        The arrays written by index_fasta, usually memory mapped with
+        platypus.cache.read_arrays.
+    """
+
+    def __init__(self, arrays):
+        self.offsets = arrays['offsets']
+        self._ids = arrays['ids']
+        self._records = arrays['records']
+
+    def __len__(self):
+        return len(self._records)
+
+    def records(self, ids):
+        """Positions in the file of the records of some sequences
+
+        Parameters
+        ----------
+        ids : iterable of str
+            Identifiers of the sequences, see sequence_id.
+
+        Returns
+        -------
+        np.ndarray of int
+            Positions of the records whose identifier is in ids, in the
+            order of the file. The record i spans the bytes from offsets[i]
+            to offsets[i + 1].
+        """
+        # longer identifiers would be truncated and can't be in the index
+        itemsize = self._ids.dtype.itemsize
+        wanted = np.array([i for i in ids if len(i) <= itemsize],
+                          dtype=self._ids.dtype)
+        first = np.searchsorted(self._ids, wanted, 'left')
+        counts = np.searchsorted(self._ids, wanted, 'right') - first
+
+        # consecutive positions from the first match of each identifier
+        offsets = np.cumsum(counts) - counts
+        found = np.arange(counts.sum()) + np.repeat(first - offsets, counts)
+        return np.sort(self._records[found])
+
+
+def fasta_index(fp, cache_dir):
+    """Index a FASTA file, reusing the cached index when possible
+
+    Parameters
+    ----------
+    fp : str
+        Path to the FASTA file.
+    cache_dir : str
+        Directory where the index is stored.
+
+    Returns
+    -------
+    FastaIndex or None
+        The index, None if fp can't be read at random positions (it's not a
+        regular file, it's compressed or it has carriage returns).
+
+    Raises
+    ------
+    PlatypusParseError
+        If the data doesn't start with a header line.
+
+    Notes
+    -----
+    The name of the index depends on the path, the size and the
+    modification time of fp, see platypus.cache.cache_path. Files that
+    can't be indexed are marked with an empty index so they are not read
+    again to find out.
+    """
+    path = cache_path(fp, cache_dir, 'fasta')
+    if path is None or compression(fp) is not None:
+        return None
+
+    if isfile(path):
+        try:
+            arrays, metadata = read_arrays(path)
+        except PlatypusParseError:
+            pass
+        else:
+            touch(path)
+            return FastaIndex(arrays) if metadata['indexed'] else None
+
+    with open(fp, 'rb') as f:
+        arrays = index_fasta(f)
+    create_cache_dir(cache_dir)
+    write_arrays(path, arrays or {}, {'source': abspath(fp),
+                                      'indexed': arrays is not None})
+    if arrays is None:
+        return None
+    arrays, _ = read_arrays(path)
+    return FastaIndex(arrays)
+
+
+def split_fasta_indexed(fp, index, ids, interest_fh, rest_fh, stats=None):
+    """Split a FASTA file like split_fasta, reading it at random positions
+
+    Parameters
+    ----------
+    fp : str
+        Path to the FASTA file.
+    index : FastaIndex
+        The index of fp, see fasta_index.
+    ids : iterable of str
+        Identifiers of the sequences of interest, see sequence_id.
+    interest_fh, rest_fh : file-like object
+        Where the records are written.
+    stats : platypus.stats.Stats, optional
+        Counts the records written to each file into its current stage.
+
+    Returns
+    -------
+    int
+        Number of records written to interest_fh.
+    int
+        Number of records written to rest_fh.
+
+    Notes
+    -----
+    The outputs are the same as the ones of split_fasta. The header lines
+    are not read: the records of interest are located with the index, and
+    the data between them is copied to rest_fh in large blocks.
+    """
+    records = index.records(ids)
+    offsets = index.offsets.tolist()
+
+    # runs of consecutive records of interest are copied at once
+    runs = []
+    if len(records):
+        breaks = np.flatnonzero(np.diff(records) != 1) + 1
+        runs = zip(records[np.r_[0, breaks]].tolist(),
+                   records[np.r_[breaks - 1, len(records) - 1]].tolist())
+
+    position = offsets[0]
+    with open(fp, 'rb') as f:
+        for first, last in runs:
+            _copy(f, position, offsets[first], rest_fh)
+            _copy(f, offsets[first], offsets[last + 1], interest_fh)
+            position = offsets[last + 1]
+        _copy(f, position, offsets[-1], rest_fh)
+
+    found, rest = len(records), len(index) - len(records)
+    if stats is not None:
+        stats.add('interest', found)
+        stats.add('rest', rest)
+    return found, rest
+
+
+def _copy(f, start, end, fh):
+    """Copy the bytes from start to end of f to fh"""
+    f.seek(start)
+    while start < end:
+        data = f.read(min(BLOCK_SIZE, end - start))
+        if not data:
+            raise PlatypusParseError("%s is shorter than its index" % f.name)
+        fh.write(data)
+        start += len(data)
+
+
+class OutputFiles(object):
+    """Files written in any order, keeping a few of them open at a time
+
+    Parameters
+    ----------
+    max_open : int, optional
+        Maximum number of files open at the same time.
+    buffer_size : int, optional
+        Size of the buffer of each open file.
+
+    Notes
+    -----
+    The files are created empty by `open`. When a file is written and
+    max_open files are already open, the one that was opened first is
+    closed, and it's opened again to append to it when it's written again.
+    """
+
+    def __init__(self, max_open=MAX_OPEN, buffer_size=OUTPUT_BUFFER_SIZE):
+        if max_open < 1:
+            raise ValueError("At least one file needs to be open")
+        self._max_open = max_open
+        self._buffer_size = buffer_size
+        self._open = OrderedDict()
+
+    def open(self, fp):
+        """Create an empty file
+
+        Parameters
+        ----------
+        fp : str
+            Path of the file.
+
+        Returns
+        -------
+        file-like object
+            Object to write to the file, with a name attribute set to fp.
+        """
+        open(fp, 'w').close()
+        return _OutputFile(self, fp)
+
+    def _reopen(self, output):
+        """Open a file to append to it, closing another one if needed"""
+        if len(self._open) >= self._max_open:
+            oldest, _ = self._open.popitem(last=False)
+            oldest.fh.close()
+            oldest.fh = None
+        output.fh = open(output.name, 'a', self._buffer_size)
+        self._open[output] = None
+        return output.fh
+
+    def close(self):
+        """Close all the files"""
+        while self._open:
+            output, _ = self._open.popitem()
+            output.fh.close()
+            output.fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _OutputFile(object):
+    """A file of OutputFiles"""
+
+    def __init__(self, files, name):
+        self.name = name
+        self.fh = None
+        self._files = files
+
+    def write(self, data):
+        fh = self.fh
+        if fh is None:
+            fh = self._files._reopen(self)
+        fh.write(data)
@@ -6,10 +6,27 @@
 # The full license is in the file COPYING.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 from __future__ import division
-from itertools import product, izip
-from collections import namedtuple
+from bisect import bisect_left, bisect_right
+from itertools import product, izip, tee
+from collections import namedtuple, Mapping, OrderedDict
 from copy import copy
-from os.path import join
+from csv import QUOTE_NONE
+from io import BytesIO
+from multiprocessing import Pool
+from os import fstat
+from os.path import abspath, basename, getsize, isfile, join
+from shutil import rmtree
+from tempfile import mkdtemp
+import re
+import zlib
+
+import numpy as np
+from pandas import read_csv
+
+from platypus.cache import (cache_path, create_cache_dir, read_arrays,
+                            touch, write_arrays)
+from platypus.compare import PlatypusParseError, PlatypusValueError
+from platypus.util import FileRange
 
 _header = (('query', str),
            ('subject', str),
@@ -27,8 +44,71 @@ _header = (('query', str),
 M9 = namedtuple('m9', [h[0] for h in _header])
 M9_empty = [M9(**{h: None for h, _ in _header})]
 
+# subset of the m9 fields that is kept by the columnar parser, the remaining
+# fields are not used to select or report the best hits
+M9_COLUMNS = ('query', 'subject', 'percent_id', 'aln_length', 'evalue',
+              'bitscore')
+_columnar_fields = [(i, h, c) for i, (h, c) in enumerate(_header)
+                    if h in M9_COLUMNS]
+
+# number of bytes read at a time by the columnar parser
+BLOCK_SIZE = 8 * 1024 * 1024
+
+# maximum number of hits times threshold combinations evaluated at once
+BATCH_CELLS = 2 ** 20
+
+# maximum number of bytes of a file parsed by each task of parse_m9_parallel
+RANGE_SIZE = 64 * 1024 * 1024
+
+# bytes of hits kept in memory by group_records before they are written to
+# the partitions, and number of partitions
+GROUP_MEMORY = 1024 * 1024 * 1024
+PARTITIONS = 64
+
+# names of the table and the index of ConsolidatedOutput
+CONSOLIDATED_FN = 'results.txt'
+CONSOLIDATED_INDEX_FN = 'results_index.txt'
+
+# bytes of the lines of an output, and of all of them, kept in memory by
+# ConsolidatedOutput before they are written to the table
+CHUNK_SIZE = 1024 * 1024
+BUFFER_SIZE = 64 * 1024 * 1024
+
+_comment_line = re.compile(r'^(#[^\n]*)\n', re.MULTILINE)
+
+# the query identifier of each data line, as found by the columnar parser
+_query_field = re.compile(r'^ *([^\t\n]*)', re.MULTILINE)
+
+
+def m9_dtype(query_length=1, subject_length=1):
+    """Data type of the structured arrays created by parse_m9_columnar
+
+    Parameters
+    ----------
+    query_length : int, optional
+        Number of bytes used to store the query identifiers.
+    subject_length : int, optional
+        Number of bytes used to store the subject identifiers.
+
+    Returns
+    -------
+    np.dtype
+        Structured data type with the fields in M9_COLUMNS.
+    """
+    return np.dtype([('query', 'S%d' % query_length),
+                     ('subject', 'S%d' % subject_length),
+                     ('percent_id', float),
+                     ('aln_length', int),
+                     ('evalue', float),
+                     ('bitscore', float)])
+
+
+# shared value for the records without hits in the columnar parser
+_no_hits = np.empty(0, dtype=m9_dtype())
+_no_hits.flags.writeable = False
 
-def parse_m9(fp):
+
+def parse_m9(fp, queries=None):
     """Parse m9 formatted tabular data
 
     Parameters
@@ -37,6 +117,10 @@ def parse_m9(fp):
         A file pointer that contains the lines to parse. It is expected that
         these lines are in BLAST m9 format, or comparable. Any additional
         columns will be ignored
+    queries : container of str, optional
+        If given, the lines of the queries that are not in this container
+        are skipped without being converted, and their records are not
+        returned.
 
     Returns
     -------
@@ -63,6 +147,16 @@ def parse_m9(fp):
 
             continue
 
+        # skipping a query splits the records as a change of query would
+        if (queries is not None and
+                line.lstrip().split('\t', 1)[0] not in queries):
+            start_of_record = False
+            if hits:
+                yield (hits[0].query, hits)
+                hits = []
+                current_query = None
+            continue
+
         # BLAST output contains 12 fields, SortMeRNA has 14. The order is the
         # same, and we only care about the 12 fields common with BLAST.
         parts = line.strip().split('\t')[:12]
@@ -87,7 +181,1238 @@ def parse_m9(fp):
         yield (None, copy(M9_empty))
 
 
-def parse_first_database(db, percentage_ids, alignment_lengths):
+def _read_blocks(fp, block_size):
+    """Read complete lines from fp in blocks of roughly block_size bytes
+
+    Parameters
+    ----------
+    fp : file-like object or iterable of str
+        Object to read the lines from.
+    block_size : int
+        Approximate number of bytes to read at a time.
+
+    Returns
+    -------
+    iterator of str
+        Blocks of text, each of them made of complete lines and terminated by
+        a new line character.
+    """
+    if hasattr(fp, 'read'):
+        while True:
+            block = fp.read(block_size)
+            if not block:
+                break
+
+            # finish reading the last line so no record is split in two
+            if not block.endswith('\n'):
+                block += fp.readline()
+                if not block.endswith('\n'):
+                    block += '\n'
+            yield block
+    else:
+        lines, size = [], 0
+        for line in fp:
+            lines.append(line.rstrip('\n'))
+            size += len(line)
+            if size >= block_size:
+                yield '\n'.join(lines) + '\n'
+                lines, size = [], 0
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+
+def _text_to_array(text):
+    """Convert data lines of m9 formatted data into a structured array
+
+    Parameters
+    ----------
+    text : str
+        Lines in BLAST m9 format or comparable, each of them terminated by a
+        new line character. No comment lines are allowed.
+
+    Returns
+    -------
+    np.ndarray
+        Structured array with one element per line, see m9_dtype.
+
+    Raises
+    ------
+    ValueError
+        If any of the lines contains less than 12 fields or if any of the
+        numeric fields can't be converted.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+
+    # count the fields in each line without splitting the text
+    chars = np.frombuffer(text, dtype=np.uint8)
+    ends = np.flatnonzero(chars == ord('\n'))
+    tabs = np.searchsorted(np.flatnonzero(chars == ord('\t')), ends)
+    tabs[1:] -= tabs[:-1].copy()
+
+    # BLAST output contains 12 fields, SortMeRNA has 14. The order is the
+    # same, and we only care about the 12 fields common with BLAST.
+    if tabs.min() < 11:
+        raise ValueError("Unexpected number of fields found")
+
+    # the C tokenizer from pandas is an order of magnitude faster than
+    # splitting each line, round_trip keeps the values identical to float()
+    table = read_csv(BytesIO(text), sep='\t', header=None, engine='c',
+                     usecols=[i for i, _, _ in _columnar_fields],
+                     dtype={i: c if c is not str else object
+                            for i, _, c in _columnar_fields},
+                     na_filter=False, quoting=QUOTE_NONE,
+                     skipinitialspace=True, float_precision='round_trip')
+
+    query = table[0].values.astype(str)
+    subject = table[1].values.astype(str)
+    hits = np.empty(len(table), dtype=m9_dtype(query.itemsize,
+                                               subject.itemsize))
+    hits['query'] = query
+    hits['subject'] = subject
+    for column, name, _ in _columnar_fields[2:]:
+        hits[name] = table[column].values
+    return hits
+
+
+def _concatenate(groups):
+    """Join the groups of hits from a single query
+
+    Parameters
+    ----------
+    groups : list of np.ndarray
+        Structured arrays of hits, the length of the identifiers can be
+        different in each of the arrays.
+
+    Returns
+    -------
+    np.ndarray
+        Structured array with all the hits in groups.
+    """
+    if len(groups) == 1:
+        return groups[0]
+
+    dtype = m9_dtype(max(g.dtype['query'].itemsize for g in groups),
+                     max(g.dtype['subject'].itemsize for g in groups))
+    return np.concatenate([g.astype(dtype) for g in groups])
+
+
+def parse_m9_columnar(fp, block_size=BLOCK_SIZE, reduce=False,
+                      queries=None):
+    """Parse m9 formatted tabular data into structured arrays
+
+    Parameters
+    ----------
+    fp : file-like object
+        A file pointer that contains the lines to parse. It is expected that
+        these lines are in BLAST m9 format, or comparable. Any additional
+        columns will be ignored
+    block_size : int, optional
+        Approximate number of bytes that are read and converted at a time.
+    reduce : bool, optional
+        Whether to reduce the hits of each query to their Pareto front, see
+        pareto_front. Defaults to False.
+    queries : container of str, optional
+        If given, the lines of the queries that are not in this container
+        are removed before the text is converted, and their records are not
+        returned.
+
+    Returns
+    -------
+    iterator of tuple
+        Tuples of query identifier and hits for that query, the hits are a
+        structured array with the fields in M9_COLUMNS, see m9_dtype. Records
+        without hits are reported with a query of None and an empty array, as
+        done by parse_m9.
+
+    Notes
+    -----
+    The records are grouped following exactly the same rules than parse_m9,
+    the difference is that the text is converted in blocks of lines rather
+    than one line at a time, and only the columns in M9_COLUMNS are kept.
+    """
+    records = _parse_m9_blocks(fp, block_size, queries)
+    if reduce:
+        records = ((query, pareto_front(hits) if query is not None else hits)
+                   for query, hits in records)
+    return records
+
+
+def _line_queries(chars, starts, ends):
+    """Query identifier of each line, as a fixed width array of strings"""
+    tabs = np.flatnonzero(chars == ord('\t'))
+    if not len(tabs):
+        return np.array([chars[i:j].tostring() for i, j in
+                         izip(starts.tolist(), ends.tolist())])
+    first_tab = tabs[np.minimum(np.searchsorted(tabs, starts), len(tabs) - 1)]
+    stops = np.where((first_tab >= starts) & (first_tab < ends), first_tab,
+                     ends)
+
+    # the identifiers are gathered as rows of bytes padded with zeros
+    lengths = stops - starts
+    width = max(1, lengths.max())
+    columns = np.arange(width)
+    ids = chars[np.minimum(starts[:, np.newaxis] + columns, len(chars) - 1)]
+    ids[columns >= lengths[:, np.newaxis]] = 0
+    return ids.view('S%d' % width).ravel()
+
+
+def _filter_lines(data, events, queries):
+    """Remove the data lines of the queries that are not in queries
+
+    Parameters
+    ----------
+    data : str
+        Data lines, each of them terminated by a new line character.
+    events : list of tuple
+        Comment lines and the number of data lines that precede them.
+    queries : container of str
+        The queries to keep.
+
+    Returns
+    -------
+    str
+        The lines that are kept.
+    list of tuple
+        The events with the positions updated to the kept lines, plus an
+        event with an empty line wherever a run of lines was removed.
+    """
+    chars = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(chars == ord('\n'))
+    starts = np.append(0, ends[:-1] + 1)
+    if (chars[starts] == ord(' ')).any():
+        # the parser ignores the spaces that precede the query identifier
+        ids = np.array(_query_field.findall(data)[:len(ends)])
+    else:
+        ids = _line_queries(chars, starts, ends)
+
+    # the membership is checked once for each run of lines of a query
+    runs = np.flatnonzero(np.append(True, ids[1:] != ids[:-1]))
+    skip = np.array([query not in queries for query in ids[runs].tolist()])
+    if not skip.any():
+        return data, events
+    skip = np.repeat(skip, np.diff(np.append(runs, len(ids))))
+
+    data = chars[np.repeat(~skip, ends - starts + 1)].tostring()
+    kept = np.append(0, np.cumsum(~skip))
+
+    # a run of removed lines starts after a kept line or after a comment
+    removed = skip.copy()
+    removed[1:] &= ~skip[:-1]
+    comments = [position for position, line in events
+                if line is not None and position < len(skip)]
+    removed[comments] = skip[comments]
+    removed = np.flatnonzero(removed)
+
+    # the removed runs go after the comments found in the same position
+    positions = np.array([position for position, _ in events] +
+                         removed.tolist(), dtype=int)
+    order = np.argsort(2 * positions + (np.arange(len(positions)) >=
+                                        len(events)), kind='mergesort')
+    lines = [line for _, line in events] + [''] * len(removed)
+    return data, [(position, lines[i]) for position, i in
+                  izip(kept[positions[order]].tolist(), order.tolist())]
+
+
+def _parse_m9_blocks(fp, block_size, queries=None):
+    """Helper of parse_m9_columnar that does the actual parsing"""
+    pending, pending_query = [], None
+    start_of_record = False
+
+    for block in _read_blocks(fp, block_size):
+        # separate the comments from the data, keeping track of the number of
+        # data lines that precede each of the comments
+        if block.startswith('#') or '\n#' in block:
+            pieces = _comment_line.split(block)
+        else:
+            pieces = [block]
+
+        events, position = [], 0
+        for data, line in izip(pieces[::2], pieces[1::2]):
+            position += data.count('\n')
+            events.append((position, line))
+        events.append((position + pieces[-1].count('\n'), None))
+
+        data = ''.join(pieces[::2])
+        if queries is not None and data:
+            data, events = _filter_lines(data, events, queries)
+
+        if data:
+            hits = _text_to_array(data)
+            changes = hits['query']
+            changes = (np.flatnonzero(changes[1:] != changes[:-1]) +
+                       1).tolist()
+            ids = hits['query'].tolist()
+
+        start = 0
+        for position, line in events:
+            if position > start:
+                start_of_record = False
+
+                # SortMeRNA doesn't have the header output to differentiate
+                # records, only the change of query id splits them
+                bounds = ([start] +
+                          changes[bisect_right(changes, start):
+                                  bisect_left(changes, position)] +
+                          [position])
+                for lower, upper in izip(bounds[:-1], bounds[1:]):
+                    if pending and pending_query != ids[lower]:
+                        yield (pending_query, _concatenate(pending))
+                        pending = []
+                    pending.append(hits[lower:upper])
+                    pending_query = ids[lower]
+                start = position
+
+            if line is None:
+                break
+
+            # skipped lines split the records as a change of query would
+            if not line:
+                start_of_record = False
+                if pending:
+                    yield (pending_query, _concatenate(pending))
+                    pending = []
+
+            # Using the header detail from BLAST to differentiate records as
+            # this allows us to get a correct count of query sequences
+            elif line.startswith('# Fields'):
+                start_of_record = True
+                if pending:
+                    yield (pending_query, _concatenate(pending))
+                    pending = []
+            elif line.startswith('# BLASTN') and start_of_record:
+                yield (None, _no_hits)
+
+    if pending:
+        yield (pending_query, _concatenate(pending))
+    elif start_of_record:
+        yield (None, _no_hits)
+
+
+def parse_m9_cached(fp, cache_dir, jobs=1):
+    """Parse m9 formatted data reduced to Pareto fronts, caching the result
+
+    Parameters
+    ----------
+    fp : file-like object
+        A file pointer opened from a path, the path (fp.name) identifies the
+        cached results.
+    cache_dir : str
+        Directory where the parsed results are stored.
+    jobs : int, optional
+        Number of processes used to parse fp when it's not cached, see
+        parse_m9_parallel. Defaults to 1.
+
+    Returns
+    -------
+    iterator of tuple
+        The same records as parse_m9_columnar(fp, reduce=True).
+
+    Notes
+    -----
+    If there's a cache file for the current contents of fp, the records are
+    read from it using a memory map and fp is not read. Otherwise, fp is
+    parsed and the cache file is written once all the records are consumed.
+    Inputs that are not regular files are never cached. See
+    platypus.cache.evict to limit the size of the cache directory.
+    """
+    path = cache_path(getattr(fp, 'name', None), cache_dir, 'm9')
+    if path is None:
+        return parse_m9_parallel(fp, jobs, reduce=True)
+
+    if isfile(path):
+        try:
+            arrays, _ = read_arrays(path)
+        except PlatypusParseError:
+            pass
+        else:
+            touch(path)
+            return _unpack_records(arrays)
+
+    create_cache_dir(cache_dir)
+    return _write_cached_records(fp, path, jobs)
+
+
+def _pack_records(records):
+    """Store a list of records in three arrays, see _unpack_records"""
+    fronts = [hits for _, hits in records]
+    # records without hits are stored with an empty query identifier
+    return {'queries': np.array([query or '' for query, _ in records],
+                                dtype=str),
+            'offsets': np.cumsum([0] + [len(hits) for hits in fronts]),
+            'hits': _concatenate(fronts) if fronts else _no_hits}
+
+
+def _unpack_records(arrays):
+    """Iterate over the records stored with _pack_records"""
+    hits, offsets = arrays['hits'], arrays['offsets'].tolist()
+    for i, query in enumerate(arrays['queries'].tolist()):
+        if query:
+            yield (query, hits[offsets[i]:offsets[i + 1]])
+        else:
+            yield (None, _no_hits)
+
+
+def _write_cached_records(fp, path, jobs):
+    """Helper of parse_m9_cached to parse and then cache the records"""
+    records = []
+    for record in parse_m9_parallel(fp, jobs, reduce=True):
+        records.append(record)
+        yield record
+
+    write_arrays(path, _pack_records(records), {'source': abspath(fp.name)})
+
+
+def group_records(records, memory=GROUP_MEMORY, partitions=PARTITIONS,
+                  temp_dir=None, reduce=False):
+    """Join the records of each query when its hits are not contiguous
+
+    Parameters
+    ----------
+    records : iterable of tuple
+        The records of a parser, for example parse_m9_columnar. The hits of
+        a query can be split in several records anywhere in the input.
+    memory : int, optional
+        Approximate number of bytes of hits kept in memory. Beyond that, the
+        records are written to temporary files.
+    partitions : int, optional
+        Number of temporary files the records are distributed to.
+    temp_dir : str, optional
+        Directory for the temporary files, defaults to the directory of the
+        tempfile module.
+    reduce : bool, optional
+        Whether the hits are Pareto fronts, the front of the hits joined from
+        several records is computed again, see pareto_front.
+
+    Returns
+    -------
+    iterator of tuple
+        A record per query, with the hits of all its records in the order
+        they were found, as a structured array. The records without hits are
+        returned first, as they are found.
+
+    Notes
+    -----
+    The parsers start a new record whenever the query changes, so merged
+    or multithreaded outputs with interleaved queries split the hits of a
+    query in several records that would be treated as different queries.
+
+    The records are kept in memory in the order their query is first found
+    and, if they don't fit, every record is written to one of the
+    partitions depending on a hash of its query. Each partition is then read
+    and grouped in turn, so the memory needed is about the size of a
+    partition, and the records come out partition by partition.
+    """
+    groups, size = OrderedDict(), 0
+    spill_dir, spilled = None, False
+    try:
+        for query, hits in records:
+            if query is None:
+                yield query, hits
+                continue
+            if not isinstance(hits, np.ndarray):
+                hits = _as_array(hits)
+            groups.setdefault(query, []).append(hits)
+            size += hits.nbytes + len(query)
+
+            if size > memory:
+                if spill_dir is None:
+                    spill_dir = mkdtemp(prefix='platypus-group-', dir=temp_dir)
+                _spill(groups, spill_dir, partitions)
+                groups, size, spilled = OrderedDict(), 0, True
+
+        if not spilled:
+            for record in _joined(groups, reduce):
+                yield record
+            return
+
+        _spill(groups, spill_dir, partitions)
+        groups = None
+        for partition in range(partitions):
+            fp = join(spill_dir, str(partition))
+            if not isfile(fp):
+                continue
+            groups = OrderedDict()
+            for query, hits in _read_spilled(fp):
+                groups.setdefault(query, []).append(hits)
+            for record in _joined(groups, reduce):
+                yield record
+    finally:
+        if spill_dir is not None:
+            rmtree(spill_dir, ignore_errors=True)
+
+
+def _joined(groups, reduce):
+    """Helper of group_records, a record for each group of hits"""
+    for query, fragments in groups.iteritems():
+        hits = _concatenate(fragments)
+        if reduce and len(fragments) > 1:
+            hits = pareto_front(hits)
+        yield query, hits
+
+
+def _spill(groups, spill_dir, partitions):
+    """Helper of group_records, append the groups to their partitions"""
+    batches = {}
+    for query, fragments in groups.iteritems():
+        partition = (zlib.crc32(query) & 0xffffffff) % partitions
+        batches.setdefault(partition, []).append((query,
+                                                  _concatenate(fragments)))
+    for partition, batch in batches.iteritems():
+        arrays = _pack_records(batch)
+        with open(join(spill_dir, str(partition)), 'ab') as f:
+            for name in ('queries', 'offsets', 'hits'):
+                np.save(f, arrays[name])
+
+
+def _read_spilled(fp):
+    """Helper of group_records, the records written to a partition"""
+    size = getsize(fp)
+    with open(fp, 'rb') as f:
+        while f.tell() < size:
+            arrays = {name: np.load(f)
+                      for name in ('queries', 'offsets', 'hits')}
+            for record in _unpack_records(arrays):
+                yield record
+
+
+def parse_m9_parallel(fp, jobs, reduce=False, range_size=RANGE_SIZE,
+                      queries=None):
+    """Parse m9 formatted data using several processes
+
+    Parameters
+    ----------
+    fp : file-like object
+        A file pointer opened from a path, the workers read the file by name.
+    jobs : int
+        Number of processes.
+    reduce : bool, optional
+        Whether to reduce the hits of each query to their Pareto front.
+    range_size : int, optional
+        Maximum number of bytes parsed by each task.
+    queries : container of str, optional
+        If given, only the records of these queries are returned, see
+        parse_m9_columnar.
+
+    Returns
+    -------
+    iterator of tuple
+        The same records, in the same order, as parse_m9_columnar.
+
+    Notes
+    -----
+    The file is split in byte ranges that are moved forward to the next
+    change of query identifier in the data lines, so that each range can be
+    parsed on its own and joining the records of all the ranges in order
+    gives exactly the records of the serial parser. If jobs is 1 or fp is
+    not a regular file (for example a pipe or a compressed file opened with
+    platypus.util.open_input), fp is parsed serially with parse_m9_columnar.
+    """
+    # decompressed inputs have a name but can't be split in ranges
+    if jobs <= 1 or not isinstance(fp, file) or not isfile(fp.name):
+        return parse_m9_columnar(fp, reduce=reduce, queries=queries)
+    return _parse_m9_ranges(fp, jobs, reduce, range_size, queries)
+
+
+# queries kept by the workers of parse_m9_parallel, the forked processes
+# inherit it so it doesn't need to be sent with every task
+_range_queries = None
+
+
+def _parse_m9_ranges(fp, jobs, reduce, range_size, queries):
+    """Helper of parse_m9_parallel that runs the pool of processes"""
+    global _range_queries
+
+    name = fp.name
+    with open(name, 'rb') as f:
+        size = fstat(f.fileno()).st_size
+        ranges = max(jobs, -(-size // range_size))
+        offsets = [0]
+        for i in range(1, ranges):
+            offset = _next_query_boundary(f, max(size * i // ranges,
+                                                 offsets[-1]))
+            if offset >= size:
+                break
+            if offset > offsets[-1]:
+                offsets.append(offset)
+        offsets.append(size)
+
+    tasks = [(name, start, end, reduce)
+             for start, end in izip(offsets[:-1], offsets[1:])]
+    _range_queries = queries
+    try:
+        pool = Pool(min(jobs, len(tasks)))
+    finally:
+        _range_queries = None
+    try:
+        # imap returns the results in the order of the tasks, fp is moved
+        # past each range as a serial parser would, to follow the progress
+        for (_, _, end, _), arrays in izip(tasks,
+                                           pool.imap(_parse_m9_range, tasks)):
+            for record in _unpack_records(arrays):
+                yield record
+            fp.seek(end)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _next_query_boundary(f, offset):
+    """Offset after the last hit of the first query found after offset
+
+    Parameters
+    ----------
+    f : file
+        File opened in binary mode.
+    offset : int
+        Position to start searching from.
+
+    Returns
+    -------
+    int
+        Position right after a data line whose next data line belongs to a
+        different query, or the size of the file if there's none. The parser
+        flushes the hits of a query when the identifier changes, so splitting
+        there doesn't change the records.
+    """
+    f.seek(offset)
+    if offset:
+        # skip the rest of a line that could be partially read
+        f.readline()
+
+    first, end = None, None
+    for line in iter(f.readline, ''):
+        if line.startswith('#'):
+            continue
+
+        query = line.split('\t', 1)[0].strip()
+        if first is None:
+            first = query
+        elif query != first:
+            return end
+        end = f.tell()
+    return f.tell()
+
+
+def _parse_m9_range(task):
+    """Parse a range of a file in a worker process, see parse_m9_parallel"""
+    name, start, end, reduce = task
+    with open(name, 'rb') as f:
+        records = list(parse_m9_columnar(FileRange(f, start, end),
+                                         reduce=reduce,
+                                         queries=_range_queries))
+    return _pack_records(records)
+
+
+def pareto_front(hits):
+    """Reduce the hits of a query to the ones that can ever be the best hit
+
+    Parameters
+    ----------
+    hits : np.ndarray
+        Structured array with the hits of a single query, see m9_dtype.
+
+    Returns
+    -------
+    np.ndarray
+        The hits that are not dominated by any other hit, sorted by decreasing
+        bit score; hits with the same bit score keep their original order.
+
+    Notes
+    -----
+    Whatever the thresholds, the best hit of a query is the first one with
+    the highest bit score among the hits with a percentage identity and an
+    alignment length above the thresholds. A hit is dominated when a hit that
+    comes before it in the returned order has a percentage identity and an
+    alignment length at least as large, as that hit passes any thresholds
+    that the dominated hit passes. Hits with a bit score of zero or less are
+    never selected. For any thresholds, the first hit of the front that
+    passes them is the best hit, see best_in_front.
+    """
+    hits = hits[hits['bitscore'] > 0]
+    if len(hits) > 1:
+        hits = hits[np.argsort(-hits['bitscore'], kind='mergesort')]
+        # the hits seen so far that no other dominates, a staircase with
+        # increasing percentage identities and decreasing alignment lengths
+        pids, lengths = [], []
+        keep = []
+        for i, (pid, length) in enumerate(zip(hits['percent_id'].tolist(),
+                                              hits['aln_length'].tolist())):
+            # the longest of the hits with at least this percentage identity
+            j = bisect_left(pids, pid)
+            if j < len(pids) and lengths[j] >= length:
+                continue
+            keep.append(i)
+
+            # the hits of the staircase it dominates are next to each other
+            start = j
+            while start and lengths[start - 1] <= length:
+                start -= 1
+            end = j + 1 if j < len(pids) and pids[j] == pid else j
+            pids[start:end] = [pid]
+            lengths[start:end] = [length]
+        hits = hits[keep]
+    return hits
+
+
+def best_in_front(front, percentage_id, alignment_length):
+    """Find the best hit of a Pareto front for a combination of thresholds
+
+    Parameters
+    ----------
+    front : np.ndarray
+        Structured array with the Pareto front of a query, as returned by
+        pareto_front.
+    percentage_id : float
+        Minimum percentage identity.
+    alignment_length : int
+        Minimum alignment length.
+
+    Returns
+    -------
+    int
+        Position of the best hit in front, -1 if no hit passes the thresholds.
+    """
+    valid = np.flatnonzero((front['percent_id'] >= percentage_id) &
+                           (front['aln_length'] >= alignment_length))
+    return valid[0] if len(valid) else -1
+
+
+def best_hit_indices(hits, offsets, percentage_ids, alignment_lengths):
+    """Find the best hit of several queries for all the threshold combinations
+
+    Parameters
+    ----------
+    hits : np.ndarray
+        Structured array with the hits of all the queries one after the
+        other, see m9_dtype.
+    offsets : np.ndarray
+        Position in hits where the hits of each query start, followed by the
+        total number of hits. All the queries need at least one hit.
+    percentage_ids : iterable of float
+        Minimum percentage identities.
+    alignment_lengths : iterable of int
+        Minimum alignment lengths.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (number of queries, number of combinations) with the
+        position in hits of the first hit with the highest bit score that
+        passes each combination of thresholds, or -1 if there's no such hit.
+        The combinations are ordered as in product(percentage_ids,
+        alignment_lengths).
+    """
+    options = np.array(list(product(percentage_ids, alignment_lengths)),
+                       dtype=float).reshape(-1, 2)
+    starts = offsets[:-1]
+    if not len(options) or not len(starts):
+        return np.empty((len(starts), len(options)), dtype=int)
+
+    # one row per combination of thresholds, one column per hit
+    valid = ((hits['percent_id'] >= options[:, :1]) &
+             (hits['aln_length'] >= options[:, 1:]) &
+             (hits['bitscore'] > 0))
+    scores = np.where(valid, hits['bitscore'], -np.inf)
+
+    # the highest score of each query, and then the first hit reaching it
+    best = np.maximum.reduceat(scores, starts, axis=1)
+    valid &= scores == np.repeat(best, np.diff(offsets), axis=1)
+    positions = np.where(valid, np.arange(len(hits)), len(hits))
+    positions = np.minimum.reduceat(positions, starts, axis=1)
+    positions[positions == len(hits)] = -1
+    return positions.T
+
+
+def _as_array(hits):
+    """Convert the namedtuples created by parse_m9 into a structured array"""
+    rows = [tuple(getattr(h, name) for name in M9_COLUMNS) for h in hits]
+    dtype = m9_dtype(max(len(h.query) for h in hits),
+                     max(len(h.subject) for h in hits))
+    return np.array(rows, dtype=dtype)
+
+
+def _evaluated_batches(results, percentage_ids, alignment_lengths):
+    """Evaluate the records of a parser in batches with best_hit_indices
+
+    Parameters
+    ----------
+    results : iterator of tuple
+        The records as returned by parse_m9 or parse_m9_columnar.
+    percentage_ids : iterable of float
+        Minimum percentage identities.
+    alignment_lengths : iterable of int
+        Minimum alignment lengths.
+
+    Returns
+    -------
+    iterator of tuple
+        For each batch, the list of records (with the hits converted to
+        structured arrays), a structured array with the hits of all of them,
+        the position in this array where the hits of each record start and a
+        2-D array with the position of the best hit of each record for each
+        combination of thresholds (-1 if none). The order of the records is
+        preserved.
+    """
+    percentage_ids = list(percentage_ids)
+    alignment_lengths = list(alignment_lengths)
+    combinations = max(1, len(percentage_ids) * len(alignment_lengths))
+
+    pending, size = [], 0
+    for query, hits in results:
+        if query is not None and not isinstance(hits, np.ndarray):
+            hits = _as_array(hits)
+        # records without hits count as one so the batches stay bounded
+        size += max(len(hits), 1) if query is not None else 1
+        pending.append((query, hits))
+
+        if size * combinations >= BATCH_CELLS:
+            yield _evaluate_batch(pending, percentage_ids, alignment_lengths)
+            pending, size = [], 0
+
+    if pending:
+        yield _evaluate_batch(pending, percentage_ids, alignment_lengths)
+
+
+def _evaluate_batch(pending, percentage_ids, alignment_lengths):
+    """Helper of _evaluated_batches to process one batch of records"""
+    # queries without hits can come from a reduction with pareto_front
+    rows = [i for i, (query, hits) in enumerate(pending)
+            if query is not None and len(hits)]
+    sizes = [len(hits) if query is not None else 0 for query, hits in pending]
+    starts = np.cumsum([0] + sizes[:-1])
+
+    best = np.full((len(pending), len(percentage_ids) *
+                    len(alignment_lengths)), -1, dtype=int)
+    if rows:
+        hits = _concatenate([pending[i][1] for i in rows])
+        offsets = np.append(starts[rows], len(hits))
+        best[rows] = best_hit_indices(hits, offsets, percentage_ids,
+                                      alignment_lengths)
+    else:
+        hits = _no_hits
+    return pending, hits, starts, best
+
+
+def _best_hits_in_batches(results, percentage_ids, alignment_lengths):
+    """Evaluate the records of a parser one at a time
+
+    Parameters
+    ----------
+    results : iterator of tuple
+        The records as returned by parse_m9 or parse_m9_columnar.
+    percentage_ids : iterable of float
+        Minimum percentage identities.
+    alignment_lengths : iterable of int
+        Minimum alignment lengths.
+
+    Returns
+    -------
+    iterator of tuple
+        Tuples of query identifier, structured array of hits and array with
+        the position in the hits of the best hit for each combination of
+        thresholds (-1 if none). The records without hits are returned as
+        (None, None, None). The order of the records is preserved.
+    """
+    for records, _, starts, best in _evaluated_batches(results,
+                                                       percentage_ids,
+                                                       alignment_lengths):
+        best = np.where(best >= 0, best - starts[:, np.newaxis], -1)
+        for (query, hits), positions in izip(records, best):
+            if query is None:
+                yield (None, None, None)
+            else:
+                yield (query, hits, positions)
+
+
+def _describe(hits, best):
+    """Describe the best hits of a query as stored in best_hits
+
+    Parameters
+    ----------
+    hits : np.ndarray
+        Structured array with the hits of the query.
+    best : np.ndarray
+        Position of the best hit for each combination of thresholds, -1 if
+        there's none.
+
+    Returns
+    -------
+    list of dict or None
+        The description of the best hit for each combination of thresholds.
+        Combinations that select the same hit share the same dictionary.
+    """
+    best = best.tolist()
+    found = {}
+    for i in set(best):
+        if i >= 0:
+            _, subject, percent_id, aln_length, evalue, bitscore = \
+                hits[i].item()
+            found[i] = {'subject_id': subject,
+                        'percentage_id': percent_id,
+                        'bit_score': bitscore,
+                        'alg_length': aln_length,
+                        'evalue': evalue}
+    return [found.get(i) for i in best]
+
+
+def _new_values(hits, best):
+    """Create the best_hits entry of a query in the first database"""
+    return [{'a': a, 'b': {'subject_id': None, 'bit_score': -1}} if a else None
+            for a in _describe(hits, best)]
+
+
+def _update_values(values, hits, best):
+    """Add the best hits of a query in the second database to its entry"""
+    for value, b in izip(values, _describe(hits, best)):
+        if value and b:
+            value['b'] = b
+
+
+# row of the table of hits in BestHits, the subject is a code in the list of
+# subject identifiers
+_best_hit_dtype = np.dtype([('subject', np.int32),
+                            ('percentage_id', float),
+                            ('alg_length', np.int64),
+                            ('evalue', float),
+                            ('bit_score', float)])
+
+
+class BestHits(Mapping):
+    """Best hits of each query for every combination of thresholds
+
+    Parameters
+    ----------
+    combinations : int
+        Number of combinations of percentage identity and alignment length.
+    arrays : dict of np.ndarray, optional
+        The arrays of a previous store as returned by as_arrays, for example
+        read with platypus.cache.read_arrays.
+
+    Attributes
+    ----------
+    queries : list of str
+        The query identifiers, in the order they were added.
+    subjects : list of str
+        The subject identifiers, the hits reference them by position.
+    hits : np.ndarray
+        Structured array with the hits that are the best for some query and
+        combination, with the fields subject, percentage_id, alg_length,
+        evalue and bit_score.
+    first, second : np.ndarray
+        Arrays of shape (len(queries), combinations) with the position in
+        hits of the best hit in the first and second databases, -1 if
+        there's none.
+
+    Notes
+    -----
+    Each query costs a few bytes per combination instead of the
+    dictionaries previously returned by parse_first_database. For
+    compatibility, best_hits[query] returns that list of dictionaries (None
+    for the combinations without a hit in the first database), built on
+    demand; changing it doesn't change the store.
+    """
+
+    def __init__(self, combinations, arrays=None):
+        self.combinations = combinations
+        self.queries = []
+        self.subjects = []
+        self._index = {}
+        self._subject_index = {}
+        self._chunks = {'hits': [], 'first': [], 'second': []}
+        self._hits = np.empty(0, dtype=_best_hit_dtype)
+        self._first = np.empty((0, combinations), dtype=np.int32)
+        self._second = np.empty((0, combinations), dtype=np.int32)
+        self._replaced = False
+
+        if arrays is not None:
+            self.queries = arrays['queries'].tolist()
+            self.subjects = arrays['subjects'].tolist()
+            self._index = {query: i for i, query in enumerate(self.queries)}
+            self._subject_index = {subject: i for i, subject in
+                                   enumerate(self.subjects)}
+            self._hits = np.array(arrays['hits'], dtype=_best_hit_dtype)
+            self._first = np.array(arrays['first'], dtype=np.int32).reshape(
+                -1, combinations)
+            self._second = np.array(arrays['second'],
+                                    dtype=np.int32).reshape(-1, combinations)
+
+    def _store_hits(self, hits, best):
+        """Add the hits selected in best to the table, return their rows"""
+        used = np.unique(best[best >= 0])
+        rows = np.full(best.shape, -1, dtype=np.int32)
+        if not len(used):
+            return rows
+
+        selected = hits[used]
+        table = np.empty(len(used), dtype=_best_hit_dtype)
+        table['subject'] = [self._subject_code(subject) for subject in
+                            selected['subject'].tolist()]
+        table['percentage_id'] = selected['percent_id']
+        table['alg_length'] = selected['aln_length']
+        table['evalue'] = selected['evalue']
+        table['bit_score'] = selected['bitscore']
+
+        rows[best >= 0] = (len(self._hits) + self._pending_hits() +
+                           np.searchsorted(used, best[best >= 0]))
+        self._chunks['hits'].append(table)
+        return rows
+
+    def _pending_hits(self):
+        return sum(len(chunk) for chunk in self._chunks['hits'])
+
+    def _subject_code(self, subject):
+        code = self._subject_index.get(subject)
+        if code is None:
+            code = self._subject_index[subject] = len(self.subjects)
+            self.subjects.append(subject)
+        return code
+
+    def add_first(self, queries, hits, best):
+        """Add the best hits in the first database of a batch of queries
+
+        Parameters
+        ----------
+        queries : list of str
+            The query identifiers, None for records without hits which are
+            ignored.
+        hits : np.ndarray
+            Structured array with the hits of all the queries, see m9_dtype.
+        best : np.ndarray
+            Position in hits of the best hit of each query for each
+            combination, -1 if none.
+        """
+        keep = [i for i, query in enumerate(queries) if query is not None]
+        rows = self._store_hits(hits, best[keep])
+        for i in keep:
+            query = queries[i]
+            # the last record of a query replaces any previous one
+            if query in self._index:
+                self._replaced = True
+            self._index[query] = len(self.queries)
+            self.queries.append(query)
+
+        self._chunks['first'].append(rows)
+        self._chunks['second'].append(np.full(rows.shape, -1,
+                                              dtype=np.int32))
+
+    def add_second(self, queries, hits, best):
+        """Add the best hits in the second database of a batch of queries
+
+        Parameters
+        ----------
+        queries : list of str
+            The query identifiers, the ones that were not added with
+            add_first are ignored.
+        hits : np.ndarray
+            Structured array with the hits of all the queries, see m9_dtype.
+        best : np.ndarray
+            Position in hits of the best hit of each query for each
+            combination, -1 if none.
+        """
+        keep = [i for i, query in enumerate(queries) if query in self]
+        if not keep:
+            return
+        rows = self._store_hits(hits, best[keep])
+
+        # the table of hits keeps growing, only the queries are joined
+        self._consolidate(('first', 'second'))
+        positions = np.array([self._index[queries[i]] for i in keep])
+        second = self._second
+        # a query can be found more than once in a batch when its lines are
+        # interleaved with others, the last fragment with a hit wins as if
+        # they were added one after the other
+        for combination in range(rows.shape[1]):
+            found = np.flatnonzero(rows[:, combination] >= 0)[::-1]
+            _, last = np.unique(positions[found], return_index=True)
+            found = found[last]
+            second[positions[found], combination] = rows[found, combination]
+
+    def _consolidate(self, names=('hits', 'first', 'second')):
+        """Join the chunks added since the last call"""
+        for name in names:
+            chunks = self._chunks[name]
+            if chunks:
+                current = getattr(self, '_' + name)
+                setattr(self, '_' + name, np.concatenate([current] + chunks))
+                self._chunks[name] = []
+
+        if self._replaced and 'first' in names:
+            live = [i for i, query in enumerate(self.queries)
+                    if self._index[query] == i]
+            self.queries = [self.queries[i] for i in live]
+            self._index = {query: i for i, query in enumerate(self.queries)}
+            self._first = self._first[live]
+            self._second = self._second[live]
+            self._replaced = False
+
+    def update(self, other):
+        """Add the best hits of another store with the same combinations
+
+        Parameters
+        ----------
+        other : BestHits
+            The store whose queries are added.
+
+        Notes
+        -----
+        The queries that are only in other are added after the current
+        ones. For the queries in both, each combination keeps the hit with
+        the highest bit score in each database, the current one if they
+        tie, as if the hits of other were found after the current ones.
+        """
+        self._consolidate()
+        table = other.hits.copy()
+        codes = np.array([self._subject_code(subject) for subject in
+                          other.subjects], dtype=np.int32)
+        table['subject'] = codes[table['subject']]
+        offset = len(self._hits)
+        self._hits = np.concatenate([self._hits, table])
+        first = np.where(other.first >= 0, other.first + offset, -1)
+        second = np.where(other.second >= 0, other.second + offset, -1)
+
+        known = np.array([self._index.get(query, -1) for query in
+                          other.queries], dtype=int)
+        found = known >= 0
+        if found.any():
+            # -1 selects the last score, lower than any hit
+            scores = np.append(self._hits['bit_score'], -np.inf)
+            rows = known[found]
+            for current, new in ((self._first, first[found]),
+                                 (self._second, second[found])):
+                current[rows] = np.where(scores[new] > scores[current[rows]],
+                                         new, current[rows])
+
+        added = np.flatnonzero(~found)
+        for i in added.tolist():
+            self._index[other.queries[i]] = len(self.queries)
+            self.queries.append(other.queries[i])
+        self._first = np.concatenate([self._first, first[added]])
+        self._second = np.concatenate([self._second, second[added]])
+
+    def as_arrays(self):
+        """The arrays of the store, sorted by query
+
+        Returns
+        -------
+        dict of np.ndarray
+            The queries, subjects, hits, first and second arrays with the
+            queries in sorted order and only the hits they use. They can be
+            stored with platypus.cache.write_arrays and read back with
+            BestHits(combinations, arrays).
+        """
+        self._consolidate()
+        queries = np.array(self.queries, dtype=str)
+        order = np.argsort(queries, kind='mergesort')
+        first, second = self._first[order], self._second[order]
+
+        used = np.unique(np.concatenate([first.ravel(), second.ravel()]))
+        used = used[used >= 0]
+        rows = np.full(len(self._hits) + 1, -1, dtype=np.int32)
+        rows[used] = np.arange(len(used))
+        return {'queries': queries[order],
+                'subjects': np.array(self.subjects, dtype=str),
+                'hits': self._hits[used],
+                'first': rows[first], 'second': rows[second]}
+
+    @property
+    def hits(self):
+        self._consolidate()
+        return self._hits
+
+    @property
+    def first(self):
+        self._consolidate()
+        return self._first
+
+    @property
+    def second(self):
+        self._consolidate()
+        return self._second
+
+    def _describe(self, row):
+        """Dictionary of a row of hits, as created by parse_first_database"""
+        subject, percentage_id, alg_length, evalue, bit_score = \
+            self._hits[row].item()
+        return {'subject_id': self.subjects[subject],
+                'percentage_id': percentage_id,
+                'bit_score': bit_score,
+                'alg_length': alg_length,
+                'evalue': evalue}
+
+    def __getitem__(self, query):
+        self._consolidate()
+        i = self._index[query]
+        values = []
+        for a, b in izip(self._first[i].tolist(), self._second[i].tolist()):
+            if a < 0:
+                values.append(None)
+                continue
+            values.append({'a': self._describe(a),
+                           'b': self._describe(b) if b >= 0 else
+                           {'subject_id': None, 'bit_score': -1}})
+        return values
+
+    def __contains__(self, query):
+        return query in self._index
+
+    def __iter__(self):
+        self._consolidate()
+        return iter(self.queries)
+
+    def __len__(self):
+        return len(self._index)
+
+
+def _records(db, columnar, cache_dir, jobs, queries=None, stats=None,
+             unordered=False, group_memory=GROUP_MEMORY):
+    """Select the parser used for a database
+
+    Parameters
+    ----------
+    db : file-like object
+        The search results.
+    columnar : bool
+        Whether to use parse_m9_columnar, reducing the hits to Pareto fronts.
+    cache_dir : str or None
+        If not None, use parse_m9_cached with this directory.
+    jobs : int
+        Number of processes used by the columnar parser.
+    queries : container of str, optional
+        The only queries that are needed, the lines of the rest are skipped.
+        Not used when the records are cached, the cache keeps all of them.
+    stats : platypus.stats.Stats, optional
+        Counts the queries and hits read into the current stage.
+    unordered : bool, optional
+        Whether the hits of a query can be anywhere in db, see
+        group_records.
+    group_memory : int, optional
+        Memory used to group the records of unordered inputs.
+
+    Returns
+    -------
+    iterator of tuple
+        The records of db.
+    """
+    if cache_dir is not None:
+        records = parse_m9_cached(db, cache_dir, jobs)
+    elif columnar:
+        records = parse_m9_parallel(db, jobs, reduce=True, queries=queries)
+    else:
+        records = parse_m9(db, queries)
+
+    if unordered:
+        records = group_records(records, group_memory,
+                                reduce=columnar or cache_dir is not None)
+
+    if stats is not None:
+        records = stats.count_records(records)
+    return records
+
+
+def parse_first_database(db, percentage_ids, alignment_lengths,
+                         columnar=False, cache_dir=None, jobs=1, stats=None,
+                         unordered=False, group_memory=GROUP_MEMORY):
     """Find hits above a given threshold
 
     Parameters
@@ -98,13 +1423,32 @@ def parse_first_database(db, percentage_ids, alignment_lengths):
             Iterable with percentage ids
         alignment_lengths : iterable of ints
             Iterable with alignment length values
+        columnar : bool, optional
+            Whether to parse db with parse_m9_columnar instead of parse_m9,
+            defaults to False.
+        cache_dir : str, optional
+            Directory where the parsed db is cached, see parse_m9_cached.
+            Defaults to None, no caching.
+        jobs : int, optional
+            Number of processes used by the columnar parser, see
+            parse_m9_parallel. Defaults to 1.
+        stats : platypus.stats.Stats, optional
+            Counts the queries and hits read into its current stage.
+        unordered : bool, optional
+            Whether the hits of a query can be anywhere in db instead of one
+            after the other, for example in merged outputs. The records of
+            each query are joined with group_records. Defaults to False.
+        group_memory : int, optional
+            Bytes of hits kept in memory when `unordered`, the rest are
+            written to temporary files. Defaults to GROUP_MEMORY.
 
     Returns
     -------
         int
             total number of seqs in the db
-        dict
-            A dictionary of seqs and hits, of the form:
+        BestHits
+            The best hits of each query. For compatibility it can be used as
+            a dictionary of seqs and hits, of the form:
                 {'seq_id':
                     [{
                         'a': {'evalue':%f, 'percentageId':%f, 'bitScore':%f,
@@ -115,91 +1459,608 @@ def parse_first_database(db, percentage_ids, alignment_lengths):
                     ]
                 }
     """
-    # try blast parser object
-    results = parse_m9(db)
-
-    options = list(product(percentage_ids, alignment_lengths))
+    percentage_ids = list(percentage_ids)
+    alignment_lengths = list(alignment_lengths)
 
-    best_hits = {}
-    for total_queries, (query, hits) in enumerate(results, 1):
-        if query is None:
-            continue
+    # try blast parser object
+    results = _records(db, columnar, cache_dir, jobs, stats=stats,
+                       unordered=unordered, group_memory=group_memory)
 
-        best_hits[query] = []
-        for p, a in options:
-            # best bit score
-            bbs = 0
-            result = None
-
-            for h in hits:
-                valid = (h.percent_id >= p and h.aln_length >= a and
-                         h.bitscore > bbs)
-                if valid:
-                    result = {'a': {'subject_id': h.subject,
-                                    'percentage_id': h.percent_id,
-                                    'bit_score': h.bitscore,
-                                    'alg_length': h.aln_length,
-                                    'evalue': h.evalue},
-                              'b': {'subject_id': None,
-                                    'bit_score': -1}}
-                    bbs = h.bitscore
-            best_hits[query].append(result)
+    total_queries = 0
+    best_hits = BestHits(len(percentage_ids) * len(alignment_lengths))
+    for records, hits, _, best in _evaluated_batches(results, percentage_ids,
+                                                     alignment_lengths):
+        total_queries += len(records)
+        best_hits.add_first([query for query, _ in records], hits, best)
 
     return total_queries, best_hits
 
 
 def parse_second_database(db, best_hits, percentage_ids_other,
-                          alignment_lengths_other):
+                          alignment_lengths_other, columnar=False,
+                          cache_dir=None, jobs=1, stats=None,
+                          unordered=False, group_memory=GROUP_MEMORY):
     """Parses 2nd database, only looking at successful hits of the 1st db
 
     Parameters
     ----------
         db : str
             Filename of the blast results against a database without first
-        best_hits: dict
-            A dictionary with the successful results from parse_first_database
+        best_hits: BestHits or dict
+            The successful results from parse_first_database, or a dictionary
+            with the same contents
         percentage_ids : iterable
             Iterable with percentage id values
         alignment_lengths : iterable
             Iterable with with alignment length values
+        columnar : bool, optional
+            Whether to parse db with parse_m9_columnar instead of parse_m9,
+            defaults to False.
+        cache_dir : str, optional
+            Directory where the parsed db is cached, see parse_m9_cached.
+            Defaults to None, no caching.
+        jobs : int, optional
+            Number of processes used by the columnar parser, see
+            parse_m9_parallel. Defaults to 1.
+        stats : platypus.stats.Stats, optional
+            Counts the queries and hits read into its current stage.
+        unordered : bool, optional
+            Whether the hits of a query can be anywhere in db, see
+            parse_first_database. Defaults to False.
+        group_memory : int, optional
+            Bytes of hits kept in memory when `unordered`. Defaults to
+            GROUP_MEMORY.
 
     Notes
     -----
         There are no return values, the command modifies best_hits, mainly the
         'b' key.
     """
-    results = parse_m9(db)
+    # only the queries with hits in the first database are evaluated, the
+    # lines of the rest are skipped before they are converted
+    results = _records(db, columnar, cache_dir, jobs, best_hits, stats,
+                       unordered, group_memory)
+    results = ((query, hits) for query, hits in results
+               if query is not None and query in best_hits)
 
-    # create function to return results
-    for query, hits in results:
+    if isinstance(best_hits, BestHits):
+        for records, hits, _, best in _evaluated_batches(
+                results, percentage_ids_other, alignment_lengths_other):
+            best_hits.add_second([query for query, _ in records], hits, best)
+        return
+
+    results = _best_hits_in_batches(results, percentage_ids_other,
+                                    alignment_lengths_other)
+    for query, hits, best in results:
+        _update_values(best_hits[query], hits, best)
+
+
+def _check_sorted(records, name):
+    """Raise if the queries of the records are not strictly increasing"""
+    last = None
+    for query, hits in records:
+        if query is not None:
+            if last is not None and query <= last:
+                raise PlatypusParseError(
+                    "The queries in %s are not sorted, %s is found after %s"
+                    % (name, query, last))
+            last = query
+        yield (query, hits)
+
+
+def _join(records_a, records_b):
+    """Pair each record of the first database with the same query's hits in
+    the second database, _no_hits if there are none"""
+    records_b = ((query, hits) for query, hits in records_b
+                 if query is not None)
+    query_b, hits_b = next(records_b, (None, None))
+
+    for query, hits in records_a:
         if query is None:
+            yield (None, hits, None)
             continue
 
-        if query in best_hits:
-            values = product(percentage_ids_other, alignment_lengths_other)
-            for i, (p, a) in enumerate(values):
-                if not best_hits[query][i]:
-                    continue
-                # best bit score
-                bbs = 0
-                result = None
-                for h in hits:
-                    valid = (h.percent_id >= p and h.aln_length >= a and
-                             h.bitscore > bbs)
-                    if valid:
-                        result = {'subject_id': h.subject,
-                                  'percentage_id': h.percent_id,
-                                  'bit_score': h.bitscore,
-                                  'alg_length': h.aln_length,
-                                  'evalue': h.evalue}
-                        bbs = h.bitscore
-                if result:
-                    best_hits[query][i]['b'] = result
+        # the queries only found in the second database are skipped
+        while query_b is not None and query_b < query:
+            query_b, hits_b = next(records_b, (None, None))
+
+        yield (query, hits, hits_b if query_b == query else _no_hits)
+
+    # the remaining records are read to verify they are sorted, otherwise a
+    # query found out of order would be silently ignored
+    for _ in records_b:
+        pass
+
+
+class MergedDatabases(object):
+    """Best hits in both databases, computed in a single pass over each one
+
+    Parameters
+    ----------
+    db_a : file-like object
+        Search results against the database of interest.
+    db_b : file-like object
+        Search results against the other database.
+    percentage_ids, alignment_lengths : iterable of ints
+        Thresholds for the database of interest.
+    percentage_ids_other, alignment_lengths_other : iterable of ints
+        Thresholds for the other database.
+    columnar : bool, optional
+        Whether to parse with parse_m9_columnar instead of parse_m9, defaults
+        to False.
+    cache_dir : str, optional
+        Directory where the parsed databases are cached, see parse_m9_cached.
+        Defaults to None, no caching.
+    jobs : int, optional
+        Number of processes used by the columnar parser, see
+        parse_m9_parallel. Defaults to 1.
+    stats : platypus.stats.Stats, optional
+        Counts the queries and hits read into its current stage.
+
+    Attributes
+    ----------
+    total_queries : int
+        Number of records read from the database of interest so far.
+
+    Raises
+    ------
+    PlatypusParseError
+        While iterating, if the queries of either database are not sorted.
+
+    Notes
+    -----
+    Iterating yields (query, values) tuples where values is the same list
+    found in best_hits[query] after calling parse_first_database and
+    parse_second_database. The databases are read side by side, so only a
+    batch of queries is kept in memory regardless of the size of the inputs.
+    This requires both databases to be sorted by query identifier in byte
+    order (for example with `LC_ALL=C sort -s -t $'\\t' -k1,1` after
+    removing the comment lines); the order is checked as the files are read.
+    The instance can be iterated only once.
+    """
+
+    def __init__(self, db_a, db_b, percentage_ids, alignment_lengths,
+                 percentage_ids_other, alignment_lengths_other,
+                 columnar=False, cache_dir=None, jobs=1, stats=None):
+        records_a = _check_sorted(
+            _records(db_a, columnar, cache_dir, jobs, stats=stats),
+            getattr(db_a, 'name', 'the first database'))
+        records_b = _check_sorted(
+            _records(db_b, columnar, cache_dir, jobs, stats=stats),
+            getattr(db_b, 'name', 'the second database'))
+        joined_a, joined_b = tee(_join(records_a, records_b))
+
+        self._results_a = _best_hits_in_batches(
+            ((query, hits) for query, hits, _ in joined_a),
+            percentage_ids, alignment_lengths)
+        self._results_b = _best_hits_in_batches(
+            ((query, hits) for query, _, hits in joined_b),
+            percentage_ids_other, alignment_lengths_other)
+        self.total_queries = 0
+
+    def __iter__(self):
+        for (query, hits, best), (_, hits_b, best_b) in izip(self._results_a,
+                                                             self._results_b):
+            self.total_queries += 1
+            if query is None:
+                continue
+
+            values = _new_values(hits, best)
+            _update_values(values, hits_b, best_b)
+            yield (query, values)
+
+
+def _summarize_best_hits(best_hits, results):
+    """Helper of process_results that summarizes a BestHits instance
+
+    The same rules than process_results are applied to all the queries of
+    each combination at once, the lines are written in the order of the
+    queries.
+    """
+    names = [query.split(' ')[0].strip() for query in best_hits.queries]
+    subjects = best_hits.subjects
+    hits = best_hits.hits
+    # process_results treats empty subject identifiers as missing hits
+    empty = np.array([not subject for subject in subjects] + [True])
+    codes = np.append(hits['subject'], -1)
+    scores = np.append(hits['bit_score'], -1)
+
+    for i, result in enumerate(results):
+        first = best_hits.first[:, i]
+        second = best_hits.second[:, i]
+        rows = np.flatnonzero(first >= 0)
+        first, second = first[rows], second[rows]
+
+        score_a, score_b = scores[first], scores[second]
+        subject_a, subject_b = codes[first], codes[second]
+        equal = score_a == score_b
+        better = score_a > score_b
+        perfect = better & empty[subject_b]
+        other = ~equal & ~better
+
+        result['equal'] += int(equal.sum())
+        result['perfect_interest'] += int(perfect.sum())
+        result['db_other'] += int(other.sum())
+
+        lines = []
+        for row, a, b, kind in izip(rows.tolist(), subject_a.tolist(),
+                                    subject_b.tolist(),
+                                    (equal + 2 * perfect + 3 * other)):
+            if kind == 1:
+                lines.append('%s\t%s\t%s\n' % (names[row], subjects[a],
+                                               subjects[b] if b >= 0 else
+                                               None))
+            elif kind == 2:
+                lines.append('%s\t%s\t\n' % (names[row], subjects[a]))
+            elif kind == 3:
+                lines.append('%s\t\t\n' % names[row])
+        result['summary_fh'].writelines(lines)
+
+        db_seqs_counts_a = result['db_seqs_counts']['a']
+        if isinstance(db_seqs_counts_a, SubjectCounts):
+            db_seqs_counts_a.add_codes(subject_a[equal | better], subjects)
+        elif db_seqs_counts_a:
+            db_seqs_counts_a.writelines(
+                '%s\n' % subjects[a] for a in subject_a[equal | better])
+        db_seqs_counts_b = result['db_seqs_counts']['b']
+        if isinstance(db_seqs_counts_b, SubjectCounts):
+            db_seqs_counts_b.add_codes(subject_b[equal | other], subjects)
+        elif db_seqs_counts_b:
+            db_seqs_counts_b.writelines(
+                '%s\n' % (subjects[b] if b >= 0 else None)
+                for b in subject_b[equal | other])
+
+
+def _count_best_hits(best_hits, results):
+    """Helper of process_results that only counts the queries of BestHits
+
+    The queries are classified for all the combinations at once, in batches
+    of rows of about BATCH_CELLS cells.
+    """
+    # process_results treats empty subject identifiers as missing hits
+    empty = np.array([not subject for subject in best_hits.subjects] +
+                     [True])
+    codes = np.append(best_hits.hits['subject'], -1)
+    scores = np.append(best_hits.hits['bit_score'], -1)
+    first, second = best_hits.first, best_hits.second
+
+    equal = np.zeros(len(results), dtype=np.int64)
+    perfect = np.zeros(len(results), dtype=np.int64)
+    other = np.zeros(len(results), dtype=np.int64)
+    rows = max(1, BATCH_CELLS // max(1, len(results)))
+    for start in range(0, len(first), rows):
+        a = first[start:start + rows]
+        b = second[start:start + rows]
+        found = a >= 0
+        score_a, score_b = scores[a], scores[b]
+        same = found & (score_a == score_b)
+        better = found & (score_a > score_b)
+        equal += same.sum(axis=0)
+        perfect += (better & empty[codes[b]]).sum(axis=0)
+        other += (found & ~same & ~better).sum(axis=0)
+
+    for result, e, p, o in izip(results, equal.tolist(), perfect.tolist(),
+                                other.tolist()):
+        result['equal'] += e
+        result['perfect_interest'] += p
+        result['db_other'] += o
+
+
+def _count_values(best_hits, results):
+    """Helper of process_results that only counts the queries of the values
+
+    The same rules than process_results for (query, values) tuples, without
+    writing any line.
+    """
+    for _, values in best_hits:
+        for result, vals in izip(results, values):
+            if not vals:
+                continue
+            score_a = vals['a']['bit_score']
+            score_b = vals['b']['bit_score']
+            if score_a == score_b:
+                result['equal'] += 1
+            elif score_a > score_b:
+                if not vals['b']['subject_id']:
+                    result['perfect_interest'] += 1
+            else:
+                result['db_other'] += 1
+
+
+class SubjectCounts(object):
+    """Number of hits to each subject, written as a table when closed
+
+    Parameters
+    ----------
+    fp : str or file
+        Path of the table, or an open file where it's written.
+
+    Notes
+    -----
+    It can be used as the file of the hits to a database in
+    process_results: each line written is a subject identifier that is
+    counted, instead of written. The table has a subject and its count per
+    line, sorted by decreasing count and then by subject, like the output
+    of `sort | uniq -c | sort -rn` over the lines.
+    """
+
+    def __init__(self, fp):
+        self._fp = fp
+        self.name = fp if isinstance(fp, basestring) else fp.name
+        self.counts = {}
+
+    def write(self, line):
+        subject = line.rstrip('\n')
+        self.counts[subject] = self.counts.get(subject, 0) + 1
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def add_codes(self, codes, subjects):
+        """Count hits given as positions in a list of subjects
+
+        Parameters
+        ----------
+        codes : np.ndarray of int
+            Position of the subject of each hit, negative for missing hits
+            that are counted as None.
+        subjects : list of str
+            The subject identifiers.
+        """
+        counts = self.counts
+        missing = int((codes < 0).sum())
+        if missing:
+            counts['None'] = counts.get('None', 0) + missing
+
+        found = np.bincount(codes[codes >= 0], minlength=len(subjects))
+        for code in np.flatnonzero(found).tolist():
+            subject = subjects[code]
+            counts[subject] = counts.get(subject, 0) + int(found[code])
+
+    def close(self):
+        """Write the table"""
+        f = open(self._fp, 'w') if isinstance(self._fp, basestring) else \
+            self._fp
+        with f:
+            f.write('#Subject\tCount\n')
+            f.writelines('%s\t%d\n' % (subject, count) for subject, count in
+                         sorted(self.counts.items(),
+                                key=lambda item: (-item[1], item[0])))
+
+
+class ConsolidatedOutput(object):
+    """The outputs of all the combinations of thresholds in a single table
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory where the table and its index are written.
+    compress : bool, optional
+        Compress the table with gzip.
+    chunk_size : int, optional
+        Bytes of the lines of an output kept in memory before they are
+        written.
+    buffer_size : int, optional
+        Bytes of the lines of all the outputs kept in memory before they are
+        written.
+
+    Attributes
+    ----------
+    name : str
+        Path of the table.
+
+    Notes
+    -----
+    Each line of the table has the position of the combination of
+    thresholds, the name of the output and a line of the file that
+    process_results would write for that combination, for example:
+    `3<tab>summary<tab>query_1<tab>subject_a<tab>subject_b`. The lines
+    of each output are kept in memory and written in chunks of at least
+    `chunk_size` bytes (or when `buffer_size` bytes are kept), so a single
+    file is open regardless of the number of combinations.
+
+    The index, CONSOLIDATED_INDEX_FN, has the combination, file name,
+    output, offset, length and number of lines of every chunk, in the order
+    of the lines of each output, see read_consolidated. When compressed,
+    each chunk is a gzip member of its own, so the table can be read with
+    `zcat` and each chunk can be decompressed without reading the others.
+    """
+
+    def __init__(self, output_dir, compress=False, chunk_size=CHUNK_SIZE,
+                 buffer_size=BUFFER_SIZE):
+        self.name = join(output_dir,
+                         CONSOLIDATED_FN + ('.gz' if compress else ''))
+        self._index_fp = join(output_dir, CONSOLIDATED_INDEX_FN)
+        self._compress = compress
+        self._chunk_size = chunk_size
+        self._buffer_size = buffer_size
+        self._fh = open(self.name, 'wb')
+        self._offset = 0
+        self._buffers = OrderedDict()
+        self._buffered = 0
+        self._chunks = []
+        self._write('#Combination\tOutput\tLine\n')
+
+    def output(self, combination, filename, output):
+        """File-like object for the lines of an output of a combination
+
+        Parameters
+        ----------
+        combination : int
+            Position of the combination of thresholds.
+        filename : str
+            Name of the combination, as in the outputs of process_results.
+        output : str
+            Name of the output, for example `summary`.
+
+        Returns
+        -------
+        file-like
+            An object with write, writelines and close methods.
+        """
+        key = (combination, filename, output)
+        self._buffers[key] = [[], 0, 0]
+        return _ConsolidatedFile(self, key)
+
+    def _add(self, key, lines):
+        prefix = '%d\t%s\t' % (key[0], key[2])
+        lines = [prefix + line for line in lines]
+        size = sum(len(line) for line in lines)
+        buf = self._buffers[key]
+        buf[0].extend(lines)
+        buf[1] += size
+        buf[2] += len(lines)
+        self._buffered += size
+
+        if buf[1] >= self._chunk_size:
+            self._flush(key)
+        elif self._buffered >= self._buffer_size:
+            for other in self._buffers:
+                self._flush(other)
+
+    def _flush(self, key):
+        lines, size, count = self._buffers[key]
+        if not count:
+            return
+        self._buffers[key] = [[], 0, 0]
+        self._buffered -= size
+        offset = self._offset
+        self._write(''.join(lines))
+        self._chunks.append(key + (offset, self._offset - offset, count))
+
+    def _write(self, data):
+        if self._compress:
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+        self._fh.write(data)
+        self._offset += len(data)
+
+    def close(self):
+        """Write the lines left and the index"""
+        keys = sorted(self._buffers)
+        for key in keys:
+            self._flush(key)
+        self._fh.close()
+
+        # outputs without lines are in the index too, with an empty chunk
+        chunks = self._chunks + [key + (0, 0, 0) for key in keys]
+        chunks.sort(key=lambda chunk: chunk[:3])
+        with open(self._index_fp, 'w') as f:
+            f.write('#Table\t%s\n' % basename(self.name))
+            f.write('#Combination\tFilename\tOutput\tOffset\tLength\t'
+                    'Lines\n')
+            f.writelines('%d\t%s\t%s\t%d\t%d\t%d\n' % chunk
+                         for chunk in chunks)
+
+
+class _ConsolidatedFile(object):
+    """Helper of ConsolidatedOutput, an output of a combination"""
+
+    def __init__(self, table, key):
+        self._table = table
+        self._key = key
+        self.name = table.name
+
+    def write(self, line):
+        self._table._add(self._key, [line])
+
+    def writelines(self, lines):
+        self._table._add(self._key, list(lines))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_consolidated(output_dir, combination, output):
+    """Read an output of a combination from a consolidated table
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory with the table and the index written by
+        ConsolidatedOutput.
+    combination : int or str
+        Position or name of the combination of thresholds, for example
+        `p1_70-a1_50_p2_70-a2_50`.
+    output : str
+        Name of the output, for example `summary` or `hits_to_first_db`.
+
+    Returns
+    -------
+    iterator of str
+        The lines of the output, the same as the lines of the file that
+        process_results writes without `consolidated`.
+
+    Raises
+    ------
+    PlatypusValueError
+        If the output of the combination is not in the table.
+    """
+    with open(join(output_dir, CONSOLIDATED_INDEX_FN)) as f:
+        table_fp = join(output_dir, f.readline().rstrip('\n').split('\t')[1])
+        chunks = []
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if ((fields[0] == str(combination) or fields[1] == combination)
+                    and fields[2] == output):
+                chunks.append((int(fields[3]), int(fields[4])))
+    if not chunks:
+        raise PlatypusValueError("There is no %s output for %s in %s." %
+                                 (output, combination, output_dir))
+    return _read_chunks(table_fp, chunks)
+
+
+def _read_chunks(fp, chunks):
+    """Helper of read_consolidated, the lines of the chunks of an output"""
+    compressed = fp.endswith('.gz')
+    with open(fp, 'rb') as f:
+        for offset, length in chunks:
+            if not length:
+                continue
+            f.seek(offset)
+            data = f.read(length)
+            if compressed:
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            for line in data.splitlines(True):
+                yield line.split('\t', 2)[2]
+
+
+def _combination_names(percentage_ids, alignment_lengths,
+                       percentage_ids_other, alignment_lengths_other):
+    """Helper of process_results, the name of each combination"""
+    iter_a = product(percentage_ids, alignment_lengths)
+    iter_b = product(percentage_ids_other, alignment_lengths_other)
+    return ["p1_%d-a1_%d_p2_%d-a2_%d" % (perc_id_a, aln_len_a, perc_id_b,
+                                         aln_len_b)
+            for (perc_id_a, aln_len_a), (perc_id_b, aln_len_b) in
+            izip(iter_a, iter_b)]
+
+
+def _open_output(output_dir, table, combination, fn, name, counts=False):
+    """Helper of process_results, the file of an output of a combination"""
+    if table is not None:
+        fh = table.output(combination, fn, name)
+    else:
+        fh = join(output_dir, name + '_' + fn + '.txt')
+        if not counts:
+            fh = open(fh, 'w')
+    return SubjectCounts(fh) if counts else fh
 
 
 def process_results(percentage_ids, alignment_lengths, percentage_ids_other,
                     alignment_lengths_other, best_hits, output_dir,
-                    hits_to_first, hits_to_second):
+                    hits_to_first, hits_to_second, hit_counts=False,
+                    consolidated=False, compress=False, counts_only=False):
     """Format the results into a summary dictionary
 
     Parameters
@@ -216,8 +2077,9 @@ def process_results(percentage_ids, alignment_lengths, percentage_ids_other,
     alignment_lengths_other : iterable of ints
         An iterable of ints with the alignment lengths for the 'other'
         database.
-    best_hits : dict
-        A dictionary with the best hits found in the databases.
+    best_hits : dict or iterable of tuple
+        A dictionary with the best hits found in the databases, or an
+        iterable of (query, values) tuples like MergedDatabases.
     output_dir : str
         File path to the output directory.
     hits_to_first : bool
@@ -226,29 +2088,51 @@ def process_results(percentage_ids, alignment_lengths, percentage_ids_other,
     hits_to_second : bool
         Outputs all the labels of the sequences being hit in the second
         database.
+    hit_counts : bool, optional
+        Instead of writing the label of the sequence hit by each query,
+        write the number of queries that hit each sequence. The tables are
+        written to `hit_counts_first_db_*.txt` and
+        `hit_counts_second_db_*.txt`, see SubjectCounts.
+    consolidated : bool, optional
+        Write the outputs of all the combinations to a single table with an
+        index instead of a set of files per combination, see
+        ConsolidatedOutput and read_consolidated.
+    compress : bool, optional
+        With `consolidated`, compress the table with gzip.
+    counts_only : bool, optional
+        Only count the queries of each category, no file is written and the
+        `summary_fh` and `db_seqs_counts` of the results are None.
 
     Returns
     -------
     list of dicts
         List of dictionaries with the summarized results.
     """
+    names = _combination_names(percentage_ids, alignment_lengths,
+                               percentage_ids_other, alignment_lengths_other)
+    if counts_only:
+        results = [{'filename': fn, 'db_interest': 0, 'db_other': 0,
+                    'perfect_interest': 0, 'equal': 0, 'summary_fh': None,
+                    'db_seqs_counts': {'a': None, 'b': None}}
+                   for fn in names]
+        if isinstance(best_hits, BestHits):
+            _count_best_hits(best_hits, results)
+        else:
+            if isinstance(best_hits, Mapping):
+                best_hits = best_hits.iteritems()
+            _count_values(best_hits, results)
+        return results
+
     results = []
     summary_fh = {}
+    table = ConsolidatedOutput(output_dir, compress) if consolidated else None
 
-    iter_a = product(percentage_ids, alignment_lengths)
-    iter_b = product(percentage_ids_other, alignment_lengths_other)
-
-    for (perc_id_a, aln_len_a), (perc_id_b, aln_len_b) in izip(iter_a, iter_b):
-        # basic filename for each combination of options
-        fn = "p1_%d-a1_%d_p2_%d-a2_%d" % (perc_id_a, aln_len_a,
-                                          perc_id_b, aln_len_b)
-        # filename, handler and header for the summary results
-        summary_fn = join(output_dir, "summary_" + fn + ".txt")
-        summary_fh = open(summary_fn, 'w')
+    for i, fn in enumerate(names):
+        # handler and header for the summary results
+        summary_fh = _open_output(output_dir, table, i, fn, 'summary')
         summary_fh.write('#SeqId\tFirst\tSecond\n')
-        # filename for the hits to first/second databases
-        hits_to_first_fn = join(output_dir, "hits_to_first_db_%s.txt" % fn)
-        hits_to_second_fn = join(output_dir, "hits_to_second_db_%s.txt" % fn)
+        # names of the outputs of the hits to first/second databases
+        prefix = 'hit_counts_%s_db' if hit_counts else 'hits_to_%s_db'
         # generating basic element
         tmp = {'filename': fn,
                'db_interest': 0,
@@ -258,12 +2142,20 @@ def process_results(percentage_ids, alignment_lengths, percentage_ids_other,
                'summary_fh': summary_fh,
                'db_seqs_counts': {'a': None, 'b': None}}
         if hits_to_first:
-            tmp['db_seqs_counts']['a'] = open(hits_to_first_fn, 'w')
+            tmp['db_seqs_counts']['a'] = _open_output(
+                output_dir, table, i, fn, prefix % 'first', hit_counts)
         if hits_to_second:
-            tmp['db_seqs_counts']['b'] = open(hits_to_second_fn, 'w')
+            tmp['db_seqs_counts']['b'] = _open_output(
+                output_dir, table, i, fn, prefix % 'second', hit_counts)
         results.append(tmp)
 
-    for seq_name, values in best_hits.items():
+    if isinstance(best_hits, BestHits):
+        _summarize_best_hits(best_hits, results)
+        best_hits = []
+    elif isinstance(best_hits, Mapping):
+        best_hits = best_hits.iteritems()
+
+    for seq_name, values in best_hits:
         seq_name = seq_name.split(' ')[0].strip()
         for i, vals in enumerate(values):
             if not vals:
@@ -302,5 +2194,7 @@ def process_results(percentage_ids, alignment_lengths, percentage_ids_other,
             r['db_seqs_counts']['a'].close()
         if r['db_seqs_counts']['b']:
             r['db_seqs_counts']['b'].close()
+    if table is not None:
+        table.close()
 
     return results
@@ -0,0 +1,555 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import division
+
+from os import stat
+from os.path import abspath, basename, isfile, join
+from stat import S_ISREG
+
+import numpy as np
+
+from platypus.cache import read_arrays, write_arrays
+from platypus.compare import PlatypusParseError, PlatypusValueError
+from platypus.parse import BestHits, SubjectCounts, _combination_names
+from platypus.util import create_dir
+
+# file with the counts and the subject tallies in the state directory, and
+# files with the best hits of each batch
+STATE_FN = 'state.arrays'
+BATCH_FN = 'batch-%d.arrays'
+
+# rows of CompareState.counts
+CATEGORIES = ('equal', 'perfect_interest', 'db_other')
+
+# prefix of the hit count tables of each database
+_TABLES = {'a': 'hit_counts_first_db', 'b': 'hit_counts_second_db'}
+
+
+def _no_tallies():
+    return {'combination': np.empty(0, dtype=np.int32),
+            'subject': np.empty(0, dtype='S1'),
+            'count': np.empty(0, dtype=np.int64)}
+
+
+def sum_tallies(tallies, signs=None):
+    """Add the subject tallies of several sets of queries
+
+    Parameters
+    ----------
+    tallies : list of dict
+        Tallies as returned by tally_best_hits.
+    signs : list of int, optional
+        Multiplies the counts of each of the tallies, -1 removes them.
+        Defaults to adding all of them.
+
+    Returns
+    -------
+    dict of np.ndarray
+        The combination, subject and count of every pair of combination and
+        subject with a count other than zero, sorted by combination and
+        subject.
+    """
+    if signs is None:
+        signs = [1] * len(tallies)
+    combination = np.concatenate([t['combination'] for t in tallies])
+    subject = np.concatenate([t['subject'] for t in tallies])
+    count = np.concatenate([t['count'] * sign for t, sign in
+                            zip(tallies, signs)])
+    if not len(count):
+        return _no_tallies()
+
+    order = np.lexsort((subject, combination))
+    combination, subject, count = (combination[order], subject[order],
+                                   count[order])
+    starts = np.flatnonzero(np.append(True, (combination[1:] !=
+                                             combination[:-1]) |
+                                      (subject[1:] != subject[:-1])))
+    count = np.add.reduceat(count, starts)
+    keep = count != 0
+    return {'combination': combination[starts][keep],
+            'subject': subject[starts][keep],
+            'count': count[keep]}
+
+
+def tally_best_hits(best_hits):
+    """Count the queries of each category and the hits to each subject
+
+    Parameters
+    ----------
+    best_hits : platypus.parse.BestHits
+        The best hits of the queries.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (len(CATEGORIES), combinations) with the number of
+        queries of each category for each combination of thresholds.
+    dict of dict
+        The tallies of the first (`a`) and second (`b`) databases, with the
+        combination, subject and count of every pair of combination and
+        subject, as the hit count tables of process_results.
+    """
+    combinations = best_hits.combinations
+    # process_results treats empty subject identifiers as missing hits, and
+    # counts the missing hits of the second database as None
+    subjects = np.array(best_hits.subjects + ['None'], dtype=str)
+    empty = np.array([not subject for subject in best_hits.subjects] +
+                     [True])
+    codes = np.append(best_hits.hits['subject'], len(subjects) - 1)
+    scores = np.append(best_hits.hits['bit_score'], -1)
+
+    counts = np.zeros((len(CATEGORIES), combinations), dtype=np.int64)
+    pieces = {'a': [], 'b': []}
+    for i in range(combinations):
+        first = best_hits.first[:, i]
+        second = best_hits.second[:, i]
+        found = first >= 0
+        first, second = first[found], second[found]
+
+        score_a, score_b = scores[first], scores[second]
+        subject_a, subject_b = codes[first], codes[second]
+        equal = score_a == score_b
+        better = score_a > score_b
+        other = ~equal & ~better
+        counts[:, i] = (equal.sum(), (better & empty[subject_b]).sum(),
+                        other.sum())
+
+        for db, hits in (('a', subject_a[equal | better]),
+                         ('b', subject_b[equal | other])):
+            tallied = np.bincount(hits, minlength=len(subjects))
+            used = np.flatnonzero(tallied)
+            pieces[db].append({
+                'combination': np.full(len(used), i, dtype=np.int32),
+                'subject': subjects[used],
+                'count': tallied[used].astype(np.int64)})
+
+    return counts, {db: sum_tallies(pieces[db]) for db in pieces}
+
+
+def _lookup(stored, queries):
+    """Position of each query in a sorted array of queries, -1 if missing"""
+    positions = np.full(len(queries), -1, dtype=int)
+    if not len(stored) or not len(queries):
+        return positions
+    # longer identifiers would be truncated to the width of stored
+    fits = np.flatnonzero(np.char.str_len(queries) <=
+                          stored.dtype.itemsize)
+    candidates = queries[fits].astype(stored.dtype)
+    found = np.minimum(np.searchsorted(stored, candidates), len(stored) - 1)
+    match = stored[found] == candidates
+    positions[fits[match]] = found[match]
+    return positions
+
+
+def _subset(arrays, rows):
+    """The arrays of a BestHits with the queries in rows and their hits"""
+    first, second = arrays['first'][rows], arrays['second'][rows]
+    used = np.unique(np.concatenate([first.ravel(), second.ravel()]))
+    used = used[used >= 0]
+    hits = np.array(arrays['hits'][used])
+    codes = np.unique(hits['subject'])
+    hits['subject'] = np.searchsorted(codes, hits['subject'])
+    return {'queries': arrays['queries'][rows],
+            'subjects': arrays['subjects'][codes],
+            'hits': hits,
+            'first': np.where(first >= 0, np.searchsorted(used, first), -1),
+            'second': np.where(second >= 0, np.searchsorted(used, second),
+                               -1)}
+
+
+def _source(fp):
+    """Path, size and modification time of a regular file, None otherwise"""
+    try:
+        info = stat(fp)
+    except (OSError, TypeError):
+        return None
+    if not S_ISREG(info.st_mode):
+        return None
+    return [abspath(fp), info.st_size, info.st_mtime]
+
+
+class CompareSummary(object):
+    """Counts and subject tallies of a set of queries, mergeable with others
+
+    Parameters
+    ----------
+    percentage_ids, alignment_lengths : list of int
+        Thresholds of the database of interest.
+    percentage_ids_other, alignment_lengths_other : list of int
+        Thresholds of the other database.
+    tallies : bool, optional
+        Whether to keep the subject tallies, they are needed to write the hit
+        count tables.
+
+    Attributes
+    ----------
+    names : list of str
+        Name of each combination of thresholds, as in process_results.
+    total_queries : int
+        Number of queries, as counted by parse_first_database.
+    counts : np.ndarray
+        Array of shape (len(CATEGORIES), combinations) with the number of
+        queries of each category.
+    tallies : dict of dict or None
+        Tallies of the subjects of the first (`a`) and second (`b`)
+        databases, see tally_best_hits. None if they are not kept.
+    sources : dict of list
+        Names of the files of the database of interest (`interest`) and of
+        the other database (`other`) the queries were read from.
+
+    Notes
+    -----
+    A summary is all compile_output.txt needs, so the queries can be split
+    in shards compared by different nodes, each writing its summary with
+    write, and the summaries merged with update. The shards are expected to
+    have different queries, a query in several shards is counted once for
+    each of them.
+    """
+
+    def __init__(self, percentage_ids, alignment_lengths,
+                 percentage_ids_other, alignment_lengths_other, tallies=True):
+        self.thresholds = [[float(value) for value in values] for values in
+                           (percentage_ids, alignment_lengths,
+                            percentage_ids_other, alignment_lengths_other)]
+        self.names = _combination_names(*self.thresholds)
+        self.total_queries = 0
+        self.counts = np.zeros((len(CATEGORIES), len(self.names)),
+                               dtype=np.int64)
+        self.tallies = ({'a': _no_tallies(), 'b': _no_tallies()} if tallies
+                        else None)
+        self.sources = {'interest': [], 'other': []}
+
+    def add(self, best_hits, total_queries):
+        """Add the best hits of queries that are not in the summary yet
+
+        Parameters
+        ----------
+        best_hits : platypus.parse.BestHits
+            The best hits of the queries in both databases.
+        total_queries : int
+            Number of queries, as returned by parse_first_database.
+        """
+        counts, tallies = tally_best_hits(best_hits)
+        self.counts += counts
+        self.total_queries += total_queries
+        if self.tallies is not None:
+            self.tallies = {db: sum_tallies([self.tallies[db], tallies[db]])
+                            for db in self.tallies}
+
+    def add_results(self, results, total_queries):
+        """Add the counts of the results of process_results
+
+        Parameters
+        ----------
+        results : list of dict
+            The results of process_results of queries that are not in the
+            summary yet, for example of MergedDatabases.
+        total_queries : int
+            Number of queries of the results.
+
+        Notes
+        -----
+        The results don't have the subject tallies, so they are dropped.
+        """
+        self.counts += [[result[category] for result in results]
+                        for category in CATEGORIES]
+        self.total_queries += total_queries
+        self.tallies = None
+
+    def update(self, other):
+        """Add the counts and tallies of the queries of another summary
+
+        Parameters
+        ----------
+        other : CompareSummary
+            Summary of other queries with the same thresholds. If it has no
+            tallies, the tallies of this summary are dropped.
+
+        Raises
+        ------
+        PlatypusValueError
+            If the thresholds of both summaries are not the same.
+        """
+        if other.thresholds != self.thresholds:
+            raise PlatypusValueError(
+                "The thresholds of the summaries are not the same: %s - %s" %
+                (self.thresholds, other.thresholds))
+        self.counts += other.counts
+        self.total_queries += other.total_queries
+        if self.tallies is None or other.tallies is None:
+            self.tallies = None
+        else:
+            self.tallies = {db: sum_tallies([self.tallies[db],
+                                             other.tallies[db]])
+                            for db in self.tallies}
+        for db, names in other.sources.items():
+            self.sources[db].extend(names)
+
+    def write(self, fp):
+        """Write the summary to a file that can be read with read"""
+        write_arrays(fp, self._arrays(), self._metadata())
+
+    @classmethod
+    def read(cls, fp):
+        """Read a summary written with write
+
+        Parameters
+        ----------
+        fp : str
+            Path of the file.
+
+        Returns
+        -------
+        CompareSummary
+            The summary.
+
+        Raises
+        ------
+        PlatypusParseError
+            If the file is not a summary or it's corrupted.
+        """
+        arrays, metadata = read_arrays(fp)
+        if 'thresholds' not in metadata or 'counts' not in arrays:
+            raise PlatypusParseError("%s is not a summary of compare" % fp)
+        summary = cls(*metadata['thresholds'],
+                      tallies='tally_a_count' in arrays)
+        summary._load(arrays, metadata)
+        return summary
+
+    def _arrays(self):
+        arrays = {'counts': self.counts}
+        for db, tallies in (self.tallies or {}).items():
+            for field, values in tallies.items():
+                arrays['tally_%s_%s' % (db, field)] = values
+        return arrays
+
+    def _metadata(self):
+        return {'thresholds': self.thresholds,
+                'total_queries': self.total_queries,
+                'sources': self.sources}
+
+    def _load(self, arrays, metadata):
+        self.total_queries = metadata['total_queries']
+        self.sources = {db: [str(name) for name in names] for db, names in
+                        metadata.get('sources', self.sources).items()}
+        self.counts = np.array(arrays['counts'])
+        if self.tallies is not None:
+            self.tallies = {db: {field: np.array(arrays['tally_%s_%s' %
+                                                        (db, field)])
+                                 for field in ('combination', 'subject',
+                                               'count')}
+                            for db in self.tallies}
+
+    def results(self):
+        """The counts of each combination, as the results of process_results
+
+        Returns
+        -------
+        list of dict
+            The filename and the number of queries of each category of each
+            combination of thresholds.
+        """
+        results = []
+        for i, fn in enumerate(self.names):
+            result = {'filename': fn, 'db_interest': 0}
+            for category, counts in zip(CATEGORIES, self.counts.tolist()):
+                result[category] = counts[i]
+            results.append(result)
+        return results
+
+    def write_hit_counts(self, output_dir, first=True, second=True):
+        """Write the hit count tables of the subject tallies
+
+        Parameters
+        ----------
+        output_dir : str
+            Directory where the tables are written.
+        first, second : bool, optional
+            Whether to write the tables of the first and second databases.
+
+        Returns
+        -------
+        list of str
+            The paths of the tables, named as the ones of process_results.
+
+        Raises
+        ------
+        PlatypusValueError
+            If the summary doesn't have the tallies.
+        """
+        if self.tallies is None and (first or second):
+            raise PlatypusValueError("The subject tallies were not kept, the "
+                                     "hit count tables can't be written.")
+        written = []
+        for db, wanted in (('a', first), ('b', second)):
+            if not wanted:
+                continue
+            tallies = self.tallies[db]
+            for i, fn in enumerate(self.names):
+                keep = tallies['combination'] == i
+                table = SubjectCounts(join(output_dir, '%s_%s.txt' %
+                                           (_TABLES[db], fn)))
+                table.counts = dict(zip(tallies['subject'][keep].tolist(),
+                                        tallies['count'][keep].tolist()))
+                table.close()
+                written.append(table.name)
+        return written
+
+
+class CompareState(CompareSummary):
+    """Counts, subject tallies and best hits of the batches compared so far
+
+    Parameters
+    ----------
+    state_dir : str
+        Directory where the state is stored, it's created if it doesn't
+        exist. The state already in it is loaded.
+    percentage_ids, alignment_lengths : list of int
+        Thresholds of the database of interest.
+    percentage_ids_other, alignment_lengths_other : list of int
+        Thresholds of the other database.
+
+    Attributes
+    ----------
+    batches : list of dict
+        The batches added, with the name of the file of their best hits and
+        the files they were read from.
+
+    Raises
+    ------
+    PlatypusValueError
+        If the thresholds are not the ones of the state in state_dir.
+    PlatypusParseError
+        If the state in state_dir is corrupted.
+
+    Notes
+    -----
+    The counts and tallies are updated with the queries of each new batch,
+    and the best hits of the batch are stored in their own file sorted by
+    query, so adding a batch doesn't read the previous ones. Only the
+    queries of the new batch are looked for in the files of the previous
+    batches: a query found again keeps the best hits of both batches, and
+    what it added to the counts and tallies is replaced. Its hits in the
+    other database are only found in the batch that has its hits in the
+    database of interest.
+    """
+
+    def __init__(self, state_dir, percentage_ids, alignment_lengths,
+                 percentage_ids_other, alignment_lengths_other):
+        super(CompareState, self).__init__(
+            percentage_ids, alignment_lengths, percentage_ids_other,
+            alignment_lengths_other)
+        self.state_dir = state_dir
+        self.batches = []
+
+        fp = join(state_dir, STATE_FN)
+        if not isfile(fp):
+            return
+        arrays, metadata = read_arrays(fp)
+        if metadata['thresholds'] != self.thresholds:
+            raise PlatypusValueError(
+                "The thresholds are not the ones of the state in %s: %s" %
+                (state_dir, metadata['thresholds']))
+        self._load(arrays, metadata)
+        self.batches = metadata['batches']
+
+    def added(self, interest_fp, other_fp):
+        """Whether the same files were already added
+
+        Parameters
+        ----------
+        interest_fp, other_fp : str
+            Paths of the search results of a batch.
+
+        Returns
+        -------
+        bool
+            True if both are regular files and a batch was read from them,
+            with the same sizes and modification times.
+        """
+        sources = [_source(fp) for fp in (interest_fp, other_fp)]
+        return None not in sources and any(
+            batch['sources'] == sources for batch in self.batches)
+
+    def add_batch(self, best_hits, total_queries, interest_fp, other_fp):
+        """Add the best hits of a new batch of queries and store the state
+
+        Parameters
+        ----------
+        best_hits : platypus.parse.BestHits
+            The best hits of the batch in both databases, from
+            parse_first_database and parse_second_database.
+        total_queries : int
+            Number of queries of the batch, as returned by
+            parse_first_database.
+        interest_fp, other_fp : str
+            Paths of the search results of the batch.
+
+        Returns
+        -------
+        platypus.parse.BestHits
+            The best hits of the queries of the batch, joined with the ones
+            of the previous batches for the queries found again. Those
+            queries come first.
+
+        Raises
+        ------
+        PlatypusValueError
+            If the same files were already added.
+        """
+        if self.added(interest_fp, other_fp):
+            raise PlatypusValueError("%s and %s were already added to %s." %
+                                     (interest_fp, other_fp, self.state_dir))
+        create_dir(self.state_dir)
+
+        previous = self._previous(best_hits.queries)
+        merged = BestHits(len(self.names))
+        merged.update(previous)
+        merged.update(best_hits)
+
+        counts, tallies = tally_best_hits(merged)
+        previous_counts, previous_tallies = tally_best_hits(previous)
+        self.counts += counts - previous_counts
+        self.tallies = {db: sum_tallies([self.tallies[db], tallies[db],
+                                         previous_tallies[db]], [1, 1, -1])
+                        for db in self.tallies}
+        self.total_queries += total_queries - len(previous)
+
+        # the batch is written first, so the state never lists a batch that
+        # is not complete
+        fn = BATCH_FN % len(self.batches)
+        write_arrays(join(self.state_dir, fn), merged.as_arrays())
+        self.batches.append({
+            'file': fn, 'queries': len(merged),
+            'sources': [_source(fp) for fp in (interest_fp, other_fp)]})
+        self.sources['interest'].append(basename(interest_fp))
+        self.sources['other'].append(basename(other_fp))
+        self.write(join(self.state_dir, STATE_FN))
+        return merged
+
+    def _metadata(self):
+        metadata = super(CompareState, self)._metadata()
+        metadata['batches'] = self.batches
+        return metadata
+
+    def _previous(self, queries):
+        """The stored best hits of the queries found in earlier batches"""
+        previous = BestHits(len(self.names))
+        pending = np.array(queries, dtype=str)
+        # the newest batch of a query has its best hits so far
+        for batch in reversed(self.batches):
+            if not len(pending):
+                break
+            arrays, _ = read_arrays(join(self.state_dir, batch['file']))
+            positions = _lookup(arrays['queries'], pending)
+            found = positions >= 0
+            if found.any():
+                previous.update(BestHits(len(self.names), _subset(
+                    arrays, positions[found])))
+                pending = pending[~found]
+        return previous
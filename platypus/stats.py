@@ -0,0 +1,239 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import division
+
+import sys
+from json import dump
+from os import times
+from os.path import getsize, isfile
+from resource import getrusage, RUSAGE_CHILDREN, RUSAGE_SELF
+from time import time
+
+# name of the report written to the output directory of the commands
+REPORT_FN = 'platypus_report.json'
+
+# ru_maxrss is in kilobytes except on OS X, where it's in bytes
+_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def peak_rss(who=RUSAGE_SELF):
+    """Peak resident set size in bytes of the process or of its children"""
+    return getrusage(who).ru_maxrss * _RSS_UNIT
+
+
+def _position(fh):
+    """Number of bytes read from fh, None if it can't be known"""
+    if not isinstance(fh, file) or not isfile(fh.name):
+        return None
+    try:
+        return fh.tell()
+    except (IOError, ValueError):
+        return None
+
+
+class Stage(object):
+    """Measurements of a stage of a command
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+    inputs : list of file
+        Files read by the stage, used to report the progress.
+
+    Attributes
+    ----------
+    counters : dict
+        Things processed in the stage, for example queries or hits.
+    input_bytes : int or None
+        Total size of the inputs, None if some of them are not regular files
+        (compressed files or pipes).
+    started : float or None
+        Time when the stage started.
+    """
+
+    def __init__(self, name, inputs=()):
+        self.name = name
+        self.counters = {}
+        self._inputs = list(inputs)
+        sizes = [getsize(fh.name) if _position(fh) is not None else None
+                 for fh in self._inputs]
+        self.input_bytes = None if None in sizes else sum(sizes)
+
+        self.started = None
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.children_cpu = 0.0
+        self.peak_rss = 0
+        self.children_peak_rss = 0
+
+    def add(self, counter, value=1):
+        """Increase a counter"""
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def done(self):
+        """Fraction of the inputs read so far, None if it can't be known"""
+        positions = [_position(fh) for fh in self._inputs]
+        if not self.input_bytes or None in positions:
+            return None
+        return sum(positions) / self.input_bytes
+
+    def as_dict(self):
+        """The measurements, with the rate of each counter"""
+        stage = {'name': self.name, 'wall': self.wall, 'cpu': self.cpu,
+                 'children_cpu': self.children_cpu,
+                 'peak_rss': self.peak_rss,
+                 'children_peak_rss': self.children_peak_rss,
+                 'input_bytes': self.input_bytes,
+                 'counters': dict(self.counters)}
+        rates = dict(self.counters)
+        if self.input_bytes is not None:
+            rates['bytes'] = self.input_bytes
+        stage['rates'] = {'%s_per_second' % name:
+                          value / self.wall if self.wall else None
+                          for name, value in rates.items()}
+        return stage
+
+
+class Stats(object):
+    """Timing, counters and memory of each of the stages of a command
+
+    Parameters
+    ----------
+    progress : float, optional
+        Seconds between progress lines, None to write none.
+    echo : callable, optional
+        Function that writes the progress lines, defaults to writing them to
+        the standard error.
+
+    Attributes
+    ----------
+    stages : list of Stage
+        The stages started so far, in order.
+
+    Notes
+    -----
+    The hooks only update a few counters, so the overhead is negligible and
+    the measurements can be collected for every run. Peak memory is the
+    peak of the process up to the end of each stage, as reported by the
+    operating system.
+    """
+
+    def __init__(self, progress=None, echo=None):
+        self.stages = []
+        self._current = None
+        self._progress = progress
+        self._echo = echo or (lambda line: sys.stderr.write(line + '\n'))
+        self._start = time()
+        self._last_progress = self._start
+
+    def stage(self, name, inputs=()):
+        """Context manager that measures a stage
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        inputs : iterable of file, optional
+            Files read by the stage, used to estimate the time left.
+
+        Returns
+        -------
+        context manager
+            Returns the Stage on entering.
+        """
+        return _Measure(self, Stage(name, inputs))
+
+    def add(self, counter, value=1):
+        """Increase a counter of the current stage"""
+        if self._current is not None:
+            self._current.add(counter, value)
+            self.tick()
+
+    def count_records(self, records):
+        """Count the queries and hits of the records as they are iterated
+
+        Parameters
+        ----------
+        records : iterable of tuple
+            (query, hits) tuples like the ones of parse.parse_m9.
+
+        Returns
+        -------
+        iterator of tuple
+            The same records.
+        """
+        for query, hits in records:
+            if query is not None and self._current is not None:
+                counters = self._current.counters
+                counters['queries'] = counters.get('queries', 0) + 1
+                counters['hits'] = counters.get('hits', 0) + len(hits)
+                if self._progress is not None:
+                    self.tick()
+            yield query, hits
+
+    def tick(self):
+        """Write a progress line if it's due"""
+        if self._progress is None or self._current is None:
+            return
+        now = time()
+        if now - self._last_progress < self._progress:
+            return
+        self._last_progress = now
+
+        stage = self._current
+        elapsed = now - stage.started
+        parts = ['[%s] %.1fs' % (stage.name, elapsed)]
+        for name, value in sorted(stage.counters.items()):
+            parts.append('%d %s (%.0f/s)' % (value, name,
+                                             value / max(elapsed, 1e-9)))
+        done = stage.done()
+        if done:
+            parts.append('%.1f%% done, ETA %.0fs' % (
+                100 * done, elapsed * (1 - done) / done))
+        self._echo(', '.join(parts))
+
+    def as_dict(self):
+        """The measurements of all the stages"""
+        return {'wall': time() - self._start,
+                'peak_rss': peak_rss(),
+                'stages': [stage.as_dict() for stage in self.stages]}
+
+    def write(self, fp):
+        """Write the measurements as JSON to fp"""
+        with open(fp, 'w') as f:
+            dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+
+class _Measure(object):
+    """Helper of Stats.stage"""
+
+    def __init__(self, stats, stage):
+        self._stats = stats
+        self._stage = stage
+
+    def __enter__(self):
+        stage = self._stage
+        self._stats.stages.append(stage)
+        self._previous = self._stats._current
+        self._stats._current = stage
+
+        self._times = times()
+        stage.started = time()
+        return stage
+
+    def __exit__(self, *args):
+        stage = self._stage
+        stage.wall = time() - stage.started
+        end = times()
+        stage.cpu = (end[0] + end[1]) - (self._times[0] + self._times[1])
+        stage.children_cpu = ((end[2] + end[3]) -
+                              (self._times[2] + self._times[3]))
+        stage.peak_rss = peak_rss()
+        stage.children_peak_rss = peak_rss(RUSAGE_CHILDREN)
+        self._stats._current = self._previous
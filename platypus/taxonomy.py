@@ -0,0 +1,251 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import division
+
+from os.path import abspath, isfile
+
+import numpy as np
+
+from platypus.cache import (cache_path, create_cache_dir, read_arrays, touch,
+                            write_arrays)
+from platypus.compare import (QueryMatcher, PlatypusParseError,
+                              PlatypusValueError, _split_taxonomy_line)
+from platypus.util import open_input
+
+
+class TaxonomyIndex(object):
+    """Taxonomy file indexed by assignment, searched without reading it
+
+    Parameters
+    ----------
+    arrays : dict of np.ndarray
+        The arrays written by build_index, usually memory mapped with
+        platypus.cache.read_arrays.
+
+    Notes
+    -----
+    Taxonomy files assign the same string to many sequences, so the index
+    keeps each distinct assignment once, joined in a single text, and the
+    identifiers of the sequences of each assignment (the postings). A
+    query is searched in the text of the distinct assignments and the
+    sequences are then read from the postings of the ones that match.
+
+    The format of the file and the duplicated identifiers are checked once
+    when the index is built. As with sequences_from_query, a repeated
+    identifier is only an error if one of its lines matches the query.
+    """
+
+    def __init__(self, arrays):
+        self._text = arrays['text'].tostring()
+        self._lower = self._text.lower()
+        self._starts = arrays['starts']
+        self._ids = arrays['ids']
+        self._groups = arrays['groups']
+        self._repeated = arrays['repeated']
+
+    def __len__(self):
+        return len(self._ids)
+
+    def sequences_from_query(self, query):
+        """Search for a query in the taxonomy assignments
+
+        Parameters
+        ----------
+        query : str
+            String to search for in the taxonomy assignments, the search is
+            case insensitive.
+
+        Returns
+        -------
+        dict
+            The same as compare.sequences_from_query, the keys are the
+            identifiers of the sequences and the values are the taxonomy
+            assignments.
+
+        Raises
+        ------
+        PlatypusValueError
+            If a sequence that matches is repeated in the taxonomy.
+        """
+        query = query.lower()
+        lower, positions = self._lower, []
+        # assignments are separated by new lines, so they can't be matched
+        if '\n' not in query:
+            position = lower.find(query)
+            while position != -1 and position < len(lower):
+                positions.append(position)
+                # continue from the next assignment, each is reported once
+                position = lower.find(query, lower.find('\n', position) + 1)
+
+        starts = self._starts
+        assignments = np.searchsorted(starts, positions, 'right') - 1
+        names = [self._text[start:end - 1].strip() for start, end in
+                 zip(starts[assignments].tolist(),
+                     starts[assignments + 1].tolist())]
+        rows, owners = self._rows(assignments)
+        return dict(zip(self._ids[rows].tolist(),
+                        [names[i] for i in owners.tolist()]))
+
+    def sequences_from_queries(self, queries):
+        """Search for several queries in the taxonomy assignments at once
+
+        Parameters
+        ----------
+        queries : list of str
+            Strings to search for in the taxonomy assignments, the search is
+            case insensitive.
+
+        Returns
+        -------
+        dict
+            The same as compare.sequences_from_queries, the keys are the
+            identifiers of the sequences that match at least one query and
+            the values are tuples with the positions in `queries` of the
+            queries they match.
+
+        Raises
+        ------
+        PlatypusValueError
+            If a sequence that matches is repeated in the taxonomy.
+        """
+        matcher = QueryMatcher(queries)
+        assignments, found = [], []
+        # the text ends with a new line, so the last item is always empty
+        for assignment, taxa_name in enumerate(self._lower.split('\n')[:-1]):
+            matched = matcher.find(taxa_name)
+            if matched:
+                assignments.append(assignment)
+                found.append(matched)
+
+        rows, owners = self._rows(np.array(assignments, dtype=np.int64))
+        return dict(zip(self._ids[rows].tolist(),
+                        [found[i] for i in owners.tolist()]))
+
+    def _rows(self, assignments):
+        """Sequences of the assignments and the position of their assignment
+
+        Raises
+        ------
+        PlatypusValueError
+            If one of the sequences is repeated in the taxonomy.
+        """
+        starts = self._groups[assignments]
+        counts = self._groups[assignments + 1] - starts
+        owners = np.repeat(np.arange(len(assignments)), counts)
+        # consecutive positions from the start of each assignment
+        offsets = np.cumsum(counts) - counts
+        rows = np.arange(counts.sum()) + np.repeat(starts - offsets, counts)
+
+        repeated = np.flatnonzero(self._repeated[rows])
+        if len(repeated):
+            raise PlatypusValueError(
+                "There are duplicated entries in the taxonomy file (%s)." %
+                self._ids[rows[repeated[0]]])
+        return rows, owners
+
+
+def build_index(taxonomy):
+    """Read a taxonomy file into the arrays of a TaxonomyIndex
+
+    Parameters
+    ----------
+    taxonomy : iterable of str
+        Lines with tab-delimited values of sequence identifier to taxonomy
+        assignment, for example an open file.
+
+    Returns
+    -------
+    dict of np.ndarray
+        The arrays, they can be stored with platypus.cache.write_arrays.
+
+    Raises
+    ------
+    PlatypusParseError
+        If the input is not a two column tab-delimited file.
+    """
+    assignments = {}
+    ids, groups = [], []
+    for line in taxonomy:
+        sequence_identifier, taxa_name = _split_taxonomy_line(line)
+        ids.append(sequence_identifier)
+        groups.append(assignments.setdefault(taxa_name, len(assignments)))
+
+    names = sorted(assignments, key=assignments.get)
+    starts = np.cumsum([0] + [len(name) + 1 for name in names])
+    text = ''.join(name + '\n' for name in names)
+
+    ids = np.array(ids, dtype=str)
+    order = np.argsort(groups, kind='mergesort')
+    ids = ids[order]
+    groups = np.searchsorted(np.asarray(groups)[order],
+                             np.arange(len(names) + 1))
+
+    # flag every copy of the identifiers that are found more than once
+    by_id = np.argsort(ids, kind='mergesort')
+    same = ids[by_id][1:] == ids[by_id][:-1]
+    repeated = np.zeros(len(ids), dtype=bool)
+    repeated[by_id[1:][same]] = True
+    repeated[by_id[:-1][same]] = True
+
+    return {'text': np.frombuffer(text, dtype=np.uint8),
+            'starts': starts.astype(np.int64),
+            'ids': ids,
+            'groups': groups.astype(np.int64),
+            'repeated': repeated}
+
+
+def taxonomy_index(fp, cache_dir=None):
+    """Index a taxonomy file, reusing the cached index when possible
+
+    Parameters
+    ----------
+    fp : str
+        Path to the taxonomy file, it can be gzip, bz2 or xz compressed.
+    cache_dir : str, optional
+        Directory where the index is stored. If None is passed, the index is
+        built in memory.
+
+    Returns
+    -------
+    TaxonomyIndex
+        The index.
+
+    Raises
+    ------
+    PlatypusParseError
+        If the input is not a two column tab-delimited file.
+
+    Notes
+    -----
+    The cached index is memory mapped and fp is not read. The name of the
+    index depends on the path, the size and the modification time of fp,
+    so a new release of the taxonomy is indexed again. Inputs that are not
+    regular files are never cached. See platypus.cache.evict to limit the
+    size of the cache directory.
+    """
+    path = None
+    if cache_dir is not None:
+        path = cache_path(fp, cache_dir, 'taxonomy')
+        if path is not None and isfile(path):
+            try:
+                arrays, _ = read_arrays(path)
+            except PlatypusParseError:
+                pass
+            else:
+                touch(path)
+                return TaxonomyIndex(arrays)
+
+    with open_input(fp) as f:
+        arrays = build_index(f)
+    if path is None:
+        return TaxonomyIndex(arrays)
+
+    create_cache_dir(cache_dir)
+    write_arrays(path, arrays, {'source': abspath(fp)})
+    arrays, _ = read_arrays(path)
+    return TaxonomyIndex(arrays)
@@ -0,0 +1,544 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import division
+
+import bz2
+import gzip
+import io
+import sys
+from distutils.spawn import find_executable
+from os import close, dup, fdopen, makedirs, pipe, unlink, write
+from os.path import isdir, isfile
+from subprocess import Popen, PIPE
+from tempfile import NamedTemporaryFile, TemporaryFile
+from threading import Condition, Thread
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# the magic bytes at the start of each of the supported compression formats
+_MAGIC = (('gzip', '\x1f\x8b'),
+          ('bz2', 'BZh'),
+          ('xz', '\xfd7zXZ\x00'))
+
+# programs that decompress each format to the standard output, in order of
+# preference, the parallel implementations go first
+_PROGRAMS = {'gzip': (('pigz', '-dc'), ('gzip', '-dc')),
+             'bz2': (('lbzip2', '-dc'), ('pbzip2', '-dc'), ('bzip2', '-dc')),
+             'xz': (('xz', '-dc'),)}
+
+# number of bytes decompressed at a time when no program is available
+_CHUNK_SIZE = 1024 * 1024
+
+
+def create_dir(path):
+    """Create a directory and its parents if they don't exist"""
+    if not isdir(path):
+        try:
+            makedirs(path)
+        except OSError:
+            # another process could have created it in the meantime
+            if not isdir(path):
+                raise
+
+
+class FileRange(object):
+    """Read-only view of the bytes of a file between two offsets
+
+    Parameters
+    ----------
+    f : file
+        File opened in binary mode, it's moved to start.
+    start, end : int
+        Offsets of the first byte and of the byte after the last one.
+    """
+
+    def __init__(self, f, start, end):
+        self._f = f
+        self._end = end
+        f.seek(start)
+
+    def read(self, size):
+        return self._f.read(max(0, min(size, self._end - self._f.tell())))
+
+    def readline(self):
+        remaining = self._end - self._f.tell()
+        return self._f.readline(remaining) if remaining > 0 else ''
+
+
+def compression(fp):
+    """Detect the compression format of a file from its first bytes
+
+    Parameters
+    ----------
+    fp : str
+        Path to the file.
+
+    Returns
+    -------
+    str or None
+        One of 'gzip', 'bz2' or 'xz', None if the file is not compressed.
+    """
+    with open(fp, 'rb') as f:
+        return _compression(f.read(_MAGIC_SIZE))
+
+
+# bytes needed to detect the compression format
+_MAGIC_SIZE = max(len(magic) for _, magic in _MAGIC)
+
+
+def _compression(start):
+    """Compression format of the data that starts with start"""
+    for name, magic in _MAGIC:
+        if start.startswith(magic):
+            return name
+    return None
+
+
+def is_stream(fp):
+    """Whether fp is the standard input or a file that can't be reread
+
+    Parameters
+    ----------
+    fp : str
+        Path to a file, `-` is the standard input.
+
+    Returns
+    -------
+    bool
+        True for `-`, named pipes and files like `/dev/fd/3`, whose data can
+        only be read once and in order.
+    """
+    return fp == '-' or not isfile(fp)
+
+
+def open_input(fp):
+    """Open a file for reading, decompressing it if needed
+
+    Parameters
+    ----------
+    fp : str
+        Path to a plain text file or to a gzip, bz2 or xz compressed file.
+        The format is detected from the contents, not from the extension.
+        It can also be `-` for the standard input or a named pipe, see
+        is_stream.
+
+    Returns
+    -------
+    file-like object
+        Object to read the text from, with a name attribute set to fp.
+
+    Raises
+    ------
+    IOError
+        If the file is compressed in a format that can't be read. While
+        reading, if the compressed data is corrupted.
+
+    Notes
+    -----
+    The compressed files are decompressed by a separate process (gzip,
+    bzip2, xz or their parallel versions when installed) so decompressing
+    overlaps with parsing the data. If none of the programs is available,
+    the Python modules are used from a separate thread.
+
+    Streams are opened once and never rewound: the first bytes are read to
+    detect the format and then returned ahead of the rest of the data.
+    Plain text streams are read as they are, without translating the new
+    lines, and compressed streams need one of the decompression programs.
+    """
+    if is_stream(fp):
+        return _stream_reader(fp)
+
+    kind = compression(fp)
+    if kind is None:
+        return open(fp, 'U')
+
+    for args in _PROGRAMS[kind]:
+        program = find_executable(args[0])
+        if program is not None:
+            return _process_reader([program] + list(args[1:]), fp)
+
+    return _thread_reader(kind, fp)
+
+
+class _PipeReader(object):
+    """File-like object that reads from the pipe fed by a decompressor
+
+    Parameters
+    ----------
+    fh : file
+        Reading end of the pipe.
+    name : str
+        Path of the compressed file.
+    finish : callable
+        Waits for the decompressor, raising IOError if it failed. Called once
+        the end of the data is reached or when the reader is closed.
+    """
+
+    def __init__(self, fh, name, finish):
+        self.name = name
+        self._fh = fh
+        self._finish = finish
+        self._finished = False
+
+    def _done(self):
+        if not self._finished:
+            self._finished = True
+            self._finish()
+
+    def read(self, size=-1):
+        data = self._fh.read(size)
+        if size < 0 or not data:
+            self._done()
+        return data
+
+    def readline(self, size=-1):
+        line = self._fh.readline(size)
+        if not line:
+            self._done()
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return next(self._fh)
+        except StopIteration:
+            self._done()
+            raise
+
+    @property
+    def closed(self):
+        return self._fh.closed
+
+    def close(self):
+        if not self._fh.closed:
+            self._fh.close()
+            # the decompressor fails if the data was not completely read
+            self._finished = True
+            self._finish(interrupted=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _PrefixReader(object):
+    """File-like object that returns some data before the rest of a file
+
+    Parameters
+    ----------
+    prefix : str
+        Data already read from fh.
+    fh : file
+        The file, it's read from the current position.
+    name : str
+        Name of the file.
+    """
+
+    def __init__(self, prefix, fh, name):
+        self.name = name
+        self._prefix = prefix
+        self._fh = fh
+
+    def read(self, size=-1):
+        prefix, self._prefix = self._prefix, ''
+        if size < 0:
+            return prefix + self._fh.read()
+        if len(prefix) >= size:
+            self._prefix = prefix[size:]
+            return prefix[:size]
+        return prefix + self._fh.read(size - len(prefix))
+
+    def readline(self):
+        prefix, self._prefix = self._prefix, ''
+        end = prefix.find('\n') + 1
+        if end:
+            self._prefix = prefix[end:]
+            return prefix[:end]
+        return prefix + self._fh.readline()
+
+    def __iter__(self):
+        # the prefix can have several short lines
+        while self._prefix:
+            yield self.readline()
+        for line in self._fh:
+            yield line
+
+    @property
+    def closed(self):
+        return self._fh.closed
+
+    def close(self):
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _stream_reader(fp):
+    """Read the standard input or a pipe, decompressing it if needed"""
+    if fp == '-':
+        fh = fdopen(dup(sys.stdin.fileno()), 'rb')
+    else:
+        fh = open(fp, 'rb')
+    prefix = fh.read(_MAGIC_SIZE)
+    source = _PrefixReader(prefix, fh, fp)
+    kind = _compression(prefix)
+    if kind is None:
+        return source
+
+    for args in _PROGRAMS[kind]:
+        program = find_executable(args[0])
+        if program is not None:
+            return _process_reader([program] + list(args[1:]), fp, source)
+
+    source.close()
+    raise IOError("Could not decompress %s: install %s to read compressed "
+                  "streams" % (fp, _PROGRAMS[kind][-1][0]))
+
+
+def _process_reader(args, fp, source=None):
+    """Read fp decompressed by a program that writes to stdout
+
+    If source is given, the data is read from it and written to the
+    standard input of the program by a separate thread instead.
+    """
+    errors = TemporaryFile()
+    if source is None:
+        process = Popen(args + [fp], stdout=PIPE, stderr=errors,
+                        close_fds=True)
+        feeder = None
+    else:
+        process = Popen(args, stdin=PIPE, stdout=PIPE, stderr=errors,
+                        close_fds=True)
+        feeder = Thread(target=_feed, args=(source, process.stdin))
+        feeder.daemon = True
+        feeder.start()
+
+    def finish(interrupted=False):
+        if interrupted and process.poll() is None:
+            process.terminate()
+        if feeder is not None:
+            # the program stops reading when it's terminated or fails
+            feeder.join()
+            source.close()
+        process.wait()
+        if process.returncode and not interrupted:
+            errors.seek(0)
+            raise IOError("Could not decompress %s: %s" %
+                          (fp, errors.read().strip()))
+        errors.close()
+
+    return _PipeReader(process.stdout, fp, finish)
+
+
+def _feed(source, fh):
+    """Copy the data of source to fh and close fh"""
+    try:
+        for chunk in iter(lambda: source.read(_CHUNK_SIZE), ''):
+            fh.write(chunk)
+    # the reader of fh exited, the error is reported by the reader
+    except (IOError, OSError, ValueError):
+        pass
+    finally:
+        try:
+            fh.close()
+        except (IOError, OSError):
+            pass
+
+
+def spool(fh):
+    """Read a stream in the background so its writer never waits
+
+    Parameters
+    ----------
+    fh : file-like object
+        The stream, for example a pipe opened with open_input.
+
+    Returns
+    -------
+    file-like object
+        Object to read the same data from, with the name of fh.
+
+    Notes
+    -----
+    A separate thread copies the data of fh to a temporary file as soon as
+    it's available, and the returned object reads that file, waiting for
+    the thread when it reaches the data copied so far. Useful when a pipe
+    is read after another input, so the program writing to it doesn't stop
+    when the pipe is full.
+    """
+    return _Spool(fh)
+
+
+class _Spool(object):
+    """Helper of spool, reads the temporary file written by a thread"""
+
+    def __init__(self, fh):
+        self.name = fh.name
+        self._source = fh
+        self._ready = Condition()
+        self._written = 0
+        self._done = False
+        self._closed = False
+        self._failures = []
+
+        temp = NamedTemporaryFile(prefix='platypus-spool-', delete=False)
+        try:
+            self._fh = io.open(temp.name, 'rb', buffering=0)
+        finally:
+            # the data is still accessible through the open file objects
+            unlink(temp.name)
+        self._position = 0
+        self._buffer = ''
+
+        self._thread = Thread(target=self._copy, args=(temp,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _copy(self, temp):
+        try:
+            for chunk in iter(lambda: self._source.read(_CHUNK_SIZE), ''):
+                if self._closed:
+                    break
+                temp.write(chunk)
+                temp.flush()
+                with self._ready:
+                    self._written += len(chunk)
+                    self._ready.notify()
+        except Exception as e:
+            self._failures.append(e)
+        finally:
+            temp.close()
+            with self._ready:
+                self._done = True
+                self._ready.notify()
+
+    def _fill(self, size=-1):
+        """Add up to size bytes copied so far to the buffer, False at the end
+
+        Waits for the thread if all the data copied has been read already.
+        """
+        with self._ready:
+            while self._written == self._position and not self._done:
+                self._ready.wait(1)
+            available = self._written - self._position
+        if size >= 0:
+            available = min(available, max(size, _CHUNK_SIZE))
+        if not available:
+            self._thread.join()
+            if self._failures:
+                raise IOError("Could not read %s: %s" % (self.name,
+                                                         self._failures[0]))
+            return False
+
+        chunks = [self._buffer]
+        while available:
+            chunk = self._fh.read(available)
+            available -= len(chunk)
+            self._position += len(chunk)
+            chunks.append(chunk)
+        self._buffer = ''.join(chunks)
+        return True
+
+    def read(self, size=-1):
+        while ((size < 0 or len(self._buffer) < size) and
+               self._fill(size - len(self._buffer) if size >= 0 else -1)):
+            pass
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self):
+        start = 0
+        while True:
+            end = self._buffer.find('\n', start) + 1
+            if end:
+                break
+            start = len(self._buffer)
+            if not self._fill(_CHUNK_SIZE):
+                break
+        if not end:
+            end = len(self._buffer)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    @property
+    def closed(self):
+        return self._fh.closed
+
+    def close(self):
+        self._fh.close()
+        # the thread stops once it reads the next chunk
+        self._closed = True
+        try:
+            self._source.close()
+        except IOError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _thread_reader(kind, fp):
+    """Read fp decompressed with a Python module from a separate thread"""
+    if kind == 'gzip':
+        source = gzip.open(fp, 'rb')
+    elif kind == 'bz2':
+        source = bz2.BZ2File(fp, 'rb')
+    elif lzma is not None:
+        source = lzma.LZMAFile(fp, 'rb')
+    else:
+        raise IOError("Could not decompress %s: install xz or the lzma "
+                      "module to read xz compressed files" % fp)
+
+    read_fd, write_fd = pipe()
+    failures = []
+
+    def decompress():
+        try:
+            for chunk in iter(lambda: source.read(_CHUNK_SIZE), ''):
+                while chunk:
+                    chunk = chunk[write(write_fd, chunk):]
+        # truncated files raise EOFError and a closed reader raises OSError
+        except Exception as e:
+            failures.append(e)
+        finally:
+            source.close()
+            close(write_fd)
+
+    thread = Thread(target=decompress)
+    thread.daemon = True
+    thread.start()
+
+    def finish(interrupted=False):
+        if not interrupted:
+            thread.join()
+        if failures and not interrupted:
+            raise IOError("Could not decompress %s: %s" % (fp, failures[0]))
+
+    return _PipeReader(fdopen(read_fd, 'rb'), fp, finish)
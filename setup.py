@@ -30,7 +30,7 @@ description = ("Platypus Conquistador: Confirming specific taxonomic "
 with open('README.rst') as f:
     long_description = f.read()
 
-base = {"click", "scikit-bio >= 0.2.1, < 0.3.0"}
+base = {"click", "numpy", "pandas >= 0.17.0"}
 test = {"nose >= 0.10.1", "pep8", "flake8"}
 all_deps = base | test
 
@@ -0,0 +1,125 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import division
+
+from os import listdir, utime
+from os.path import basename, join, isfile
+from shutil import rmtree
+from tempfile import gettempdir
+from unittest import TestCase, main
+
+import numpy as np
+import numpy.testing as npt
+
+from platypus.cache import (MAGIC, write_arrays, read_arrays, cache_path,
+                            evict, create_cache_dir)
+from platypus.compare import PlatypusParseError
+from platypus.parse import m9_dtype
+
+
+class CacheTests(TestCase):
+    def setUp(self):
+        self.cache_dir = join(gettempdir(), 'platypus-test-cache')
+        create_cache_dir(self.cache_dir)
+        self.fp = join(self.cache_dir, 'arrays.m9')
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+
+    def test_write_read_arrays(self):
+        hits = np.zeros(3, dtype=m9_dtype(5, 7))
+        hits['query'] = 'q1'
+        hits['subject'] = ['s1', 's2', 's3']
+        hits['bitscore'] = [1.5, 20, 300.25]
+        arrays = {'hits': hits, 'offsets': np.array([0, 1, 3]),
+                  'grid': np.arange(6, dtype=np.int8).reshape(2, 3),
+                  'empty': np.array([], dtype='S1')}
+
+        write_arrays(self.fp, arrays, {'source': 'foo.txt'})
+        obs, metadata = read_arrays(self.fp)
+
+        self.assertEqual(metadata, {'source': 'foo.txt'})
+        self.assertEqual(sorted(obs), sorted(arrays))
+        for name, array in arrays.items():
+            self.assertEqual(obs[name].dtype, array.dtype)
+            npt.assert_equal(obs[name], array)
+            self.assertFalse(obs[name].flags.writeable)
+
+        # nothing else is left in the directory
+        self.assertEqual(listdir(self.cache_dir), ['arrays.m9'])
+
+    def test_read_arrays_errors(self):
+        with open(self.fp, 'w') as f:
+            f.write('something else\n')
+        with self.assertRaises(PlatypusParseError):
+            read_arrays(self.fp)
+
+        write_arrays(self.fp, {'a': np.arange(100)})
+        with open(self.fp, 'r+') as f:
+            f.truncate(200)
+        with self.assertRaises(PlatypusParseError):
+            read_arrays(self.fp)
+
+    def test_cache_path(self):
+        with open(self.fp, 'w') as f:
+            f.write('foo\n')
+        utime(self.fp, (1000, 1000))
+        obs = cache_path(self.fp, 'cache', 'm9')
+        self.assertTrue(obs.startswith('cache/'))
+        self.assertTrue(obs.endswith('.m9'))
+        self.assertEqual(obs, cache_path(self.fp, 'cache', 'm9'))
+        self.assertNotEqual(obs, cache_path(self.fp, 'cache', 'tax'))
+
+        # a modified file gets a new cache file
+        utime(self.fp, (2000, 2000))
+        self.assertNotEqual(obs, cache_path(self.fp, 'cache', 'm9'))
+
+        self.assertIsNone(cache_path(join(self.cache_dir, 'missing'),
+                                     'cache', 'm9'))
+        self.assertIsNone(cache_path(self.cache_dir, 'cache', 'm9'))
+        self.assertIsNone(cache_path(None, 'cache', 'm9'))
+
+    def test_evict(self):
+        fps = []
+        for i in range(4):
+            fp = join(self.cache_dir, '%040x.m9' % i)
+            with open(fp, 'w') as f:
+                f.write(MAGIC + 'x' * (100 - len(MAGIC)))
+            utime(fp, (1000 + i, 1000 + i))
+            fps.append(fp)
+
+        self.assertEqual(evict(self.cache_dir, 1000), [])
+        self.assertEqual(evict(self.cache_dir, 250, keep=[fps[0]]),
+                         fps[1:3])
+        self.assertEqual(sorted(listdir(self.cache_dir)),
+                         [basename(fps[0]), basename(fps[3])])
+        self.assertEqual(evict(self.cache_dir, 0), fps[::3])
+        self.assertEqual(listdir(self.cache_dir), [])
+
+    def test_evict_foreign_files(self):
+        """Files that were not written as cache files are never removed"""
+        foreign = ['notes.txt', '%040x.m9' % 1]
+        for name in foreign:
+            with open(join(self.cache_dir, name), 'w') as f:
+                f.write('x' * 1000)
+        fp = cache_path(__file__, self.cache_dir, 'm9')
+        write_arrays(fp, {'values': np.arange(10)})
+
+        self.assertEqual(evict(self.cache_dir, 0), [fp])
+        self.assertEqual(sorted(listdir(self.cache_dir)), sorted(foreign))
+
+    def test_create_cache_dir(self):
+        cache_dir = join(self.cache_dir, 'foo', 'bar')
+        create_cache_dir(cache_dir)
+        create_cache_dir(cache_dir)
+        self.assertFalse(isfile(cache_dir))
+        self.assertEqual(listdir(cache_dir), [])
+
+
+if __name__ == '__main__':
+    main()
@@ -6,13 +6,19 @@
 # The full license is in the file COPYING.txt, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from os.path import join, dirname, abspath
+import gzip
+from json import load
+from os import listdir, makedirs, mkfifo
+from os.path import join, dirname, abspath, basename, getsize
 from shutil import rmtree
-from tempfile import gettempdir
+from tempfile import mkdtemp
+from threading import Thread
 from unittest import TestCase, main
 from click import BadParameter
 
-from platypus.commands import split_db, compare
+from platypus.commands import (split_db, split_db_multi, read_queries,
+                               compare, compare_batch, extract, merge,
+                               read_manifest, COLLATED_FN)
 
 
 class TestSplitDB(TestCase):
@@ -34,7 +40,7 @@ class TestSplitDB(TestCase):
                 pass
 
     def test_split_db(self):
-        temp_dir = gettempdir()
+        temp_dir = mkdtemp()
         self.to_delete.append(temp_dir)
 
         split_db(self.tax_fp, self.seqs_fp, 'Streptococcus', temp_dir, None)
@@ -51,13 +57,152 @@ class TestSplitDB(TestCase):
         with open(exp_rest) as exp, open(out_rest) as out:
             self.assertItemsEqual(exp.readlines(), out.readlines())
 
+    def test_split_db_cache_dir(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+        cache_dir = join(temp_dir, 'cache')
+
+        split_db(self.tax_fp, self.seqs_fp, 'Streptococcus',
+                 join(temp_dir, 'streamed'), None)
+
+        # the second time the inputs are read using the indexes
+        for i in range(2):
+            split_db(self.tax_fp, self.seqs_fp, 'Streptococcus',
+                     join(temp_dir, str(i)), None, cache_dir=cache_dir)
+            for fn in ('interest.fna', 'rest.fna'):
+                with open(join(temp_dir, 'streamed', fn)) as exp, \
+                        open(join(temp_dir, str(i), fn)) as out:
+                    self.assertEqual(exp.read(), out.read())
+            self.assertEqual(sorted(fn.split('.')[-1]
+                                    for fn in listdir(cache_dir)),
+                             ['fasta', 'taxonomy'])
+
+        obs = split_db_multi(self.tax_fp, self.seqs_fp,
+                             ['Streptococcus', 'Burkholderia'],
+                             join(temp_dir, 'multi'), cache_dir=cache_dir)
+        self.assertEqual(obs, {'Streptococcus': 6, 'Burkholderia': 4,
+                               'rest': 10})
+
+        with self.assertRaises(BadParameter):
+            split_db(self.bad_tax_fp, self.seqs_fp, 'pseudomallei',
+                     join(temp_dir, 'bad'), None, cache_dir=cache_dir)
+
+    def test_split_db_jobs(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        for jobs in (1, 3):
+            split_db(self.tax_fp, self.seqs_fp, 'Streptococcus',
+                     join(temp_dir, str(jobs)), None, jobs=jobs)
+        for fn in ('interest.fna', 'rest.fna'):
+            with open(join(temp_dir, '1', fn)) as exp, \
+                    open(join(temp_dir, '3', fn)) as out:
+                self.assertEqual(exp.read(), out.read())
+
+    def test_split_db_compressed(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        inputs = []
+        makedirs(join(temp_dir, 'compressed'))
+        for fp in (self.tax_fp, self.seqs_fp):
+            inputs.append(join(temp_dir, 'compressed', basename(fp) + '.gz'))
+            with open(fp) as f, gzip.open(inputs[-1], 'wb') as out:
+                out.write(f.read())
+
+        split_db(inputs[0], inputs[1], 'Streptococcus', temp_dir, None)
+
+        for fp in ('interest.fna', 'rest.fna'):
+            with open(join(self.base, fp)) as exp, \
+                    open(join(temp_dir, fp)) as out:
+                self.assertItemsEqual(exp.readlines(), out.readlines())
+
+    def test_split_db_report(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        split_db(self.tax_fp, self.seqs_fp, 'Streptococcus', temp_dir, None,
+                 report=True)
+
+        with open(join(temp_dir, 'platypus_report.json')) as f:
+            stages = load(f)['stages']
+        self.assertEqual([s['name'] for s in stages],
+                         ['select_sequences', 'split_sequences'])
+        with open(join(self.base, 'interest.fna')) as f:
+            interest = f.read().count('>')
+        self.assertEqual(stages[1]['counters']['interest'], interest)
+        self.assertEqual(stages[1]['counters']['bytes_written'],
+                         getsize(join(temp_dir, 'interest.fna')) +
+                         getsize(join(temp_dir, 'rest.fna')))
+
+    def test_split_db_multi(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        queries = ['Streptococcus', 'Burkholderia', 'pseudomallei', 'Rumba']
+        obs = split_db_multi(self.tax_fp, self.seqs_fp, queries,
+                             join(temp_dir, 'multi'), max_open=2)
+        self.assertEqual(obs, {'Streptococcus': 6, 'Burkholderia': 4,
+                               'pseudomallei': 3, 'Rumba': 0, 'rest': 10})
+
+        # the same as splitting by each query
+        for query in queries[:3]:
+            split_db(self.tax_fp, self.seqs_fp, query, join(temp_dir, query),
+                     None)
+            with open(join(temp_dir, query, 'interest.fna')) as exp, \
+                    open(join(temp_dir, 'multi', query + '.fna')) as out:
+                self.assertEqual(exp.read(), out.read())
+        with open(join(temp_dir, 'multi', 'Rumba.fna')) as out:
+            self.assertEqual(out.read(), '')
+
+        with open(join(temp_dir, 'multi', 'rest.fna')) as out:
+            rest = out.read()
+        self.assertEqual(rest.count('>'), 10)
+        self.assertNotIn('Streptococcus', rest)
+
+    def test_split_db_multi_errors(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        with self.assertRaises(BadParameter):
+            split_db_multi(self.tax_fp, self.seqs_fp, ['Rumba', 'Mambo'],
+                           temp_dir)
+        with self.assertRaises(BadParameter):
+            split_db_multi(self.tax_fp, self.seqs_fp, ['a b', 'a_b'],
+                           temp_dir)
+        with self.assertRaises(BadParameter):
+            split_db_multi(self.tax_fp, self.seqs_fp, {'rest': 'Rumba'},
+                           temp_dir)
+        with self.assertRaises(BadParameter):
+            split_db_multi(self.bad_tax_fp, self.seqs_fp, ['Rumba'],
+                           temp_dir)
+
+    def test_read_queries(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+        fp = join(temp_dir, 'queries.txt')
+
+        with open(fp, 'w') as f:
+            f.write('Streptococcus\tstrep\nSalmonella enterica\n\n'
+                    'Burkholderia\t\n')
+        self.assertEqual(read_queries(fp).items(),
+                         [('strep', 'Streptococcus'),
+                          ('Salmonella_enterica', 'Salmonella enterica'),
+                          ('Burkholderia', 'Burkholderia')])
+
+        for contents in ('', 'a\tb\tc\n', 'a\tx\nb\tx\n'):
+            with open(fp, 'w') as f:
+                f.write(contents)
+            with self.assertRaises(BadParameter):
+                read_queries(fp)
+
     def test_split_db_no_results(self):
         with self.assertRaises(BadParameter):
             split_db(self.tax_fp, self.seqs_fp, ":L doesn't exist", 'output',
                      None)
 
     def test_split_db_split_fp(self):
-        temp_dir = gettempdir()
+        temp_dir = mkdtemp()
         self.to_delete.append(temp_dir)
 
         split_fp = join(self.base, 'split_fp.txt')
@@ -77,7 +222,7 @@ class TestSplitDB(TestCase):
             self.assertItemsEqual(exp.readlines(), out.readlines())
 
     def test_split_db_split_fp_errors(self):
-        temp_dir = gettempdir()
+        temp_dir = mkdtemp()
         self.to_delete.append(temp_dir)
 
         with self.assertRaises(BadParameter):
@@ -105,7 +250,7 @@ class TestCompare(TestCase):
                 pass
 
     def test_compare_base(self):
-        temp_dir = gettempdir()
+        temp_dir = mkdtemp()
         self.to_delete.append(temp_dir)
 
         compare(self.interest_fp, self.other_fp, temp_dir)
@@ -119,8 +264,404 @@ class TestCompare(TestCase):
             with open(exp_fp) as exp, open(out_fp) as out:
                 self.assertItemsEqual(exp.readlines(), out.readlines())
 
+    def test_compare_cache(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+        cache_dir = join(temp_dir, 'cache')
+
+        # the second comparison reads the results from the cache
+        for _ in range(2):
+            compare(self.interest_fp, self.other_fp, temp_dir,
+                    cache_dir=cache_dir)
+
+            fp = 'summary_p1_70-a1_50_p2_70-a2_50.txt'
+            with open(join(self.base, 'compare-tests', fp)) as exp, \
+                    open(join(temp_dir, fp)) as out:
+                self.assertItemsEqual(exp.readlines(), out.readlines())
+            self.assertEqual(len(listdir(cache_dir)), 2)
+
+        compare(self.interest_fp, self.other_fp, temp_dir,
+                cache_dir=cache_dir, cache_size=0)
+        self.assertEqual(len(listdir(cache_dir)), 2)
+
+    def test_compare_streaming(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        # both files sorted by query
+        inputs = []
+        makedirs(join(temp_dir, 'sorted'))
+        for fp in (self.interest_fp, self.other_fp):
+            lines = [line for line in open(fp) if not line.startswith('#')]
+            lines.sort(key=lambda line: line.split('\t', 1)[0])
+            inputs.append(join(temp_dir, 'sorted', basename(fp)))
+            with open(inputs[-1], 'w') as f:
+                f.writelines(lines)
+
+        exp_dir, obs_dir = join(temp_dir, 'exp'), join(temp_dir, 'obs')
+        compare(inputs[0], inputs[1], exp_dir, hits_to_first=True,
+                hits_to_second=True)
+        compare(inputs[0], inputs[1], obs_dir, hits_to_first=True,
+                hits_to_second=True, streaming=True)
+
+        for fp in listdir(exp_dir):
+            with open(join(exp_dir, fp)) as exp, \
+                    open(join(obs_dir, fp)) as out:
+                self.assertItemsEqual(exp.readlines(), out.readlines())
+
+        with self.assertRaises(BadParameter):
+            compare(self.interest_fp, inputs[1], obs_dir, streaming=True)
+
+    def test_compare_unordered(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        # the same hits sorted by query and with the queries interleaved
+        inputs = {'sorted': [], 'interleaved': []}
+        for fp in (self.interest_fp, self.other_fp):
+            lines = [line for line in open(fp) if not line.startswith('#')]
+            lines.sort(key=lambda line: line.split('\t', 1)[0])
+            for name in inputs:
+                if not inputs[name]:
+                    makedirs(join(temp_dir, name))
+                inputs[name].append(join(temp_dir, name, basename(fp)))
+                with open(inputs[name][-1], 'w') as f:
+                    f.writelines(lines[::2] + lines[1::2]
+                                 if name == 'interleaved' else lines)
+
+        interleaved = inputs['interleaved']
+        exp_dir = join(temp_dir, 'exp')
+        compare(inputs['sorted'][0], inputs['sorted'][1], exp_dir,
+                hits_to_first=True, hits_to_second=True)
+        for memory in (0, 1024 ** 2):
+            obs_dir = join(temp_dir, 'obs-%d' % memory)
+            compare(interleaved[0], interleaved[1], obs_dir,
+                    hits_to_first=True, hits_to_second=True, unordered=True,
+                    group_memory=memory, jobs=2)
+
+            self.assertEqual(sorted(listdir(exp_dir)),
+                             sorted(listdir(obs_dir)))
+            for fp in listdir(exp_dir):
+                with open(join(exp_dir, fp)) as exp, \
+                        open(join(obs_dir, fp)) as out:
+                    self.assertItemsEqual(exp.readlines(), out.readlines())
+
+        with self.assertRaises(BadParameter):
+            compare(interleaved[0], interleaved[1], obs_dir,
+                    streaming=True, unordered=True)
+
+    def test_compare_state(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+        state_dir = join(temp_dir, 'state')
+
+        # the hits of one query in the first batch and the rest in the second
+        inputs = {'all': [], 'batch0': [], 'batch1': []}
+        for fp in (self.interest_fp, self.other_fp):
+            lines = [line for line in open(fp) if not line.startswith('#')]
+            batches = {'all': lines,
+                       'batch0': [line for line in lines
+                                  if line.startswith('HABJ36W02EXF44')],
+                       'batch1': [line for line in lines
+                                  if not line.startswith('HABJ36W02EXF44')]}
+            for name, batch in batches.items():
+                if not inputs[name]:
+                    makedirs(join(temp_dir, name))
+                inputs[name].append(join(temp_dir, name, basename(fp)))
+                with open(inputs[name][-1], 'w') as f:
+                    f.writelines(batch)
+
+        exp_dir = join(temp_dir, 'exp')
+        compare(inputs['all'][0], inputs['all'][1], exp_dir,
+                hits_to_first=True, hit_counts=True)
+        for name in ('batch0', 'batch1'):
+            obs_dir = join(temp_dir, 'obs_' + name)
+            compare(inputs[name][0], inputs[name][1], obs_dir,
+                    hits_to_first=True, hit_counts=True, state_dir=state_dir)
+
+        self.assertEqual(sorted(listdir(exp_dir)), sorted(listdir(obs_dir)))
+        for fp in listdir(exp_dir):
+            if fp.startswith('summary'):
+                continue
+            with open(join(exp_dir, fp)) as exp, \
+                    open(join(obs_dir, fp)) as out:
+                self.assertEqual(exp.read(), out.read())
+
+        # the summaries only have the queries of the batch
+        with open(join(obs_dir, 'summary_p1_70-a1_50_p2_70-a2_50.txt')) as f:
+            self.assertNotIn('HABJ36W02EXF44', f.read())
+
+        with self.assertRaises(BadParameter):
+            compare(inputs['batch1'][0], inputs['batch1'][1], obs_dir,
+                    state_dir=state_dir)
+        with self.assertRaises(BadParameter):
+            compare(inputs['all'][0], inputs['all'][1], obs_dir,
+                    interest_pcts=[90], state_dir=state_dir)
+        with self.assertRaises(BadParameter):
+            compare(inputs['all'][0], inputs['all'][1], obs_dir,
+                    streaming=True, state_dir=state_dir)
+
+    def test_merge(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        # two shards with different queries and all of them, same file names
+        shards = [[], [], []]
+        for fp in (self.interest_fp, self.other_fp):
+            lines = [line for line in open(fp) if not line.startswith('#')]
+            for i, shard in enumerate(shards):
+                if not shard:
+                    makedirs(join(temp_dir, 'shard%d' % i))
+                shard.append(join(temp_dir, 'shard%d' % i, basename(fp)))
+                with open(shard[-1], 'w') as f:
+                    f.writelines(line for line in lines if i == 2 or
+                                 line.startswith('HABJ36W02EXF44') == i)
+        full = shards.pop()
+
+        exp_dir = join(temp_dir, 'exp')
+        exp = compare(full[0], full[1], exp_dir,
+                      interest_pcts=[70, 90], hits_to_first=True,
+                      hits_to_second=True, hit_counts=True)
+        partial_fps = []
+        for i, (interest_fp, other_fp) in enumerate(shards):
+            partial_fps.append(join(temp_dir, 'partial%d.arrays' % i))
+            compare(interest_fp, other_fp, join(temp_dir, 'out%d' % i),
+                    interest_pcts=[70, 90], hit_counts=True,
+                    partial_fp=partial_fps[-1], counts_only=i == 1)
+
+        obs_dir = join(temp_dir, 'obs')
+        obs = merge(partial_fps, obs_dir, hits_to_first=True,
+                    hits_to_second=True)
+        self.assertEqual(obs, exp)
+        self.assertEqual(sorted(fp for fp in listdir(exp_dir)
+                                if not fp.startswith('summary') and
+                                fp != 'platypus_report.json'),
+                         sorted(listdir(obs_dir)))
+        for fp in listdir(obs_dir):
+            with open(join(exp_dir, fp)) as exp_f, \
+                    open(join(obs_dir, fp)) as out:
+                self.assertEqual(exp_f.read(), out.read())
+
+        # without the tallies only the counts can be merged
+        compare(shards[1][0], shards[1][1], join(temp_dir, 'streaming'),
+                interest_pcts=[70, 90], hit_counts=True, streaming=True,
+                partial_fp=partial_fps[1])
+        self.assertEqual(merge(partial_fps, obs_dir), exp)
+        with self.assertRaises(BadParameter):
+            merge(partial_fps, obs_dir, hits_to_first=True)
+
+        compare(shards[0][0], shards[0][1], join(temp_dir, 'other'),
+                partial_fp=partial_fps[0])
+        with self.assertRaises(BadParameter):
+            merge(partial_fps, obs_dir)
+        with self.assertRaises(BadParameter):
+            merge([self.interest_fp], obs_dir)
+        with self.assertRaises(BadParameter):
+            merge([], obs_dir)
+
+    def test_compare_batch(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        # the second sample is relative to the manifest, the third is missing
+        makedirs(join(temp_dir, 'inputs'))
+        for fp in (self.interest_fp, self.other_fp):
+            with open(fp) as f, open(join(temp_dir, 'inputs', basename(fp)),
+                                     'w') as out:
+                out.write(f.read())
+        manifest_fp = join(temp_dir, 'manifest.txt')
+        with open(manifest_fp, 'w') as f:
+            f.write('# sample\tinterest\tother\n\n')
+            f.write('s1\t%s\t%s\n' % (self.interest_fp, self.other_fp))
+            f.write('s2\tinputs/first_db.txt\tinputs/second_db.txt\n')
+
+        exp_dir = join(temp_dir, 'exp')
+        exp = compare(self.interest_fp, self.other_fp, exp_dir,
+                      interest_pcts=[70, 90], interest_alg_lens=[50])
+        output_dir = join(temp_dir, 'batch')
+        obs = compare_batch(manifest_fp, output_dir, interest_pcts=[70, 90],
+                            interest_alg_lens=[50], jobs=2)
+        self.assertEqual(obs.keys(), ['s1', 's2'])
+        for sample in obs:
+            self.assertEqual(obs[sample], exp)
+            with open(join(exp_dir, 'compile_output.txt')) as exp_f, \
+                    open(join(output_dir, sample,
+                              'compile_output.txt')) as out:
+                self.assertEqual(exp_f.read(), out.read())
+
+        with open(join(output_dir, COLLATED_FN)) as f:
+            lines = f.readlines()
+        self.assertEqual(lines[0], '#Sample\tCombination\tinterest db\t'
+                         'other db\tonly interest\tboth dbs\t'
+                         'no hits in interest db\n')
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[1], 's1\tp1_70-a1_50_p2_70-a2_50\t%s\n' %
+                         '\t'.join(row[1] for row in exp[1:]))
+        self.assertEqual(lines[4], 's2\tp1_90-a1_50_p2_90-a2_50\t%s\n' %
+                         '\t'.join(row[2] for row in exp[1:]))
+
+        # the rest of the samples are written before reporting the failure
+        with open(manifest_fp, 'a') as f:
+            f.write('s3\tmissing.txt\tinputs/second_db.txt\n')
+        output_dir = join(temp_dir, 'failed')
+        with self.assertRaises(BadParameter):
+            compare_batch(manifest_fp, output_dir)
+        with open(join(output_dir, COLLATED_FN)) as f:
+            self.assertEqual([line.split('\t', 1)[0] for line in f],
+                             ['#Sample', 's1', 's2'])
+
+    def test_read_manifest(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+        base = join(temp_dir, 'manifest')
+        makedirs(base)
+        fp = join(base, 'manifest.txt')
+
+        with open(fp, 'w') as f:
+            f.write('a\tx.txt\t/y.txt\n\n#b\tx\ty\nb\tz\tw\n')
+        self.assertEqual(read_manifest(fp),
+                         {'a': (join(base, 'x.txt'), '/y.txt'),
+                          'b': (join(base, 'z'), join(base, 'w'))})
+
+        for bad in ('', 'a\tx\n', 'a\tx\ty\na\tz\tw\n', 'a/b\tx\ty\n',
+                    'a\t-\ty\n'):
+            with open(fp, 'w') as f:
+                f.write(bad)
+            with self.assertRaises(BadParameter):
+                read_manifest(fp)
+
+    def test_compare_jobs(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        exp_dir, obs_dir = join(temp_dir, 'exp'), join(temp_dir, 'obs')
+        compare(self.interest_fp, self.other_fp, exp_dir, hits_to_first=True,
+                hits_to_second=True)
+        compare(self.interest_fp, self.other_fp, obs_dir, hits_to_first=True,
+                hits_to_second=True, jobs=3)
+
+        self.assertEqual(sorted(listdir(exp_dir)), sorted(listdir(obs_dir)))
+        for fp in listdir(exp_dir):
+            with open(join(exp_dir, fp)) as exp, \
+                    open(join(obs_dir, fp)) as out:
+                self.assertEqual(exp.read(), out.read())
+
+    def test_compare_compressed(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        inputs = []
+        makedirs(join(temp_dir, 'compressed'))
+        for fp in (self.interest_fp, self.other_fp):
+            inputs.append(join(temp_dir, 'compressed', basename(fp) + '.gz'))
+            with open(fp) as f, gzip.open(inputs[-1], 'wb') as out:
+                out.write(f.read())
+
+        compare(inputs[0], inputs[1], temp_dir, jobs=2)
+
+        fp = 'summary_p1_70-a1_50_p2_70-a2_50.txt'
+        with open(join(self.base, 'compare-tests', fp)) as exp, \
+                open(join(temp_dir, fp)) as out:
+            self.assertItemsEqual(exp.readlines(), out.readlines())
+
+    def test_compare_pipes(self):
+        """Both searches can write to a pipe at the same time"""
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        exp_dir, obs_dir = join(temp_dir, 'exp'), join(temp_dir, 'obs')
+        compare(self.interest_fp, self.other_fp, exp_dir, hits_to_first=True,
+                hits_to_second=True)
+
+        makedirs(join(temp_dir, 'pipes'))
+        fifos = []
+        for fp in (self.interest_fp, self.other_fp):
+            fifos.append(join(temp_dir, 'pipes', basename(fp)))
+            mkfifo(fifos[-1])
+
+        def search(fp, fifo):
+            with open(fp) as f, open(fifo, 'w') as out:
+                out.write(f.read())
+        threads = [Thread(target=search, args=args)
+                   for args in zip((self.interest_fp, self.other_fp), fifos)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        compare(fifos[0], fifos[1], obs_dir, hits_to_first=True,
+                hits_to_second=True, cache_dir=join(temp_dir, 'cache'),
+                jobs=2)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(listdir(exp_dir)), sorted(listdir(obs_dir)))
+        for fp in listdir(exp_dir):
+            if fp.startswith('compile_output'):
+                continue
+            with open(join(exp_dir, fp)) as exp, \
+                    open(join(obs_dir, fp)) as out:
+                self.assertEqual(exp.read(), out.read())
+
+        with self.assertRaises(BadParameter):
+            compare('-', '-', obs_dir)
+
+    def test_compare_report(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        compare(self.interest_fp, self.other_fp, temp_dir, report=True)
+
+        with open(join(temp_dir, 'platypus_report.json')) as f:
+            stages = load(f)['stages']
+        self.assertEqual([s['name'] for s in stages],
+                         ['parse_first_database', 'parse_second_database',
+                          'process_results'])
+        self.assertTrue(stages[0]['counters']['queries'] > 0)
+        self.assertEqual(stages[0]['input_bytes'], getsize(self.interest_fp))
+        self.assertTrue(stages[2]['counters']['bytes_written'] > 0)
+
+    def test_compare_consolidated(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        compare(self.interest_fp, self.other_fp, temp_dir, hits_to_first=True,
+                hits_to_second=True, consolidated=True, compress=True)
+        self.assertEqual(sorted(listdir(temp_dir)), [
+            'compile_output.txt', 'compile_output_no_nohits.txt',
+            'results.txt.gz', 'results_index.txt'])
+
+        files = ['compile_output.txt', 'compile_output_no_nohits.txt',
+                 'hits_to_first_db_p1_70-a1_50_p2_70-a2_50.txt',
+                 'hits_to_second_db_p1_70-a1_50_p2_70-a2_50.txt',
+                 'summary_p1_70-a1_50_p2_70-a2_50.txt']
+        for fp in files:
+            out_fp = join(temp_dir, fp)
+            if not fp.startswith('compile_output'):
+                output, combination = fp[:-len('.txt')].split('_p1_')
+                extract(temp_dir, 'p1_' + combination, output, out_fp)
+
+            with open(join(self.base, 'compare-tests', fp)) as exp, \
+                    open(out_fp) as out:
+                self.assertItemsEqual(exp.readlines(), out.readlines())
+
+        with self.assertRaises(BadParameter):
+            extract(temp_dir, '1', 'summary')
+
+    def test_compare_counts_only(self):
+        temp_dir = mkdtemp()
+        self.to_delete.append(temp_dir)
+
+        compare(self.interest_fp, self.other_fp, temp_dir, hits_to_first=True,
+                counts_only=True)
+
+        files = ['compile_output.txt', 'compile_output_no_nohits.txt']
+        self.assertEqual(sorted(listdir(temp_dir)), files)
+        for fp in files:
+            with open(join(self.base, 'compare-tests', fp)) as exp, \
+                    open(join(temp_dir, fp)) as out:
+                self.assertItemsEqual(exp.readlines(), out.readlines())
+
     def test_compare_exceptions(self):
-        temp_dir = gettempdir()
+        temp_dir = mkdtemp()
         self.to_delete.append(temp_dir)
 
         with self.assertRaises(BadParameter):
@@ -132,7 +673,7 @@ class TestCompare(TestCase):
                     interest_alg_lens=(20,), other_alg_lens=(100, 10))
 
     def test_hits_to_both(self):
-        temp_dir = gettempdir()
+        temp_dir = mkdtemp()
         self.to_delete.append(temp_dir)
 
         compare(self.interest_fp, self.other_fp, temp_dir, hits_to_first=True,
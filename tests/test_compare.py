@@ -8,7 +8,8 @@
 from __future__ import division
 
 from platypus.compare import (
-    sequences_from_query, PlatypusParseError, PlatypusValueError)
+    sequences_from_query, sequences_from_queries, QueryMatcher,
+    PlatypusParseError, PlatypusValueError)
 
 from os.path import dirname, join, abspath
 from unittest import TestCase, main
@@ -67,6 +68,68 @@ class TopLevelTests(TestCase):
             PlatypusValueError, sequences_from_query,
             self.broken_taxonomy_lines, 'parahaemolyticus')
 
+    def test_sequences_from_queries(self):
+        """Search several queries at once"""
+        queries = ['Beggiatoa', 'rumba', 'vibrio', 'sp. SS']
+        obs = sequences_from_queries(self.taxonomy_lines, queries)
+
+        exp = {}
+        for i, query in enumerate(queries):
+            for sequence_id in sequences_from_query(self.taxonomy_lines,
+                                                    query):
+                exp[sequence_id] = exp.get(sequence_id, ()) + (i,)
+        self.assertEqual(obs, exp)
+        self.assertEqual(obs['NZ_ABBY01000221|640963012'], (0, 2, 3))
+
+        self.assertEqual(sequences_from_queries(self.taxonomy_fp, ['Rumba']),
+                         {})
+
+    def test_sequences_from_queries_exceptions(self):
+        """Check exceptions are raised accordingly"""
+        self.assertRaises(
+            PlatypusParseError, sequences_from_queries,
+            self.taxonomy_lines.replace('\t', 'BOOOM'), ['Beggiatoa'])
+
+        self.assertRaises(
+            PlatypusValueError, sequences_from_queries,
+            self.broken_taxonomy_lines, ['Beggiatoa', 'parahaemolyticus'])
+
+
+class QueryMatcherTests(TestCase):
+
+    def test_find(self):
+        """Find overlapping queries and queries inside other queries"""
+        matcher = QueryMatcher(['he', 'She', 'his', 'hers', 'xyz', 'he'])
+        self.assertEqual(matcher.find('ushers'), (0, 1, 3, 5))
+        self.assertEqual(matcher.find('this'), (2,))
+        self.assertEqual(matcher.find('hishers'), (0, 1, 2, 3, 5))
+        self.assertEqual(matcher.find('abc'), ())
+        self.assertEqual(matcher.find(''), ())
+
+    def test_find_failure_links(self):
+        """The scan continues from the longest suffix that is a prefix"""
+        matcher = QueryMatcher(['abcd', 'bcx', 'aab'])
+        self.assertEqual(matcher.find('abcx'), (1,))
+        self.assertEqual(matcher.find('aabcd'), (0, 2))
+        self.assertEqual(matcher.find('abcabcd'), (0,))
+
+    def test_find_empty_query(self):
+        """An empty query matches everything, like the substring test"""
+        matcher = QueryMatcher(['', 'a'])
+        self.assertEqual(matcher.find(''), (0,))
+        self.assertEqual(matcher.find('bab'), (0, 1))
+
+    def test_find_same_as_substring(self):
+        """Compare with the substring test of each query"""
+        queries = ['aa', 'aab', 'ab', 'b', 'bab', 'abba', 'baa', 'aaa']
+        matcher = QueryMatcher(queries)
+        texts = ['']
+        for _ in range(6):
+            texts += [text + c for text in texts for c in 'ab']
+        for text in set(texts):
+            self.assertEqual(matcher.find(text), tuple(
+                i for i, query in enumerate(queries) if query in text))
+
 
 TAXONOMY_LINES = """NZ_AAOS01000254|638341243\tVibrioYersinia pestis bv Orientalis IP275
 NZ_AAOS01000267|638341243\tVibrioYersinia pestis bv Orientalis IP275
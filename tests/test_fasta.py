@@ -0,0 +1,217 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import division
+
+import gzip
+from os import listdir, makedirs
+from os.path import isdir, join
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import gettempdir
+from unittest import TestCase, main
+
+from platypus.compare import PlatypusParseError
+from platypus.fasta import (FastaIndex, OutputFiles, fasta_index, index_fasta,
+                            route_fasta, sequence_id, split_fasta,
+                            split_fasta_indexed, split_fasta_parallel)
+
+
+class FastaTests(TestCase):
+    def setUp(self):
+        self.records = ['>a description\nACGT\nAC\n', '>b\nGGG\n',
+                        '>c\tother\nTT\n', '>d\n', '>e x\nAAAA\nCCCC\nG\n']
+        self.fasta = ''.join(self.records)
+
+    def test_sequence_id(self):
+        self.assertEqual(sequence_id('a description'), 'a')
+        self.assertEqual(sequence_id(' a\tdescription'), 'a')
+        self.assertEqual(sequence_id(''), '')
+
+    def test_split_fasta(self):
+        """Copy the records verbatim regardless of the block size"""
+        ids = {'a', 'c', 'd'}
+        for block_size in (1, 5, 16, 1024):
+            interest, rest = StringIO(), StringIO()
+            obs = split_fasta(StringIO(self.fasta), ids, interest, rest,
+                              block_size=block_size)
+            self.assertEqual(obs, (3, 2))
+            self.assertEqual(interest.getvalue(),
+                             ''.join(self.records[i] for i in (0, 2, 3)))
+            self.assertEqual(rest.getvalue(),
+                             ''.join(self.records[i] for i in (1, 4)))
+
+    def test_split_fasta_edges(self):
+        """Empty inputs, leading blank lines and no final new line"""
+        interest, rest = StringIO(), StringIO()
+        self.assertEqual(split_fasta(StringIO(''), {'a'}, interest, rest),
+                         (0, 0))
+
+        obs = split_fasta(StringIO('\n\n>a\nAC\n>b\nGT'), {'a'}, interest,
+                          rest, block_size=2)
+        self.assertEqual(obs, (1, 1))
+        self.assertEqual(interest.getvalue(), '>a\nAC\n')
+        self.assertEqual(rest.getvalue(), '>b\nGT')
+
+    def test_split_fasta_bad(self):
+        """Raise if the data doesn't start with a header"""
+        for data in ('ACGT\n>a\nAC\n', 'ACGT\n'):
+            with self.assertRaises(PlatypusParseError):
+                split_fasta(StringIO(data), {'a'}, StringIO(), StringIO())
+
+    def test_route_fasta(self):
+        """Write each record to all its files"""
+        first, second, rest = StringIO(), StringIO(), StringIO()
+        both = (first, second)
+        routes = {'a': both, 'b': (second,), 'd': both}
+        for block_size in (1, 1024):
+            for fh in (first, second, rest):
+                fh.truncate(0)
+            obs = route_fasta(StringIO(self.fasta), routes, (rest,),
+                              block_size=block_size)
+            self.assertEqual(obs, {both: 2, (second,): 1, (rest,): 2})
+            self.assertEqual(first.getvalue(),
+                             self.records[0] + self.records[3])
+            self.assertEqual(second.getvalue(), ''.join(
+                self.records[i] for i in (0, 1, 3)))
+            self.assertEqual(rest.getvalue(),
+                             self.records[2] + self.records[4])
+
+    def test_output_files(self):
+        """Files are reopened to append when too many are open"""
+        temp_dir = join(gettempdir(), 'platypus-test-fasta')
+        if not isdir(temp_dir):
+            makedirs(temp_dir)
+        self.addCleanup(rmtree, temp_dir)
+
+        with open(join(temp_dir, 'a.txt'), 'w') as f:
+            f.write('old contents')
+
+        with OutputFiles(max_open=2, buffer_size=1) as files:
+            outputs = [files.open(join(temp_dir, name))
+                       for name in ('a.txt', 'b.txt', 'c.txt')]
+            for i in range(4):
+                for output in outputs:
+                    output.write('%s%d\n' % (output.name[-5], i))
+            self.assertEqual(sum(o.fh is not None for o in outputs), 2)
+
+        for output in outputs:
+            self.assertTrue(output.fh is None)
+            with open(output.name) as f:
+                self.assertEqual(f.read(), ''.join(
+                    '%s%d\n' % (output.name[-5], i) for i in range(4)))
+
+        with self.assertRaises(ValueError):
+            OutputFiles(max_open=0)
+
+
+class FastaIndexTests(TestCase):
+    def setUp(self):
+        self.temp_dir = join(gettempdir(), 'platypus-test-fasta-index')
+        if not isdir(self.temp_dir):
+            makedirs(self.temp_dir)
+        self.cache_dir = join(self.temp_dir, 'cache')
+        self.fp = join(self.temp_dir, 'seqs.fna')
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def write(self, data):
+        with open(self.fp, 'w') as f:
+            f.write(data)
+
+    def test_index_fasta(self):
+        arrays = index_fasta(StringIO('\n>b x\nAC\n>a\nGG\n>b\n'),
+                             block_size=2)
+        self.assertEqual(arrays['offsets'].tolist(), [1, 9, 15, 18])
+        self.assertEqual(arrays['ids'].tolist(), ['a', 'b', 'b'])
+        self.assertEqual(arrays['records'].tolist(), [1, 0, 2])
+
+        self.assertEqual(index_fasta(StringIO('>a\r\nAC\r\n')), None)
+        with self.assertRaises(PlatypusParseError):
+            index_fasta(StringIO('AC\n>a\n'))
+
+    def test_records(self):
+        index = FastaIndex(index_fasta(StringIO('>b\n>a\n>c\n>b\n')))
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.records(['b', 'c']).tolist(), [0, 2, 3])
+        self.assertEqual(index.records({'a', 'z', 'longer'}).tolist(), [1])
+        self.assertEqual(index.records([]).tolist(), [])
+
+    def test_split_fasta_indexed(self):
+        """The same outputs as split_fasta"""
+        data = ('\n>a desc\nAC\nGT\n>b\nT\n>c\n\n>a\nA\n>d\nCC\n'
+                '>e\nGG')
+        self.write(data)
+        index = fasta_index(self.fp, self.cache_dir)
+
+        for ids in ({'a'}, {'b', 'c'}, {'a', 'd', 'e'}, set(), {'z'},
+                    {'a', 'b', 'c', 'd', 'e'}):
+            exp = StringIO(), StringIO()
+            exp_counts = split_fasta(StringIO(data), ids, *exp)
+            obs = StringIO(), StringIO()
+            obs_counts = split_fasta_indexed(self.fp, index, ids, *obs)
+
+            self.assertEqual(obs_counts, exp_counts)
+            self.assertEqual(obs[0].getvalue(), exp[0].getvalue())
+            self.assertEqual(obs[1].getvalue(), exp[1].getvalue())
+
+    def test_split_fasta_parallel(self):
+        """The same outputs as split_fasta with any number of ranges"""
+        data = ''.join('>s%d desc\n%s\n%s\n' % (i, 'ACGT' * i, 'GG' * i)
+                       for i in range(50))
+        self.write('\n' + data)
+        ids = {'s%d' % i for i in range(50) if i % 3 == 0 or 20 < i < 30}
+
+        exp = StringIO(), StringIO()
+        exp_counts = split_fasta(StringIO(data), ids, *exp)
+        for jobs, range_size in ((2, 1), (2, 100), (3, 1024 ** 2), (1, 1)):
+            obs = StringIO(), StringIO()
+            with open(self.fp, 'U') as f:
+                obs_counts = split_fasta_parallel(f, ids, obs[0], obs[1],
+                                                  jobs, range_size)
+            self.assertEqual(obs_counts, exp_counts)
+            self.assertEqual(obs[0].getvalue(), exp[0].getvalue())
+            self.assertEqual(obs[1].getvalue(), exp[1].getvalue())
+
+    def test_split_fasta_parallel_serial(self):
+        """Carriage returns and errors are handled like split_fasta"""
+        self.write('>a\r\nAC\r\n>b\r\nGT\r\n')
+        interest, rest = StringIO(), StringIO()
+        with open(self.fp, 'U') as f:
+            self.assertEqual(split_fasta_parallel(f, {'b'}, interest, rest, 2,
+                                                  range_size=1), (1, 1))
+        self.assertEqual(interest.getvalue(), '>b\nGT\n')
+        self.assertEqual(rest.getvalue(), '>a\nAC\n')
+
+        self.write('AC\n>a\nGT\n>b\n')
+        with open(self.fp, 'U') as f, self.assertRaises(PlatypusParseError):
+            split_fasta_parallel(f, {'b'}, StringIO(), StringIO(), 2,
+                                 range_size=1)
+
+    def test_fasta_index(self):
+        """The index is cached, compressed files are not indexed"""
+        self.write('>a\nAC\n')
+        self.assertEqual(len(fasta_index(self.fp, self.cache_dir)), 1)
+        self.assertEqual(len(fasta_index(self.fp, self.cache_dir)), 1)
+        self.assertEqual(len(listdir(self.cache_dir)), 1)
+
+        # the file is marked as not indexable
+        self.write('>a\r\nAC\r\n')
+        self.assertEqual(fasta_index(self.fp, self.cache_dir), None)
+        self.assertEqual(fasta_index(self.fp, self.cache_dir), None)
+        self.assertEqual(len(listdir(self.cache_dir)), 2)
+
+        gz_fp = join(self.temp_dir, 'seqs.fna.gz')
+        with gzip.open(gz_fp, 'wb') as f:
+            f.write('>a\nAC\n')
+        self.assertEqual(fasta_index(gz_fp, self.cache_dir), None)
+        self.assertEqual(len(listdir(self.cache_dir)), 2)
+
+
+if __name__ == '__main__':
+    main()
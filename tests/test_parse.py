@@ -7,13 +7,26 @@
 # ----------------------------------------------------------------------------
 from __future__ import division
 
+import gzip
+from collections import OrderedDict
 from copy import copy
 from unittest import TestCase, main
+from os import listdir
 from os.path import join, dirname
+from shutil import rmtree
+from tempfile import gettempdir, mkdtemp
+
+import numpy as np
+import numpy.testing as npt
 
 from platypus.parse import (
     parse_first_database, parse_second_database, process_results,
-    M9, parse_m9)
+    M9, parse_m9, parse_m9_columnar, parse_m9_cached, parse_m9_parallel,
+    M9_COLUMNS, m9_dtype, BLOCK_SIZE, GROUP_MEMORY, group_records,
+    best_hit_indices, pareto_front, best_in_front, MergedDatabases, BestHits,
+    SubjectCounts, ConsolidatedOutput, read_consolidated)
+from platypus.cache import create_cache_dir
+from platypus.compare import PlatypusParseError, PlatypusValueError
 
 
 class TopLevelTests(TestCase):
@@ -111,6 +124,222 @@ class TopLevelTests(TestCase):
         obs = list(parse_m9(self.blasttest))
         self.assertEqual(obs, exp)
 
+    def _as_tuples(self, records):
+        """Keep only the columnar fields of the namedtuples"""
+        return [(q, [tuple(getattr(h, c) for c in M9_COLUMNS) for h in hits])
+                for q, hits in records]
+
+    def test_parse_m9_columnar_sortmerna(self):
+        """Parse sortmerna output into structured arrays"""
+        exp = self._as_tuples(parse_m9(self.smrtest))
+
+        self.smrtest.seek(0)
+        obs = [(q, hits.tolist()) for q, hits in
+               parse_m9_columnar(self.smrtest)]
+        self.assertEqual(obs, exp)
+
+    def test_parse_m9_columnar_blast(self):
+        """Parse blast output into structured arrays"""
+        exp = [(q, h) if q is not None else (None, [])
+               for q, h in self._as_tuples(parse_m9(self.blasttest))]
+
+        self.blasttest.seek(0)
+        obs = [(q, hits.tolist()) for q, hits in
+               parse_m9_columnar(self.blasttest)]
+        self.assertEqual(obs, exp)
+
+    def test_parse_m9_columnar_blocks(self):
+        """Records spanning several blocks are kept together"""
+        exp = [(q, h) if q is not None else (None, [])
+               for q, h in self._as_tuples(parse_m9(self.db1))]
+
+        # small blocks from a file and from an iterable of lines
+        for size in (1, 100, 1000):
+            self.db1.seek(0)
+            obs = [(q, hits.tolist()) for q, hits in
+                   parse_m9_columnar(self.db1, block_size=size)]
+            self.assertEqual(obs, exp)
+
+            self.db1.seek(0)
+            obs = [(q, hits.tolist()) for q, hits in
+                   parse_m9_columnar(self.db1.readlines(), block_size=size)]
+            self.assertEqual(obs, exp)
+
+    def test_parse_m9_queries(self):
+        """Skipping queries gives the records of the rest"""
+        all_records = self._as_tuples(parse_m9(self.db1))
+        names = sorted({q for q, _ in all_records if q is not None})
+        for keep in (set(), set(names[::3]), set(names[1:]), set(names)):
+            # skipped queries end a record as a change of query does
+            exp, previous = [], None
+            for q, h in all_records:
+                if q in keep:
+                    if exp and previous == q:
+                        exp[-1] = (q, exp[-1][1] + h)
+                    else:
+                        exp.append((q, h))
+                previous = q
+
+            self.db1.seek(0)
+            obs = [(q, h) for q, h in
+                   self._as_tuples(parse_m9(self.db1, queries=keep))
+                   if q is not None]
+            self.assertEqual(obs, exp)
+
+            for size in (1, 100, BLOCK_SIZE):
+                self.db1.seek(0)
+                obs = [(q, hits.tolist()) for q, hits in
+                       parse_m9_columnar(self.db1, block_size=size,
+                                         queries=keep) if q is not None]
+                self.assertEqual(obs, exp)
+
+            self.db1.seek(0)
+            obs = [(q, hits.tolist()) for q, hits in
+                   parse_m9_parallel(self.db1, 3, range_size=100,
+                                     queries=keep) if q is not None]
+            self.assertEqual(obs, exp)
+
+    def test_parse_m9_queries_interleaved(self):
+        """Lines of a skipped query between two lines of a kept query"""
+        lines = ['q1\ts1\t90\t100\t0\t0\t1\t100\t1\t100\t1e-10\t50\n',
+                 'q2\ts1\t90\t100\t0\t0\t1\t100\t1\t100\t1e-10\t50\n',
+                 'q1\ts2\t95\t100\t0\t0\t1\t100\t1\t100\t1e-10\t60\n']
+        exp = [('q1', [('q1', 's1', 90.0, 100, 1e-10, 50.0)]),
+               ('q1', [('q1', 's2', 95.0, 100, 1e-10, 60.0)])]
+        obs = [(q, hits.tolist()) for q, hits in
+               parse_m9_columnar(lines, queries={'q1'})]
+        self.assertEqual(obs, exp)
+
+        obs = self._as_tuples(parse_m9(lines, queries={'q1'}))
+        self.assertEqual(obs, exp)
+
+    def test_parse_m9_columnar_bad(self):
+        """Raise on an incomplete record"""
+        with self.assertRaises(ValueError):
+            list(parse_m9_columnar(self.smrtest_bad))
+
+    def test_parse_m9_cached(self):
+        """Parse once and read the next times from the cache"""
+        cache_dir = join(gettempdir(), 'platypus-test-cache')
+        create_cache_dir(cache_dir)
+        self.addCleanup(rmtree, cache_dir)
+
+        exp = [(q, hits.tolist()) for q, hits in
+               parse_m9_columnar(self.blasttest, reduce=True)]
+
+        self.blasttest.seek(0)
+        obs = [(q, hits.tolist()) for q, hits in
+               parse_m9_cached(self.blasttest, cache_dir)]
+        self.assertEqual(obs, exp)
+        self.assertEqual(len(listdir(cache_dir)), 1)
+
+        # the file is not read again
+        obs = [(q, hits.tolist()) for q, hits in
+               parse_m9_cached(self.blasttest, cache_dir)]
+        self.assertEqual(obs, exp)
+        self.assertEqual(self.blasttest.read(), '')
+
+    def test_parse_m9_cached_lines(self):
+        """Inputs that are not files are never cached"""
+        cache_dir = join(gettempdir(), 'platypus-test-cache')
+        create_cache_dir(cache_dir)
+        self.addCleanup(rmtree, cache_dir)
+
+        exp = [(q, hits.tolist()) for q, hits in
+               parse_m9_columnar(self.db1, reduce=True)]
+        self.db1.seek(0)
+        obs = [(q, hits.tolist()) for q, hits in
+               parse_m9_cached(self.db1.readlines(), cache_dir)]
+        self.assertEqual(obs, exp)
+        self.assertEqual(listdir(cache_dir), [])
+
+    def test_parse_m9_parallel(self):
+        """Parsing ranges of the file in parallel gives the same records"""
+        for fp in (self.db1, self.blasttest, self.smrtest):
+            for reduce in (False, True):
+                fp.seek(0)
+                exp = [(q, hits.tolist()) for q, hits in
+                       parse_m9_columnar(fp, reduce=reduce)]
+
+                for range_size in (10, 500, 10000):
+                    fp.seek(0)
+                    obs = [(q, hits.tolist()) for q, hits in
+                           parse_m9_parallel(fp, 3, reduce=reduce,
+                                             range_size=range_size)]
+                    self.assertEqual(obs, exp)
+
+        # lines that don't come from a file are parsed serially
+        self.db1.seek(0)
+        exp = [(q, hits.tolist()) for q, hits in parse_m9_columnar(self.db1)]
+        self.db1.seek(0)
+        obs = [(q, hits.tolist()) for q, hits in
+               parse_m9_parallel(self.db1.readlines(), 3)]
+        self.assertEqual(obs, exp)
+
+    def test_parse_m9_parallel_bad(self):
+        """Raise on an incomplete record"""
+        with self.assertRaises(ValueError):
+            list(parse_m9_parallel(self.smrtest_bad, 2))
+
+    def test_best_hit_indices(self):
+        """Find the best hits of several queries at once"""
+        hits = np.array([('q1', 's1', 99.0, 100, 0.0, 150.0),
+                         ('q1', 's2', 90.0, 200, 0.0, 180.0),
+                         ('q1', 's3', 90.0, 200, 0.0, 180.0),
+                         ('q2', 's1', 80.0, 40, 0.1, 30.0),
+                         ('q3', 's4', 100.0, 300, 0.0, 0.0),
+                         ('q3', 's5', 70.0, 300, 0.0, 20.0)],
+                        dtype=m9_dtype(2, 2))
+        offsets = np.array([0, 3, 4, 6])
+
+        obs = best_hit_indices(hits, offsets, [70, 95], [50, 150])
+        # q3's first hit has a bit score of zero so it is never selected
+        exp = np.array([[1, 1, 0, -1],
+                        [-1, -1, -1, -1],
+                        [5, 5, -1, -1]])
+        npt.assert_equal(obs, exp)
+
+        obs = best_hit_indices(hits, offsets, [], [50])
+        self.assertEqual(obs.shape, (3, 0))
+
+    def test_pareto_front(self):
+        """Only the hits that can be selected are kept, in priority order"""
+        hits = np.array([('q1', 's1', 99.0, 100, 0.0, 150.0),
+                         ('q1', 's2', 90.0, 200, 0.0, 180.0),
+                         ('q1', 's3', 90.0, 200, 0.0, 180.0),
+                         ('q1', 's4', 80.0, 150, 0.0, 100.0),
+                         ('q1', 's5', 100.0, 20, 0.0, 0.0),
+                         ('q1', 's6', 85.0, 250, 0.0, 120.0)],
+                        dtype=m9_dtype(2, 2))
+
+        obs = pareto_front(hits)
+        self.assertEqual(obs['subject'].tolist(), ['s2', 's1', 's6'])
+        self.assertEqual(best_in_front(obs, 95, 50), 1)
+        self.assertEqual(best_in_front(obs, 70, 220), 2)
+        self.assertEqual(best_in_front(obs, 100, 10), -1)
+
+        self.assertEqual(len(pareto_front(hits[4:5])), 0)
+
+    def test_pareto_front_lookup(self):
+        """Any thresholds select the same hit in the front and in all hits"""
+        state = np.random.RandomState(0)
+        hits = np.zeros(300, dtype=m9_dtype(2, 2))
+        hits['subject'] = np.arange(300).astype(str)
+        hits['percent_id'] = state.randint(80, 101, 300)
+        hits['aln_length'] = state.randint(10, 60, 300)
+        hits['bitscore'] = state.randint(0, 40, 300)
+        front = pareto_front(hits)
+        self.assertTrue(len(front) < len(hits))
+
+        pcts, lens = range(78, 102, 2), range(5, 65, 5)
+        exp = best_hit_indices(hits, np.array([0, 300]), pcts, lens)[0]
+        for i, (p, a) in enumerate((p, a) for p in pcts for a in lens):
+            obs = best_in_front(front, p, a)
+            if exp[i] == -1:
+                self.assertEqual(obs, -1)
+            else:
+                self.assertEqual(front[obs], hits[exp[i]])
+
     def test_parse_first_database(self):
         """Parse first db should build best_hits correctly"""
 
@@ -138,6 +367,15 @@ class TopLevelTests(TestCase):
                        'alg_length': 512},
                  'b': {'subject_id': None, 'bit_score': -1}}]})
 
+    def test_parse_first_database_columnar(self):
+        """The columnar parser builds the same best_hits"""
+        exp = parse_first_database(self.db1, [80, 99], [50, 515])
+
+        self.db1.seek(0)
+        obs = parse_first_database(self.db1, [80, 99], [50, 515],
+                                   columnar=True)
+        self.assertEqual(obs, exp)
+
     def test_parse_second_database(self):
         """Check the second database is parsed correctly & updates best_hits"""
         best_hits = {
@@ -173,6 +411,173 @@ class TopLevelTests(TestCase):
                       'bit_score': 482.0, 'percentage_id': 88.79,
                       'alg_length': 455}}]})
 
+    def test_parse_second_database_columnar(self):
+        """The columnar parser updates best_hits in the same way"""
+        _, exp = parse_first_database(self.db1, [70, 90], [30, 100])
+        self.db1.seek(0)
+        _, obs = parse_first_database(self.db1, [70, 90], [30, 100],
+                                      columnar=True)
+
+        parse_second_database(self.db2, exp, [70, 90], [30, 100])
+        self.db2.seek(0)
+        parse_second_database(self.db2, obs, [70, 90], [30, 100],
+                              columnar=True)
+        self.assertEqual(obs, exp)
+
+    def test_parse_second_database_repeated_query(self):
+        """A fragment of a query without hits keeps the earlier best hit"""
+        temp_dir = mkdtemp()
+        self.addCleanup(rmtree, temp_dir)
+        line = '%s\t%s\t%.2f\t%d\t0\t0\t1\t%d\t1\t%d\t0.0\t%.1f\n'
+        db1, db2 = join(temp_dir, 'db1.txt'), join(temp_dir, 'db2.txt')
+        with open(db1, 'w') as f:
+            f.write(line % ('q1', 's1', 100, 100, 100, 100, 10))
+        with open(db2, 'w') as f:
+            f.write(line % ('q1', 't1', 95, 100, 100, 100, 60))
+            f.write(line % ('q2', 't1', 95, 100, 100, 100, 60))
+            f.write(line % ('q1', 't2', 50, 10, 10, 10, 5))
+
+        for columnar in (False, True):
+            with open(db1) as f:
+                _, best_hits = parse_first_database(f, [70], [30],
+                                                    columnar=columnar)
+            with open(db2) as f:
+                parse_second_database(f, best_hits, [70], [30],
+                                      columnar=columnar)
+            self.assertEqual(best_hits['q1'][0]['b']['subject_id'], 't1')
+
+    def test_parse_databases_cached(self):
+        """The cached results give the same best_hits"""
+        cache_dir = join(gettempdir(), 'platypus-test-cache')
+        create_cache_dir(cache_dir)
+        self.addCleanup(rmtree, cache_dir)
+
+        _, exp = parse_first_database(self.db1, [70, 90], [30, 100])
+        parse_second_database(self.db2, exp, [70, 90], [30, 100])
+
+        for _ in range(2):
+            self.db1.seek(0)
+            self.db2.seek(0)
+            _, obs = parse_first_database(self.db1, [70, 90], [30, 100],
+                                          cache_dir=cache_dir)
+            parse_second_database(self.db2, obs, [70, 90], [30, 100],
+                                  cache_dir=cache_dir)
+            self.assertEqual(obs, exp)
+            self.assertEqual(len(listdir(cache_dir)), 2)
+
+    def _interleaved_lines(self, fp):
+        """The hits of fp with the queries taking turns"""
+        queries = OrderedDict()
+        for line in fp:
+            if not line.startswith('#'):
+                queries.setdefault(line.split('\t', 1)[0], []).append(line)
+        lines, pending = [], list(queries.values())
+        while pending:
+            lines.extend(hits.pop(0) for hits in pending)
+            pending = [hits for hits in pending if hits]
+        return lines
+
+    def test_group_records(self):
+        """The records of a query are joined, in memory or spilled"""
+        temp_dir = join(gettempdir(), 'platypus-test-group')
+        create_cache_dir(temp_dir)
+        self.addCleanup(rmtree, temp_dir)
+
+        lines = self._interleaved_lines(self.db1)
+        self.db1.seek(0)
+        exp = [(q, hits.tolist()) for q, hits in
+               parse_m9_columnar(line for line in self.db1
+                                 if not line.startswith('#'))]
+        self.assertNotEqual(len(list(parse_m9_columnar(lines))), len(exp))
+
+        for memory in (0, 2000, GROUP_MEMORY):
+            obs = [(q, hits.tolist()) for q, hits in
+                   group_records(parse_m9_columnar(lines), memory, 3,
+                                 temp_dir)]
+            self.assertEqual(sorted(obs), sorted(exp))
+            self.assertEqual(listdir(temp_dir), [])
+
+        # in memory, the queries keep the order they are first found in
+        obs = [q for q, _ in group_records(parse_m9_columnar(lines))]
+        self.assertEqual(obs, [q for q, _ in exp])
+
+        # the hits of the lists of dicts of parse_m9 are converted
+        obs = [(q, hits.tolist()) for q, hits in
+               group_records(parse_m9(lines), 0, 3, temp_dir)]
+        self.assertEqual(sorted(obs), sorted(exp))
+
+        # records without a query are returned right away
+        hits = [('q1', 's1', 90.0, 100, 0.0, 50.0),
+                ('q1', 's2', 95.0, 100, 0.0, 60.0)]
+        records = [('q1', np.array(hits[:1], dtype=m9_dtype(2, 2))),
+                   (None, []),
+                   ('q1', np.array(hits[1:], dtype=m9_dtype(2, 2)))]
+        obs = [(q, np.asarray(h).tolist()) for q, h in group_records(records)]
+        self.assertEqual(obs, [(None, []), ('q1', hits)])
+
+    def test_parse_databases_unordered(self):
+        """Interleaved queries give the same best_hits when unordered"""
+        first = self._interleaved_lines(self.db1)
+        second = self._interleaved_lines(self.db2)
+        # the same hits with the queries one after the other
+        exp_total, exp = parse_first_database(
+            sorted(first, key=lambda line: line.split('\t', 1)[0]),
+            [70, 90], [30, 100])
+        parse_second_database(
+            sorted(second, key=lambda line: line.split('\t', 1)[0]), exp,
+            [70, 90], [30, 100])
+        for columnar in (False, True):
+            for memory in (0, GROUP_MEMORY):
+                total, obs = parse_first_database(
+                    first, [70, 90], [30, 100], columnar=columnar,
+                    unordered=True, group_memory=memory)
+                parse_second_database(second, obs, [70, 90], [30, 100],
+                                      columnar=columnar, unordered=True,
+                                      group_memory=memory)
+                self.assertEqual(total, exp_total)
+                self.assertEqual(obs, exp)
+
+    def _sorted_lines(self, fp):
+        """The hits of fp sorted by query"""
+        lines = [line for line in fp if not line.startswith('#')]
+        return sorted(lines, key=lambda line: line.split('\t', 1)[0])
+
+    def test_merged_databases(self):
+        """Merging sorted databases gives the same best hits"""
+        db1, db2 = self._sorted_lines(self.db1), self._sorted_lines(self.db2)
+        total, exp = parse_first_database(db1, [70, 90], [30, 100])
+        parse_second_database(db2, exp, [70, 90], [30, 100])
+
+        for columnar in (False, True):
+            obs = MergedDatabases(db1, db2, [70, 90], [30, 100], [70, 90],
+                                  [30, 100], columnar=columnar)
+            self.assertEqual(dict(obs), exp)
+            self.assertEqual(obs.total_queries, total)
+
+        # the queries not found in the first database are ignored
+        obs = MergedDatabases(db1[:1], db2, [70], [30], [80], [50])
+        self.assertEqual(
+            list(obs),
+            [('BLANK-TEST-NOT-IN-SECOND', [{
+                'a': {'evalue': 4e-133, 'bit_score': 482.0,
+                      'subject_id': 'NZ_ACZD01000120_647000262',
+                      'alg_length': 455, 'percentage_id': 88.79},
+                'b': {'subject_id': None, 'bit_score': -1}}])])
+
+    def test_merged_databases_unsorted(self):
+        """Raise if the databases are not sorted by query"""
+        obs = MergedDatabases(self.db1, self._sorted_lines(self.db2), [70],
+                              [30], [70], [30])
+        with self.assertRaises(PlatypusParseError):
+            list(obs)
+
+        self.db1.seek(0)
+        self.db2.seek(0)
+        obs = MergedDatabases(self._sorted_lines(self.db1), self.db2, [70],
+                              [30], [70], [30])
+        with self.assertRaises(PlatypusParseError):
+            list(obs)
+
     def test_process_results(self):
         """Check results are processed and summarized correctly"""
         best_hits = {
@@ -212,5 +617,265 @@ class TopLevelTests(TestCase):
             'db_interest': 0, 'db_other': 1, 'perfect_interest': 2, 'equal': 1,
             'filename': 'p1_0-a1_50_p2_0-a2_30'}])
 
+    def test_best_hits(self):
+        """Store the best hits and read them back as dictionaries"""
+        hits = np.zeros(4, dtype=m9_dtype(2, 2))
+        hits['query'] = ['q1', 'q1', 'q2', 'q3']
+        hits['subject'] = ['s1', 's2', 's1', 's3']
+        hits['percent_id'] = [99, 90, 80, 70]
+        hits['aln_length'] = [100, 200, 300, 400]
+        hits['bitscore'] = [10, 20, 30, 40]
+
+        best_hits = BestHits(2)
+        best_hits.add_first(['q1', None, 'q2'], hits,
+                            np.array([[0, 1], [-1, -1], [2, -1]]))
+        best_hits.add_first(['q3'], hits, np.array([[3, 3]]))
+        best_hits.add_second(['q2', 'q3', 'q4'], hits,
+                             np.array([[3, 3], [-1, 1], [0, 0]]))
+
+        self.assertEqual(len(best_hits), 3)
+        self.assertEqual(list(best_hits), ['q1', 'q2', 'q3'])
+        self.assertTrue('q2' in best_hits)
+        self.assertFalse('q4' in best_hits)
+        self.assertEqual(best_hits.subjects, ['s1', 's2', 's3'])
+        npt.assert_equal(best_hits.first, [[0, 1], [2, -1], [3, 3]])
+        npt.assert_equal(best_hits.second, [[-1, -1], [5, 5], [-1, 4]])
+
+        s1 = {'subject_id': 's1', 'percentage_id': 80.0, 'bit_score': 30.0,
+              'alg_length': 300, 'evalue': 0.0}
+        s3 = {'subject_id': 's3', 'percentage_id': 70.0, 'bit_score': 40.0,
+              'alg_length': 400, 'evalue': 0.0}
+        s2 = dict(s3, subject_id='s2', percentage_id=90.0, bit_score=20.0,
+                  alg_length=200)
+        none = {'subject_id': None, 'bit_score': -1}
+        self.assertEqual(best_hits['q2'], [{'a': s1, 'b': s3}, None])
+        self.assertEqual(best_hits['q3'], [{'a': s3, 'b': none},
+                                           {'a': s3, 'b': s2}])
+
+        # a query found again replaces the previous hits
+        best_hits.add_first(['q1'], hits, np.array([[2, 2]]))
+        self.assertEqual(list(best_hits), ['q2', 'q3', 'q1'])
+        self.assertEqual(best_hits['q1'], [{'a': s1, 'b': none}] * 2)
+        self.assertEqual(len(best_hits.first), 3)
+
+    def test_best_hits_update(self):
+        """Join two stores and read one back from its arrays"""
+        hits = np.zeros(4, dtype=m9_dtype(2, 2))
+        hits['query'] = ['q1', 'q1', 'q2', 'q3']
+        hits['subject'] = ['s1', 's2', 's1', 's3']
+        hits['bitscore'] = [10, 20, 30, 40]
+
+        best_hits = BestHits(2)
+        best_hits.add_first(['q2', 'q1'], hits, np.array([[2, -1], [0, 0]]))
+        other = BestHits(2)
+        other.add_first(['q3', 'q1'], hits, np.array([[3, 3], [1, 0]]))
+        other.add_second(['q1'], hits, np.array([[-1, 3]]))
+
+        best_hits.update(other)
+        self.assertEqual(list(best_hits), ['q2', 'q1', 'q3'])
+        self.assertEqual(best_hits.subjects, ['s1', 's2', 's3'])
+        # a higher bit score replaces a hit, a tie keeps the current one
+        self.assertEqual([v['a']['subject_id'] for v in best_hits['q1']],
+                         ['s2', 's1'])
+        self.assertEqual([v['b']['bit_score'] for v in best_hits['q1']],
+                         [-1, 40])
+        self.assertEqual(best_hits['q3'], other['q3'])
+
+        arrays = best_hits.as_arrays()
+        npt.assert_equal(arrays['queries'], ['q1', 'q2', 'q3'])
+        self.assertEqual(len(arrays['hits']), 5)
+        obs = BestHits(2, arrays)
+        self.assertEqual(list(obs), ['q1', 'q2', 'q3'])
+        self.assertEqual(dict(obs), dict(best_hits))
+
+    def test_process_results_best_hits(self):
+        """BestHits are summarized in the same way than dictionaries"""
+        _, best_hits = parse_first_database(self.db1, [70, 99], [30, 515],
+                                            columnar=True)
+        parse_second_database(self.db2, best_hits, [70, 80], [30, 500],
+                              columnar=True)
+
+        outputs = []
+        for values in (best_hits, dict(best_hits)):
+            output_dir = join(gettempdir(), 'platypus-test-%d' % len(outputs))
+            create_cache_dir(output_dir)
+            self.addCleanup(rmtree, output_dir)
+
+            results = process_results([70, 99], [30, 515], [70, 80],
+                                      [30, 500], values, output_dir, True,
+                                      True)
+            for result in results:
+                result.pop('summary_fh')
+                result.pop('db_seqs_counts')
+
+            files = {}
+            for fp in listdir(output_dir):
+                with open(join(output_dir, fp)) as f:
+                    files[fp] = sorted(f)
+            outputs.append((results, files))
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(len(outputs[0][1]), 12)
+
+    def test_process_results_hit_counts(self):
+        """The tables count the lines of the files of hits"""
+        _, best_hits = parse_first_database(self.db1, [70, 99], [30, 515],
+                                            columnar=True)
+        parse_second_database(self.db2, best_hits, [70, 80], [30, 500],
+                              columnar=True)
+
+        outputs = []
+        for values, hit_counts in ((best_hits, False), (best_hits, True),
+                                   (dict(best_hits), True)):
+            output_dir = join(gettempdir(), 'platypus-test-%d' % len(outputs))
+            create_cache_dir(output_dir)
+            self.addCleanup(rmtree, output_dir)
+
+            process_results([70, 99], [30, 515], [70, 80], [30, 500], values,
+                            output_dir, True, True, hit_counts)
+            files = {}
+            for fp in listdir(output_dir):
+                with open(join(output_dir, fp)) as f:
+                    files[fp] = f.read()
+            outputs.append(files)
+        self.assertEqual(outputs[1], outputs[2])
+
+        # the same counts as `sort | uniq -c` over the lines
+        tables = 0
+        for fn, lines in outputs[0].items():
+            if not fn.startswith('hits_to_'):
+                continue
+            exp = {}
+            for line in lines.splitlines():
+                exp[line] = exp.get(line, 0) + 1
+            table = outputs[1][fn.replace('hits_to_', 'hit_counts_')]
+            rows = [row.split('\t') for row in table.splitlines()]
+            self.assertEqual(rows[0], ['#Subject', 'Count'])
+            self.assertEqual({subject: int(count)
+                              for subject, count in rows[1:]}, exp)
+            counts = [-int(row[1]) for row in rows[1:]]
+            self.assertEqual(counts, sorted(counts))
+            tables += 1
+        self.assertEqual(tables, 8)
+
+    def test_process_results_consolidated(self):
+        """The table has the same lines than the files of each combination"""
+        _, best_hits = parse_first_database(self.db1, [70, 99], [30, 515],
+                                            columnar=True)
+        parse_second_database(self.db2, best_hits, [70, 80], [30, 500],
+                              columnar=True)
+        args = ([70, 99], [30, 515], [70, 80], [30, 500])
+
+        for values, hit_counts, compress in (
+                (best_hits, False, False), (dict(best_hits), False, True),
+                (best_hits, True, True), (dict(best_hits), True, False)):
+            exp_dir = join(gettempdir(), 'platypus-test-exp')
+            obs_dir = join(gettempdir(), 'platypus-test-obs')
+            for output_dir in (exp_dir, obs_dir):
+                create_cache_dir(output_dir)
+                self.addCleanup(rmtree, output_dir, True)
+
+            exp = process_results(*(args + (values, exp_dir, True, True,
+                                            hit_counts)))
+            obs = process_results(*(args + (values, obs_dir, True, True,
+                                            hit_counts, True, compress)))
+            for result in exp + obs:
+                result.pop('summary_fh')
+                result.pop('db_seqs_counts')
+            self.assertEqual(exp, obs)
+
+            table = 'results.txt.gz' if compress else 'results.txt'
+            self.assertEqual(sorted(listdir(obs_dir)),
+                             sorted(['results_index.txt', table]))
+            for fn in listdir(exp_dir):
+                output, combination = fn[:-len('.txt')].split('_p1_')
+                with open(join(exp_dir, fn)) as f:
+                    self.assertEqual(
+                        ''.join(read_consolidated(obs_dir, 'p1_' + combination,
+                                                  output)), f.read())
+            rmtree(exp_dir)
+            rmtree(obs_dir)
+
+    def test_process_results_counts_only(self):
+        """The same counts, without writing any file"""
+        _, best_hits = parse_first_database(self.db1, [70, 80, 99],
+                                            [30, 100, 515], columnar=True)
+        parse_second_database(self.db2, best_hits, [70, 75, 80],
+                              [30, 200, 500], columnar=True)
+        args = ([70, 80, 99], [30, 100, 515], [70, 75, 80], [30, 200, 500])
+
+        output_dir = join(gettempdir(), 'platypus-test-counts-only')
+        create_cache_dir(output_dir)
+        self.addCleanup(rmtree, output_dir)
+        exp = process_results(*(args + (best_hits, output_dir, True, True)))
+        for result in exp:
+            result['summary_fh'] = None
+            result['db_seqs_counts'] = {'a': None, 'b': None}
+        rmtree(output_dir)
+        create_cache_dir(output_dir)
+
+        for values in (best_hits, dict(best_hits), best_hits.iteritems()):
+            obs = process_results(*(args + (values, output_dir, True, True)),
+                                  counts_only=True)
+            self.assertEqual(obs, exp)
+            self.assertEqual(listdir(output_dir), [])
+
+    def test_consolidated_output(self):
+        output_dir = join(gettempdir(), 'platypus-test-consolidated')
+        create_cache_dir(output_dir)
+        self.addCleanup(rmtree, output_dir)
+
+        for compress in (False, True):
+            # tiny chunks, the lines of each output are split in several
+            table = ConsolidatedOutput(output_dir, compress, chunk_size=10,
+                                       buffer_size=25)
+            a = table.output(0, 'first', 'summary')
+            b = table.output(1, 'second', 'summary')
+            table.output(1, 'second', 'hits_to_first_db')
+            for i in range(20):
+                a.write('a%d\tx\n' % i)
+                if i % 3 == 0:
+                    b.writelines(['b%d\n' % i, 'bb%d\n' % i])
+            table.close()
+
+            exp_a = ['a%d\tx\n' % i for i in range(20)]
+            exp_b = [line for i in range(0, 20, 3)
+                     for line in ('b%d\n' % i, 'bb%d\n' % i)]
+            self.assertEqual(list(read_consolidated(output_dir, 0,
+                                                    'summary')), exp_a)
+            self.assertEqual(list(read_consolidated(output_dir, 'first',
+                                                    'summary')), exp_a)
+            self.assertEqual(list(read_consolidated(output_dir, '1',
+                                                    'summary')), exp_b)
+            self.assertEqual(list(read_consolidated(
+                output_dir, 'second', 'hits_to_first_db')), [])
+            with self.assertRaises(PlatypusValueError):
+                read_consolidated(output_dir, 'first', 'hits_to_first_db')
+            with self.assertRaises(PlatypusValueError):
+                read_consolidated(output_dir, 2, 'summary')
+
+            # the whole table, grouped by combination at the end
+            read = gzip.open if compress else open
+            with read(table.name) as f:
+                lines = f.readlines()
+            self.assertEqual(lines[0], '#Combination\tOutput\tLine\n')
+            self.assertEqual(sorted(lines[1:]), sorted(
+                ['0\tsummary\t' + line for line in exp_a] +
+                ['1\tsummary\t' + line for line in exp_b]))
+
+    def test_subject_counts(self):
+        output_dir = join(gettempdir(), 'platypus-test-counts')
+        create_cache_dir(output_dir)
+        self.addCleanup(rmtree, output_dir)
+        fp = join(output_dir, 'subject_counts.txt')
+        counts = SubjectCounts(fp)
+        counts.write('b\n')
+        counts.writelines(['a\n', 'None\n', 'c\n'])
+        counts.add_codes(np.array([0, 2, -1, 2, 2]), ['a', 'b', 'c'])
+        counts.close()
+        with open(fp) as f:
+            self.assertEqual(f.read(), '#Subject\tCount\nc\t4\nNone\t2\n'
+                                       'a\t2\nb\t1\n')
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,222 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import division
+
+from os import listdir
+from os.path import join, dirname
+from shutil import rmtree
+from tempfile import gettempdir
+from unittest import TestCase, main
+
+import numpy as np
+import numpy.testing as npt
+
+from platypus.cache import create_cache_dir
+from platypus.compare import PlatypusParseError, PlatypusValueError
+from platypus.parse import (parse_first_database, parse_second_database,
+                            process_results, BestHits)
+from platypus.state import (CATEGORIES, STATE_FN, CompareState,
+                            CompareSummary, sum_tallies, tally_best_hits)
+
+
+class StateTests(TestCase):
+    def setUp(self):
+        base = join(dirname(__file__), 'support_files')
+        self.first = [line for line in open(join(base, 'first_db.txt'))
+                      if not line.startswith('#')]
+        self.second = [line for line in open(join(base, 'second_db.txt'))
+                       if not line.startswith('#')]
+        self.thresholds = [70, 90], [30, 100], [70, 90], [30, 100]
+
+        self.temp_dir = join(gettempdir(), 'platypus-test-state')
+        create_cache_dir(self.temp_dir)
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def _best_hits(self, first, second, unordered=False):
+        pcts, lens, pcts_other, lens_other = self.thresholds
+        total, best_hits = parse_first_database(first, pcts, lens,
+                                                columnar=True,
+                                                unordered=unordered)
+        parse_second_database(second, best_hits, pcts_other, lens_other,
+                              columnar=True, unordered=unordered)
+        return total, best_hits
+
+    def _batch(self, name, lines):
+        """Write the lines of the first and second databases of a batch"""
+        fps = []
+        for db, db_lines in zip(('first', 'second'), lines):
+            fps.append(join(self.temp_dir, '%s_%s.txt' % (name, db)))
+            with open(fps[-1], 'w') as f:
+                f.writelines(db_lines)
+        return fps
+
+    def test_tally_best_hits(self):
+        """The same counts and tables as process_results"""
+        _, best_hits = self._best_hits(self.first, self.second)
+        counts, tallies = tally_best_hits(best_hits)
+
+        results = process_results(*(self.thresholds + (
+            best_hits, self.temp_dir, True, True, True)))
+        for i, result in enumerate(results):
+            self.assertEqual(counts[:, i].tolist(),
+                             [result[category] for category in CATEGORIES])
+            for db in ('a', 'b'):
+                keep = tallies[db]['combination'] == i
+                self.assertEqual(
+                    dict(zip(tallies[db]['subject'][keep].tolist(),
+                             tallies[db]['count'][keep].tolist())),
+                    result['db_seqs_counts'][db].counts)
+
+        counts, tallies = tally_best_hits(BestHits(4))
+        self.assertEqual(counts.tolist(), [[0] * 4] * 3)
+        self.assertEqual(len(tallies['a']['count']), 0)
+
+    def test_sum_tallies(self):
+        tallies = [{'combination': np.array([1, 0, 0]),
+                    'subject': np.array(['b', 'b', 'a']),
+                    'count': np.array([1, 2, 3])},
+                   {'combination': np.array([0, 1]),
+                    'subject': np.array(['longer', 'b']),
+                    'count': np.array([4, 1])}]
+        obs = sum_tallies(tallies)
+        npt.assert_equal(obs['combination'], [0, 0, 0, 1])
+        npt.assert_equal(obs['subject'], ['a', 'b', 'longer', 'b'])
+        npt.assert_equal(obs['count'], [3, 2, 4, 2])
+
+        obs = sum_tallies(tallies + [tallies[1]], [1, 1, -1])
+        npt.assert_equal(obs['combination'], [0, 0, 1])
+        npt.assert_equal(obs['count'], [3, 2, 1])
+
+    def test_add_batch(self):
+        """Adding the batches one at a time, as if they were compared at once
+
+        The second batch has new hits of a query of the first one, the best
+        of both are kept.
+        """
+        query = 'HABJ36W02EXF44'
+        better = [line.replace('\t1005\n', '\t2000\n') for line in
+                  self.first[:3]]
+        batches = [([line for line in self.first if line.startswith(query)],
+                    [line for line in self.second if line.startswith(query)]),
+                   ([line for line in self.first
+                     if not line.startswith(query)] + better,
+                    [line for line in self.second
+                     if not line.startswith(query)])]
+        self.assertTrue(better[0].endswith('\t2000\n'))
+
+        total, exp = self._best_hits(batches[0][0] + batches[1][0],
+                                     batches[0][1] + batches[1][1], True)
+        exp_counts, exp_tallies = tally_best_hits(exp)
+
+        state_dir = join(self.temp_dir, 'state')
+        for i, (first, second) in enumerate(batches):
+            fps = self._batch(i, (first, second))
+            state = CompareState(state_dir, *self.thresholds)
+            self.assertEqual(len(state.batches), i)
+            batch_total, best_hits = self._best_hits(first, second)
+            merged = state.add_batch(best_hits, batch_total, *fps)
+            self.assertEqual(sorted(merged), sorted(best_hits))
+
+        self.assertEqual(merged[query], exp[query])
+        self.assertEqual(merged[query][0]['a']['bit_score'], 2000)
+        self.assertEqual(sorted(listdir(state_dir)),
+                         ['batch-0.arrays', 'batch-1.arrays', STATE_FN])
+
+        # the state read back from the directory
+        for state in (state, CompareState(state_dir, *self.thresholds)):
+            self.assertEqual(state.total_queries, total)
+            npt.assert_equal(state.counts, exp_counts)
+            for db in ('a', 'b'):
+                for field in ('combination', 'subject', 'count'):
+                    npt.assert_equal(state.tallies[db][field],
+                                     exp_tallies[db][field])
+            self.assertEqual([r['equal'] for r in state.results()],
+                             exp_counts[0].tolist())
+
+        # the same files can't be added twice
+        self.assertTrue(state.added(*fps))
+        with self.assertRaises(PlatypusValueError):
+            state.add_batch(best_hits, batch_total, *fps)
+
+    def test_write_hit_counts(self):
+        _, best_hits = self._best_hits(self.first, self.second)
+        state = CompareState(join(self.temp_dir, 'state'),
+                             *self.thresholds)
+        state.add_batch(best_hits, 4, '-', '-')
+
+        exp_dir = join(self.temp_dir, 'exp')
+        create_cache_dir(exp_dir)
+        process_results(*(self.thresholds + (best_hits, exp_dir, True, True,
+                                             True)))
+
+        written = state.write_hit_counts(self.temp_dir, second=False)
+        self.assertEqual(len(written), 4)
+        for fp in written:
+            with open(fp) as obs, open(join(exp_dir, fp.split('/')[-1])) as \
+                    exp:
+                self.assertEqual(obs.read(), exp.read())
+
+    def test_summary(self):
+        """Summaries of two shards merged, as if compared at once"""
+        query = 'HABJ36W02EXF44'
+        exp_total, best_hits = self._best_hits(self.first, self.second)
+        exp_counts, exp_tallies = tally_best_hits(best_hits)
+
+        fps = []
+        for i in range(2):
+            total, shard = self._best_hits(
+                [line for line in self.first if line.startswith(query) == i],
+                [line for line in self.second if line.startswith(query) == i])
+            summary = CompareSummary(*self.thresholds)
+            summary.add(shard, total)
+            summary.sources = {'interest': ['first%d' % i],
+                               'other': ['second%d' % i]}
+            fps.append(join(self.temp_dir, 'partial%d' % i))
+            summary.write(fps[-1])
+
+        obs = CompareSummary.read(fps[0])
+        obs.update(CompareSummary.read(fps[1]))
+        self.assertEqual(obs.total_queries, exp_total)
+        self.assertEqual(obs.sources, {'interest': ['first0', 'first1'],
+                                       'other': ['second0', 'second1']})
+        npt.assert_equal(obs.counts, exp_counts)
+        for db in ('a', 'b'):
+            for field in ('combination', 'subject', 'count'):
+                npt.assert_equal(obs.tallies[db][field],
+                                 exp_tallies[db][field])
+
+        # the tallies are dropped if one of the summaries doesn't have them
+        summary = CompareSummary(*self.thresholds, tallies=False)
+        summary.add(best_hits, exp_total)
+        obs.update(summary)
+        self.assertIsNone(obs.tallies)
+        npt.assert_equal(obs.counts, exp_counts * 2)
+        with self.assertRaises(PlatypusValueError):
+            obs.write_hit_counts(self.temp_dir)
+
+        with self.assertRaises(PlatypusValueError):
+            obs.update(CompareSummary([70], [30], [70], [30]))
+        with self.assertRaises(PlatypusParseError):
+            CompareSummary.read(join(dirname(__file__), 'support_files',
+                                     'first_db.txt'))
+
+    def test_thresholds(self):
+        """The thresholds of a state can't change"""
+        state_dir = join(self.temp_dir, 'state')
+        state = CompareState(state_dir, *self.thresholds)
+        _, best_hits = self._best_hits(self.first, self.second)
+        state.add_batch(best_hits, 4, '-', '-')
+
+        with self.assertRaises(PlatypusValueError):
+            CompareState(state_dir, [70], [30], [70], [30])
+
+
+if __name__ == '__main__':
+    main()
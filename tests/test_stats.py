@@ -0,0 +1,93 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import division
+
+from json import load
+from os import makedirs
+from os.path import join, dirname, getsize, isdir
+from shutil import rmtree
+from tempfile import gettempdir
+from unittest import TestCase, main
+
+from platypus.parse import parse_m9_columnar
+from platypus.stats import Stats, peak_rss
+
+
+class StatsTests(TestCase):
+    def setUp(self):
+        self.db_fp = join(dirname(__file__), 'support_files', 'first_db.txt')
+        self.temp_dir = join(gettempdir(), 'platypus-test-stats')
+        if not isdir(self.temp_dir):
+            makedirs(self.temp_dir)
+
+    def tearDown(self):
+        rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_stages(self):
+        """Measure each stage and count the records read"""
+        stats = Stats()
+        with open(self.db_fp) as db, stats.stage('parse', [db]) as stage:
+            records = list(stats.count_records(parse_m9_columnar(db)))
+            stats.add('other', 2)
+        with stats.stage('second'):
+            stats.add('other')
+
+        queries = [q for q, _ in records if q is not None]
+        self.assertEqual(stage.counters,
+                         {'queries': len(queries), 'other': 2,
+                          'hits': sum(len(h) for q, h in records
+                                      if q is not None)})
+        self.assertEqual(stage.input_bytes, getsize(self.db_fp))
+        self.assertTrue(stage.wall >= 0 and stage.cpu >= 0)
+        self.assertTrue(0 < stage.peak_rss <= peak_rss())
+
+        obs = stats.as_dict()
+        self.assertEqual([s['name'] for s in obs['stages']],
+                         ['parse', 'second'])
+        self.assertEqual(obs['stages'][1]['counters'], {'other': 1})
+
+        # counters outside of a stage are ignored
+        stats.add('other')
+        self.assertEqual(stats.stages[1].counters, {'other': 1})
+
+    def test_progress(self):
+        """Write progress lines with the time left"""
+        lines = []
+        stats = Stats(progress=0, echo=lines.append)
+        with open(self.db_fp) as db, stats.stage('parse', [db]):
+            for record in stats.count_records(parse_m9_columnar(db)):
+                pass
+        self.assertTrue(lines)
+        self.assertTrue(lines[-1].startswith('[parse] '))
+        self.assertIn('queries', lines[-1])
+        self.assertIn('100.0% done, ETA 0s', lines[-1])
+
+        # nothing is written unless asked for
+        stats = Stats(echo=lines.append)
+        del lines[:]
+        with stats.stage('parse'):
+            stats.add('other')
+        self.assertEqual(lines, [])
+
+    def test_write(self):
+        """Write the report as JSON"""
+        stats = Stats()
+        with stats.stage('parse') as stage:
+            stage.add('queries', 10)
+        fp = join(self.temp_dir, 'report.json')
+        stats.write(fp)
+
+        with open(fp) as f:
+            obs = load(f)
+        self.assertEqual(obs['stages'][0]['name'], 'parse')
+        self.assertEqual(obs['stages'][0]['counters'], {'queries': 10})
+        self.assertIn('queries_per_second', obs['stages'][0]['rates'])
+
+
+if __name__ == '__main__':
+    main()
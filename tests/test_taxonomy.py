@@ -0,0 +1,108 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import division
+
+from os import listdir, utime
+from os.path import abspath, dirname, join
+from shutil import copy, rmtree
+from tempfile import gettempdir
+from unittest import TestCase, main
+
+from platypus.cache import create_cache_dir
+from platypus.compare import (sequences_from_query, sequences_from_queries,
+                              PlatypusParseError, PlatypusValueError)
+from platypus.taxonomy import TaxonomyIndex, build_index, taxonomy_index
+
+
+class TaxonomyIndexTests(TestCase):
+    def setUp(self):
+        support = join(dirname(abspath(__file__)), 'support_files')
+        self.taxonomy_fp = join(support, 'taxonomy_file.txt')
+        self.bacteria_fp = join(support, 'small-bacteria.contigs.txt')
+        self.queries = ['Vibrio', 'VIBRIO CHOLERAE', 'sp. ', 'pestis bv',
+                        'rumba', 'e', '', 'a\nb', 'ovibrio']
+
+        self.cache_dir = join(gettempdir(), 'platypus-test-taxonomy')
+        create_cache_dir(self.cache_dir)
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+
+    def test_sequences_from_query(self):
+        """The same results as searching the file"""
+        for fp in (self.taxonomy_fp, self.bacteria_fp):
+            with open(fp) as f:
+                index = TaxonomyIndex(build_index(f))
+            for query in self.queries:
+                self.assertEqual(index.sequences_from_query(query),
+                                 sequences_from_query(fp, query))
+
+    def test_sequences_from_queries(self):
+        """The same results as searching the file for several queries"""
+        for fp in (self.taxonomy_fp, self.bacteria_fp):
+            with open(fp) as f:
+                index = TaxonomyIndex(build_index(f))
+            self.assertEqual(index.sequences_from_queries(self.queries),
+                             sequences_from_queries(fp, self.queries))
+            self.assertEqual(index.sequences_from_queries([]), {})
+
+    def test_repeated_identifiers(self):
+        """Repeated identifiers are an error only if they match"""
+        index = TaxonomyIndex(build_index(
+            ['a\tSalmonella enterica', 'b\tVibrio cholerae',
+             'a\tVibrio cholerae', 'c\tSalmonella bongori']))
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.sequences_from_query('bongori'),
+                         {'c': 'Salmonella bongori'})
+        self.assertEqual(index.sequences_from_queries(['bongori']),
+                         {'c': (0,)})
+        with self.assertRaises(PlatypusValueError):
+            index.sequences_from_query('vibrio')
+        with self.assertRaises(PlatypusValueError):
+            index.sequences_from_queries(['bongori', 'enterica'])
+
+    def test_build_index_errors(self):
+        with self.assertRaises(PlatypusParseError):
+            build_index(['a\tb\tc'])
+        with self.assertRaises(PlatypusParseError):
+            build_index(['a b'])
+
+    def test_taxonomy_index_cached(self):
+        """The index is written once and rebuilt when the file changes"""
+        fp = join(self.cache_dir, 'taxonomy.txt')
+        copy(self.taxonomy_fp, fp)
+        cache_dir = join(self.cache_dir, 'cache')
+
+        exp = sequences_from_query(fp, 'vibrio')
+        self.assertEqual(taxonomy_index(fp, cache_dir).sequences_from_query(
+            'vibrio'), exp)
+        cached = listdir(cache_dir)
+        self.assertEqual(len(cached), 1)
+        self.assertTrue(cached[0].endswith('.taxonomy'))
+
+        self.assertEqual(taxonomy_index(fp, cache_dir).sequences_from_query(
+            'vibrio'), exp)
+        self.assertEqual(listdir(cache_dir), cached)
+
+        # a new release of the taxonomy
+        with open(fp, 'a') as f:
+            f.write('\nNEW|1\tVibrio fischeri')
+        utime(fp, (1, 1))
+        index = taxonomy_index(fp, cache_dir)
+        self.assertEqual(index.sequences_from_query('fischeri'),
+                         {'NEW|1': 'Vibrio fischeri'})
+        self.assertEqual(len(listdir(cache_dir)), 2)
+
+    def test_taxonomy_index_not_cached(self):
+        index = taxonomy_index(self.taxonomy_fp)
+        self.assertEqual(len(index), 16)
+        self.assertEqual(listdir(self.cache_dir), [])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2015--, platypus development team.
+#
+# Distributed under the terms of the BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# ----------------------------------------------------------------------------
+from __future__ import division
+
+import bz2
+import gzip
+from distutils.spawn import find_executable
+from os import close, dup, dup2, makedirs, mkfifo, pipe, write
+from os.path import join, dirname, isdir
+from shutil import rmtree
+from subprocess import check_call
+from tempfile import gettempdir
+from threading import Thread
+from time import sleep
+from unittest import TestCase, main
+
+from platypus.util import (compression, is_stream, open_input, spool,
+                           _thread_reader)
+
+
+def write_slowly(fp, data, pieces=7):
+    """Write data to a named pipe in pieces that split lines, in a thread"""
+    def run():
+        with open(fp, 'wb') as f:
+            step = -(-len(data) // pieces)
+            for i in range(0, len(data), step):
+                f.write(data[i:i + step])
+                f.flush()
+                sleep(0.01)
+
+    thread = Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class UtilTests(TestCase):
+    def setUp(self):
+        self.base = join(dirname(__file__), 'support_files')
+        with open(join(self.base, 'first_db.txt')) as f:
+            self.text = f.read()
+
+        self.temp_dir = join(gettempdir(), 'platypus-test-util')
+        if not isdir(self.temp_dir):
+            makedirs(self.temp_dir)
+
+        self.plain_fp = join(self.temp_dir, 'db.txt')
+        with open(self.plain_fp, 'w') as f:
+            f.write(self.text)
+
+        self.gzip_fp = join(self.temp_dir, 'db.txt.gz')
+        with gzip.open(self.gzip_fp, 'wb') as f:
+            f.write(self.text)
+
+        self.bz2_fp = join(self.temp_dir, 'db')
+        f = bz2.BZ2File(self.bz2_fp, 'wb')
+        f.write(self.text)
+        f.close()
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_compression(self):
+        self.assertIsNone(compression(self.plain_fp))
+        self.assertEqual(compression(self.gzip_fp), 'gzip')
+        self.assertEqual(compression(self.bz2_fp), 'bz2')
+
+    def test_open_input(self):
+        for fp in (self.plain_fp, self.gzip_fp, self.bz2_fp):
+            with open_input(fp) as f:
+                self.assertEqual(f.name, fp)
+                self.assertEqual(f.read(), self.text)
+
+            f = open_input(fp)
+            self.assertEqual(list(f), self.text.splitlines(True))
+            f.close()
+            self.assertTrue(f.closed)
+
+    def test_open_input_xz(self):
+        if find_executable('xz') is None:
+            return
+
+        check_call(['xz', '-k', self.plain_fp])
+        self.assertEqual(compression(self.plain_fp + '.xz'), 'xz')
+        with open_input(self.plain_fp + '.xz') as f:
+            self.assertEqual(f.read(), self.text)
+
+    def test_open_input_corrupted(self):
+        with open(self.gzip_fp, 'rb') as f:
+            data = f.read()
+        with open(self.gzip_fp, 'wb') as f:
+            f.write(data[:len(data) // 2])
+
+        with self.assertRaises(IOError):
+            open_input(self.gzip_fp).read()
+        with self.assertRaises(IOError):
+            list(_thread_reader('gzip', self.gzip_fp))
+
+    def test_is_stream(self):
+        fifo = join(self.temp_dir, 'fifo')
+        mkfifo(fifo)
+        self.assertTrue(is_stream('-'))
+        self.assertTrue(is_stream(fifo))
+        self.assertFalse(is_stream(self.plain_fp))
+
+    def test_open_input_stream(self):
+        """Named pipes are read once, in order, and decompressed"""
+        fifo = join(self.temp_dir, 'fifo')
+        mkfifo(fifo)
+        for fp in (self.plain_fp, self.gzip_fp, self.bz2_fp):
+            with open(fp, 'rb') as f:
+                data = f.read()
+
+            thread = write_slowly(fifo, data)
+            with open_input(fifo) as f:
+                self.assertEqual(f.name, fifo)
+                lines = self.text.splitlines(True)
+                self.assertEqual(f.readline(), lines[0])
+                self.assertEqual(f.read(10), lines[1][:10])
+                self.assertEqual(f.read(), ''.join(lines[1:])[10:])
+            thread.join()
+
+            thread = write_slowly(fifo, data)
+            f = open_input(fifo)
+            self.assertEqual(list(f), self.text.splitlines(True))
+            f.close()
+            thread.join()
+
+    def test_open_input_stdin(self):
+        read_fd, write_fd = pipe()
+        stdin = dup(0)
+        dup2(read_fd, 0)
+        close(read_fd)
+        try:
+            write(write_fd, self.text[:100])
+            close(write_fd)
+            with open_input('-') as f:
+                self.assertEqual(f.read(), self.text[:100])
+        finally:
+            dup2(stdin, 0)
+            close(stdin)
+
+    def test_open_input_short_lines(self):
+        """Lines shorter than the bytes read to detect the format"""
+        text = 'a\nb\nc\nd\n'
+        fifo = join(self.temp_dir, 'fifo')
+        mkfifo(fifo)
+        thread = write_slowly(fifo, text, pieces=1)
+        with open_input(fifo) as f:
+            self.assertEqual(list(f), text.splitlines(True))
+        thread.join()
+
+        read_fd, write_fd = pipe()
+        stdin = dup(0)
+        dup2(read_fd, 0)
+        close(read_fd)
+        try:
+            write(write_fd, text)
+            close(write_fd)
+            with open_input('-') as f:
+                self.assertEqual(list(f), text.splitlines(True))
+        finally:
+            dup2(stdin, 0)
+            close(stdin)
+
+    def test_spool(self):
+        """The writer finishes before the data is read"""
+        fifo = join(self.temp_dir, 'fifo')
+        mkfifo(fifo)
+        # larger than the buffer of a pipe
+        data = self.text * 50
+        thread = write_slowly(fifo, data, 3)
+        with spool(open_input(fifo)) as f:
+            thread.join()
+            self.assertEqual(f.name, fifo)
+            lines = data.splitlines(True)
+            self.assertEqual(f.readline(), lines[0])
+            self.assertEqual(f.read(10), lines[1][:10])
+            self.assertEqual(f.read(), ''.join(lines[1:])[10:])
+            self.assertEqual(f.read(), '')
+            self.assertEqual(f.readline(), '')
+
+        # the data is read while it's being written
+        thread = write_slowly(fifo, data, 20)
+        with spool(open_input(fifo)) as f:
+            self.assertEqual(list(f), lines)
+        thread.join()
+
+    def test_thread_reader(self):
+        for kind, fp in (('gzip', self.gzip_fp), ('bz2', self.bz2_fp)):
+            f = _thread_reader(kind, fp)
+            self.assertEqual(f.readline(), self.text.splitlines(True)[0])
+            self.assertEqual(f.read(10), self.text.splitlines(True)[1][:10])
+            f.close()
+
+            with _thread_reader(kind, fp) as f:
+                self.assertEqual(f.read(), self.text)
+
+
+if __name__ == '__main__':
+    main()